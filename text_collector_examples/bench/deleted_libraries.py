@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Benchmark the /proc/PID/maps scanner of deleted_libraries.py against the line
+by line parser it replaced, on a synthetic proc tree. The scanner runs as in
+the collector, as the procwalk plugin of deleted_libraries.py.
+
+Usage: ./deleted_libraries.py [--processes N] [--mappings N] [--workers N] [--number N]
+"""
+
+import argparse
+import glob
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import deleted_libraries  # noqa: E402
+import procwalk  # noqa: E402
+
+
+def legacy_scan(proc_root):
+    """The maps parsing of deleted_libraries.py before the byte level scanner.
+
+    The per-process bookkeeping is corrected to count every deleted library,
+    so that the results can be compared.
+    """
+    processes_linking_deleted_libraries = {}
+
+    for path in glob.glob(os.path.join(proc_root, '*', 'maps')):
+        with open(path, 'rb') as file:
+            for line in file:
+                part = line.decode().strip().split()
+
+                if len(part) == 7:
+                    library = part[5]
+                    comment = part[6]
+
+                    if '/lib/' in library and '(deleted)' in comment:
+                        pid = os.path.basename(os.path.dirname(path))
+                        libraries = processes_linking_deleted_libraries.setdefault(pid, {})
+                        libraries[library] = libraries.get(library, 0) + 1
+    return processes_linking_deleted_libraries
+
+
+def plugin_scan(root, workers=1, cache_file=None):
+    """Scan like deleted_libraries.py, with its procwalk plugin.
+
+    Returns:
+        (dict) process ID to {library path: number of mappings}, as
+        legacy_scan().
+    """
+    argv = ['--proc-root', root, '--workers', str(workers)]
+    if cache_file is not None:
+        argv += ['--cache-file', cache_file]
+    plugin = deleted_libraries.DeletedLibrariesPlugin(deleted_libraries.parse_args(argv))
+    processes = procwalk.walk(plugin.extractors(), root, workers, plugin.previous())
+    # Writes the cache
+    plugin.metrics(processes)
+    return deleted_libraries.deleted_by_process(processes)
+
+
+def mapping(address, path, deleted=False):
+    return '{0:012x}-{1:012x} r-xp 00000000 fd:01 {2:<10d}                 {3}{4}\n'.format(
+        address, address + 0x1000, address & 0xffffff, path, ' (deleted)' if deleted else '')
+
+
+def create_proc_tree(root, processes, mappings):
+    """Create a proc tree with maps files of the given number of lines.
+
+    One in ten processes is a kernel thread with an empty maps file and no
+    VmLib in its status, one in five maps a deleted library. The root of all
+    processes is root/rootfs, which contains the libraries.
+    """
+    rand = random.Random(0)
+    libraries = ['/usr/lib/x86_64-linux-gnu/lib{0}.so.{1}'.format(name, rand.randint(1, 9))
+                 for name in ('c', 'ssl', 'crypto', 'z', 'm', 'pthread', 'stdc++', 'gcc_s')]
+    rootfs = os.path.join(root, 'rootfs')
+    for library in libraries:
+        os.makedirs(os.path.dirname(rootfs + library), exist_ok=True)
+        open(rootfs + library, 'w').close()
+
+    for pid in range(1, processes + 1):
+        os.makedirs(os.path.join(root, str(pid)))
+        os.symlink(rootfs, os.path.join(root, str(pid), 'root'))
+        with open(os.path.join(root, str(pid), 'stat'), 'w') as f:
+            f.write('{0} (proc {0}) S 1 {0} {0} 0 -1 4194560 1 0 0 0 0 0 0 0 20 0 1 0 {1} {2} '
+                    '100 18446744073709551615 0 0 0 0 0 0 0 0 0 0 0 0 17 0 0 0 0 0 0\n'.format(
+                        pid, 1000 + pid, mappings * 4096))
+        with open(os.path.join(root, str(pid), 'status'), 'w') as f:
+            f.write('Name:\tproc {0}\n'.format(pid))
+            if pid % 10:
+                f.write('VmLib:\t{0:8d} kB\n'.format(mappings * 4))
+        lines = []
+        if pid % 10:
+            for i in range(mappings):
+                address = 0x7f0000000000 + i * 0x1000
+                if i % 7 == 0:
+                    lines.append('{0:012x}-{1:012x} rw-p 00000000 00:00 0 \n'.format(
+                        address, address + 0x1000))
+                else:
+                    lines.append(mapping(address, rand.choice(libraries)))
+            if pid % 5 == 0:
+                lines[rand.randrange(mappings)] = mapping(
+                    0x7e0000000000, rand.choice(libraries), deleted=True)
+        with open(os.path.join(root, str(pid), 'maps'), 'w') as f:
+            f.write(''.join(lines))
+    os.makedirs(os.path.join(root, 'self'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--processes', type=int, default=2000,
+                        help='processes in the synthetic proc tree')
+    parser.add_argument('--mappings', type=int, default=400,
+                        help='mappings per process')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='workers of the parallel scan')
+    parser.add_argument('--number', type=int, default=3,
+                        help='scans per scanner')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='proc-')
+    try:
+        create_proc_tree(root, args.processes, args.mappings)
+
+        cache = os.path.join(root, 'cache.json')
+        expected = legacy_scan(root)
+        for workers in (1, args.workers):
+            if expected != plugin_scan(root, workers):
+                sys.exit('scanners disagree')
+        # Once to fill the cache, once from it
+        for _ in range(2):
+            if expected != plugin_scan(root, cache_file=cache):
+                sys.exit('scanners disagree')
+
+        print('{0} processes x {1} mappings'.format(args.processes, args.mappings))
+        legacy = timeit.timeit(lambda: legacy_scan(root), number=args.number)
+        scans = [
+            ('current', lambda: plugin_scan(root)),
+            ('{0} workers'.format(args.workers), lambda: plugin_scan(root, args.workers)),
+            ('cached', lambda: plugin_scan(root, cache_file=cache)),
+        ]
+        print('{0:<12} {1:8.1f}ms'.format('legacy', legacy / args.number * 1e3))
+        for name, scan in scans:
+            elapsed = timeit.timeit(scan, number=args.number)
+            print('{0:<12} {1:8.1f}ms  speedup {2:.1f}x'.format(
+                name, elapsed / args.number * 1e3, legacy / elapsed))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Benchmark the shared exposition format encoder against the formatting paths
+it replaced in the collectors, on synthetic samples.
+
+Usage: ./exposition.py [--samples N] [--number N]
+"""
+
+import argparse
+import contextlib
+import decimal
+import io
+import os
+import random
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import exposition  # noqa: E402
+
+
+def create_samples(count):
+    """Create (name, labels, value) samples of 20 metrics, half of them floats."""
+    rand = random.Random(0)
+    samples = []
+    for i in range(count):
+        labels = [('disk', '/dev/sd{0}'.format(i % 26)), ('type', 'sat'),
+                  ('serial_number', 'WD-{0:010d}'.format(i))]
+        value = rand.randint(0, 10 ** 9) if i % 2 else rand.random() * 1000
+        samples.append(('metric_{0}'.format(i % 20), labels, value))
+    samples.sort(key=lambda sample: sample[0])
+    return samples
+
+
+def legacy_smartmon(samples, stream):
+    """smartmon.py: a decimal.Decimal per sample, one print() per line."""
+    with contextlib.redirect_stdout(stream):
+        previous_name = None
+        for name, labels, value in samples:
+            if name != previous_name:
+                print('# HELP smartmon_{0} SMART metric {0}'.format(name))
+                print('# TYPE smartmon_{0} gauge'.format(name))
+                previous_name = name
+            labels = ','.join('{k}="{v}"'.format(k=k, v=v) for k, v in labels)
+            print('{key}{{{labels}}} {value}'.format(
+                key='smartmon_' + name, labels=labels, value=decimal.Decimal(value)))
+
+
+def legacy_ntpd(samples, stream):
+    """ntpd_metrics.py: a dict of preformatted label sets per metric, printed with %f."""
+    metrics = {}
+    for name, labels, value in samples:
+        labels = ','.join('%s="%s"' % label for label in labels)
+        metrics.setdefault(name, {})[labels] = value
+    with contextlib.redirect_stdout(stream):
+        for metric, values in metrics.items():
+            print("# HELP ntpd_%s NTPd metric for %s" % (metric, metric))
+            print("# TYPE ntpd_%s gauge" % (metric))
+            for labels in values:
+                print("ntpd_%s{%s} %f" % (metric, labels, values[labels]))
+
+
+def legacy_btrfs(samples, stream):
+    """btrfs_stats.py: a list of lines formatted with %, joined and printed."""
+    contents = []
+    previous_name = None
+    for name, labels, value in samples:
+        if name != previous_name:
+            contents += [
+                "# TYPE node_btrfs_%s gauge" % name,
+                "# HELP node_btrfs_%s btrfs allocation data" % name,
+            ]
+            previous_name = name
+        contents.append('node_btrfs_%s{%s} %d' % (
+            name, ','.join('%s="%s"' % label for label in labels), value))
+    with contextlib.redirect_stdout(stream):
+        print("\n".join(contents))
+
+
+def current(samples, stream):
+    metrics = exposition.Exposition()
+    for name, labels, value in samples:
+        metrics.add(name, value, labels)
+    metrics.write(stream)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--samples', type=int, default=20000,
+                        help='samples per encoding')
+    parser.add_argument('--number', type=int, default=10,
+                        help='encodings per encoder')
+    args = parser.parse_args()
+
+    samples = create_samples(args.samples)
+    encoders = [
+        ('smartmon', legacy_smartmon),
+        ('ntpd_metrics', legacy_ntpd),
+        ('btrfs_stats', legacy_btrfs),
+        ('exposition', current),
+    ]
+    results = {}
+    for name, encode in encoders:
+        results[name] = timeit.timeit(
+            lambda: encode(samples, io.StringIO()), number=args.number) / args.number
+
+    print('{0} samples'.format(args.samples))
+    for name, _ in encoders:
+        print('{0:<14} {1:8.1f}ms  {2:6.2f}us/sample  {3:.1f}x of exposition'.format(
+            name, results[name] * 1e3, results[name] / args.samples * 1e6,
+            results[name] / results['exposition']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Benchmark the fd scanner of inotify-instances against the path based scan it
+replaced, on a synthetic proc tree.
+
+Usage: ./inotify_instances.py [--processes N] [--fds N] [--workers N] [--number N] [--proc PATH]
+
+With --proc, the scans are timed on an existing proc filesystem instead, such
+as /proc. Only there processes without fds are skipped by the size of their
+fd directory, on Linux 6.2 or later.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import procwalk  # noqa: E402
+
+inotify_instances = procwalk.load_inotify_instances()
+
+
+def legacy_scan(proc_root):
+    """The scan of inotify-instances before dir fd relative reads.
+
+    Returns:
+        (dict) pid to inotify instance count, for the processes holding any.
+    """
+    processes = {}
+    for n in os.listdir(proc_root):
+        if not n.isdigit():
+            continue
+        try:
+            os.stat(os.path.join(proc_root, n))
+            with open(os.path.join(proc_root, n, 'cmdline'), 'rb') as f:
+                f.read()
+            instances = 0
+            for fd in os.listdir(os.path.join(proc_root, n, 'fd')):
+                try:
+                    target = os.readlink(os.path.join(proc_root, n, 'fd', fd))
+                except FileNotFoundError:
+                    continue
+                if target == 'anon_inode:inotify':
+                    instances += 1
+        except (PermissionError, FileNotFoundError):
+            continue
+        if instances:
+            processes[int(n)] = instances
+    return processes
+
+
+def current_scan(proc_root, workers=1):
+    return {p.pid: p.inotify_instances
+            for p in inotify_instances._get_processes(proc_root, workers)}
+
+
+FD_TARGETS = ['socket:[{0}]', 'pipe:[{0}]', '/var/lib/app/data-{0}.db', '/dev/null',
+              'anon_inode:[eventpoll]']
+
+
+def fdinfo(watches):
+    """Create the fdinfo of an inotify instance with the given number of watches."""
+    return 'pos:\t0\nflags:\t02004000\nmnt_id:\t15\nino:\t1057\n' + ''.join(
+        'inotify wd:{0:x} ino:{1:x} sdev:800001 mask:fc6 ignored_mask:0 '
+        'fhandle-bytes:8 fhandle-type:1 f_handle:{1:016x}\n'.format(wd + 1, 0x100000 + wd)
+        for wd in range(watches))
+
+
+def create_proc_tree(root, processes, fds):
+    """Create a proc tree of processes with about the given number of fds.
+
+    One in ten processes is a kernel thread without fds, one in fifty holds
+    inotify instances. Only the inotify fds have an fdinfo file.
+    """
+    rand = random.Random(0)
+    for pid in range(1, processes + 1):
+        pid_dir = os.path.join(root, str(pid))
+        fd_dir = os.path.join(pid_dir, 'fd')
+        os.makedirs(fd_dir)
+        os.mkdir(os.path.join(pid_dir, 'fdinfo'))
+        kernel_thread = pid % 10 == 0
+        with open(os.path.join(pid_dir, 'cmdline'), 'wb') as f:
+            if not kernel_thread:
+                f.write('/usr/bin/app-{0}\0--serve\0'.format(pid % 7).encode())
+        if kernel_thread:
+            continue
+        count = rand.randint(fds // 2, fds * 3 // 2)
+        inotify = rand.randint(1, 4) if pid % 50 == 5 else 0
+        for fd in range(count):
+            if fd < inotify:
+                target = 'anon_inode:inotify'
+                with open(os.path.join(pid_dir, 'fdinfo', str(fd)), 'w') as f:
+                    f.write(fdinfo(rand.randint(0, 100)))
+            else:
+                target = rand.choice(FD_TARGETS).format(rand.randint(1, 10 ** 6))
+            os.symlink(target, os.path.join(fd_dir, str(fd)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--processes', type=int, default=1000,
+                        help='processes in the synthetic proc tree')
+    parser.add_argument('--fds', type=int, default=200,
+                        help='average open fds per process')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='worker processes of the parallel scan')
+    parser.add_argument('--number', type=int, default=3,
+                        help='scans per scanner')
+    parser.add_argument('--proc', help='time the scans on this proc filesystem')
+    args = parser.parse_args()
+
+    root = None
+    proc_root = args.proc
+    if proc_root is None:
+        root = tempfile.mkdtemp(prefix='inotify-bench-')
+        proc_root = root
+        create_proc_tree(root, args.processes, args.fds)
+    try:
+        scanners = [
+            ('legacy', lambda: legacy_scan(proc_root)),
+            ('current', lambda: current_scan(proc_root)),
+            ('workers={0}'.format(args.workers),
+             lambda: current_scan(proc_root, args.workers)),
+        ]
+        results = [scan() for _, scan in scanners]
+        if args.proc is None and any(result != results[0] for result in results):
+            sys.exit('The scanners found different inotify instances')
+
+        fds = sum(len(os.listdir(os.path.join(proc_root, pid, 'fd')))
+                  for pid in os.listdir(proc_root)
+                  if pid.isdigit() and os.access(os.path.join(proc_root, pid, 'fd'), os.R_OK))
+        print('{0} processes, {1} fds, {2} holding inotify instances, fd count hint: {3}'.format(
+            sum(1 for pid in os.listdir(proc_root) if pid.isdigit()), fds, len(results[0]),
+            inotify_instances._fd_count_hint(proc_root)))
+        timings = {}
+        for name, scan in scanners:
+            timings[name] = timeit.timeit(scan, number=args.number) / args.number
+        for name, _ in scanners:
+            print('{0:<10} {1:8.1f}ms  {2:.1f}x'.format(
+                name, timings[name] * 1e3, timings['legacy'] / timings[name]))
+    finally:
+        if root is not None:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Benchmark a single procwalk walk for deleted_libraries.py and
+inotify-instances against a walk for each, on a synthetic proc tree.
+
+Usage: ./procwalk.py [--processes N] [--mappings N] [--fds N] [--number N]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import deleted_libraries  # noqa: E402
+import procwalk  # noqa: E402
+from scale import create_proc_tree  # noqa: E402
+
+inotify_instances = procwalk.load_inotify_instances()
+
+
+def separate(proc_root, args):
+    metrics = procwalk.collect_plugins(
+        [deleted_libraries.DeletedLibrariesPlugin(args)], proc_root)
+    metrics.merge(procwalk.collect_plugins(
+        [inotify_instances.InotifyPlugin(proc_root)], proc_root))
+    return metrics.render()
+
+
+def single(proc_root, args):
+    return procwalk.collect_plugins(
+        [deleted_libraries.DeletedLibrariesPlugin(args),
+         inotify_instances.InotifyPlugin(proc_root)], proc_root).render()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--processes', type=int, default=2000,
+                        help='processes in the synthetic proc tree')
+    parser.add_argument('--mappings', type=int, default=200,
+                        help='mappings per process')
+    parser.add_argument('--fds', type=int, default=50,
+                        help='open fds per process')
+    parser.add_argument('--number', type=int, default=3,
+                        help='walks per variant')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='procwalk-')
+    try:
+        create_proc_tree(root, args.processes, args.mappings, args.fds)
+        collector_args = deleted_libraries.parse_args(['--by-cgroup'])
+        if separate(root, collector_args) != single(root, collector_args):
+            sys.exit('The walks disagree')
+
+        print('{0} processes x {1} mappings, {2} fds'.format(
+            args.processes, args.mappings, args.fds))
+        timings = [
+            (name, timeit.timeit(lambda: walk(root, collector_args), number=args.number))
+            for name, walk in [('separate', separate), ('single', single)]]
+        for name, elapsed in timings:
+            print('{0:<10} {1:8.1f}ms  {2:.1f}x'.format(
+                name, elapsed / args.number * 1e3, timings[0][1] / elapsed))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+"""
+Record the commands and files read by a collector, and replay them to run it
+offline.
+
+A fixture is a directory holding everything a collector read in a run:
+
+    collector.json  the collector, its arguments and the snapshots it reads
+    commands.json   the commands it ran, with their exit status and the
+                    file in commands/ holding their output
+    proc/           snapshot of the proc filesystem, with --proc
+    sysfs/, mounts  snapshot of /sys/fs/btrfs, with --sysfs
+    expected.prom   the metrics of the recorded run
+
+Commands are replayed by replacing subprocess.Popen, so collectors run
+unchanged and without starting processes. Files are replayed by pointing the
+collector at the snapshots with its --proc-root, --sysfs-root and --mounts
+options. The recorded run already reads the snapshots, so its metrics are the
+ones replay must reproduce.
+
+The expected.prom of a recorded fixture is what the collector printed, so it
+only catches changes of the output. The fixtures named after a case, like
+smartmon_sata or storcli_degraded, are written by hand instead: small inputs,
+and an expected.prom whose values were worked out from them, down to the
+parsed bytes and sample counts. Do not record over them.
+
+Not replayed: the btrfs device errors read with ioctls on the mounted
+filesystems (mounts is recorded empty), and the NTP control and chronyd
+protocols of ntpd_metrics.py, record it with --backend ntpq.
+
+Usage:
+    ./replay.py record [--proc [PATH]] [--sysfs [PATH]] FIXTURE COLLECTOR
+                       [ARGS...]
+    ./replay.py replay [--check] FIXTURE
+"""
+
+import argparse
+import contextlib
+import difflib
+import importlib
+import io
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import instrumentation  # noqa: E402
+import procwalk  # noqa: E402
+
+FIXTURES = os.path.join(HERE, 'fixtures')
+
+# Samples differing from run to run, left out when checking a replay: the
+# durations of instrumentation.py, and timestamps of some collectors
+VOLATILE_METRICS = {
+    'smartmon': ['smartmon_smartctl_run'],
+}
+
+
+def load_collector(name):
+    """Import a collector by module name, or inotify-instances."""
+    if name in ('inotify-instances', 'inotify_instances'):
+        return procwalk.load_inotify_instances()
+    return importlib.import_module(name)
+
+
+def command_key(argv):
+    """Key of a command in a fixture, without the directory of the program."""
+    return ' '.join([os.path.basename(argv[0])] +
+                    [shlex.quote(arg) for arg in argv[1:]])
+
+
+class NotRecorded(FileNotFoundError):
+    """A command without a recording, raised like a missing program."""
+
+
+class Commands(object):
+    """Commands of a fixture, with their exit status and output."""
+
+    def __init__(self):
+        # key to (returncode, output)
+        self.outputs = {}
+
+    def __call__(self, argv):
+        """Replay a command, see ReplayPopen."""
+        try:
+            return self.outputs[command_key(argv)]
+        except KeyError:
+            raise NotRecorded(
+                2, 'No recording of {}'.format(command_key(argv)), argv[0])
+
+    def add(self, argv, returncode, output):
+        self.outputs[command_key(argv)] = (returncode, output)
+
+    @classmethod
+    def load(cls, fixture):
+        commands = cls()
+        path = os.path.join(fixture, 'commands.json')
+        if not os.path.exists(path):
+            return commands
+        with open(path) as f:
+            index = json.load(f)
+        for key, entry in index.items():
+            path = os.path.join(fixture, entry['output'])
+            with open(path, 'rb') as output:
+                commands.outputs[key] = (entry['returncode'], output.read())
+        return commands
+
+    def save(self, fixture):
+        if self.outputs:
+            os.makedirs(os.path.join(fixture, 'commands'))
+        index = {}
+        for i, key in enumerate(sorted(self.outputs)):
+            returncode, output = self.outputs[key]
+            name = os.path.join('commands', '{:04d}.out'.format(i))
+            with open(os.path.join(fixture, name), 'wb') as f:
+                f.write(output)
+            index[key] = {'returncode': returncode, 'output': name}
+        with open(os.path.join(fixture, 'commands.json'), 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+class ReplayPopen(object):
+    """Stand-in for subprocess.Popen serving the output of a responder.
+
+    The responder is called with the argv of the command and returns its
+    (returncode, output). The output is served on stdout at once, stderr is
+    empty.
+    """
+
+    responder = None
+
+    def __init__(self, args, bufsize=-1, executable=None, stdin=None,
+                 stdout=None, stderr=None, *unused, text=None,
+                 universal_newlines=None, encoding=None, errors=None,
+                 **kwargs):
+        self.args = args
+        if isinstance(args, str):
+            argv = shlex.split(args)
+        else:
+            argv = [str(arg) for arg in args]
+        self._returncode, output = self.responder(argv)
+        self.returncode = None
+        self.pid = 0
+        text_mode = text or universal_newlines or encoding or errors
+        self.stdin = None
+        self.stdout = self._stream(output, stdout, text_mode, encoding, errors)
+        self.stderr = self._stream(b'', stderr, text_mode, encoding, errors)
+
+    @staticmethod
+    def _stream(data, pipe, text_mode, encoding, errors):
+        if pipe != subprocess.PIPE:
+            return None
+        stream = io.BytesIO(data)
+        if text_mode:
+            return io.TextIOWrapper(stream, encoding=encoding, errors=errors)
+        return stream
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for stream in (self.stdout, self.stderr):
+            if stream is not None:
+                stream.close()
+        self.wait()
+
+    def communicate(self, input=None, timeout=None):
+        output = [None, None]
+        for i, stream in enumerate((self.stdout, self.stderr)):
+            if stream is not None:
+                output[i] = stream.read()
+                stream.close()
+        self.wait()
+        return tuple(output)
+
+    def wait(self, timeout=None):
+        self.returncode = self._returncode
+        return self.returncode
+
+    def poll(self):
+        return self.wait()
+
+    def send_signal(self, sig):
+        pass
+
+    def terminate(self):
+        pass
+
+    def kill(self):
+        pass
+
+
+@contextlib.contextmanager
+def patched_popen(responder):
+    """Serve all commands started with subprocess by a responder."""
+    popen = subprocess.Popen
+    subprocess.Popen = type('ReplayPopen', (ReplayPopen,),
+                            {'responder': staticmethod(responder)})
+    try:
+        yield
+    finally:
+        subprocess.Popen = popen
+
+
+@contextlib.contextmanager
+def recording(commands):
+    """Run the commands started with subprocess, adding them to commands."""
+    popen = subprocess.Popen
+
+    def record(argv):
+        proc = popen(argv, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        output = proc.communicate()[0]
+        commands.add(argv, proc.returncode, output)
+        return proc.returncode, output
+
+    with patched_popen(record):
+        yield
+
+
+def copy_file(source, dest, dir_fd=None):
+    """Copy a file read with procwalk.read_bytes().
+
+    Returns:
+        (bool) False if the file cannot be read.
+    """
+    try:
+        data = procwalk.read_bytes(source, dir_fd)
+    except OSError:
+        return False
+    with open(dest, 'wb') as f:
+        f.write(data)
+    return True
+
+
+def snapshot_process(pid_fd, dest, rootfs):
+    """Copy the files of a process read by the procwalk collectors."""
+    os.makedirs(os.path.join(dest, 'fd'))
+    os.mkdir(os.path.join(dest, 'fdinfo'))
+    for name in ('stat', 'cmdline', 'cgroup', 'maps'):
+        if not copy_file(name, os.path.join(dest, name), pid_fd):
+            raise procwalk.ProcessGone()
+    os.symlink(os.path.relpath(rootfs, dest), os.path.join(dest, 'root'))
+    try:
+        os.chown(dest, os.fstat(pid_fd).st_uid, -1)
+    except PermissionError:
+        pass
+
+    # The mapped files, so that they are found from the root of the process
+    with open(os.path.join(dest, 'maps'), 'rb') as f:
+        for line in f:
+            path = line.rstrip(b'\n').partition(b' /')[2]
+            if path and not path.endswith(b' (deleted)'):
+                path = os.path.join(rootfs, os.fsdecode(path))
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    open(path, 'wb').close()
+
+    fd_dir = procwalk.open_dir('fd', pid_fd)
+    try:
+        for fd in os.listdir(fd_dir):
+            try:
+                target = os.readlink(fd, dir_fd=fd_dir)
+            except FileNotFoundError:
+                continue
+            os.symlink(target, os.path.join(dest, 'fd', fd))
+            if target == 'anon_inode:inotify':
+                copy_file(os.path.join('fdinfo', fd),
+                          os.path.join(dest, 'fdinfo', fd), pid_fd)
+    finally:
+        os.close(fd_dir)
+
+
+def snapshot_proc(dest, proc_root='/proc'):
+    """Snapshot the proc filesystem for the procwalk collectors.
+
+    Processes which cannot be read are left out.
+
+    Returns:
+        (int) number of processes in the snapshot.
+    """
+    rootfs = os.path.join(os.path.dirname(dest), 'rootfs')
+    os.makedirs(rootfs)
+    processes = 0
+    for pid in procwalk.list_pids(proc_root):
+        try:
+            pid_fd = procwalk.open_dir(os.path.join(proc_root, pid))
+        except OSError:
+            continue
+        try:
+            snapshot_process(pid_fd, os.path.join(dest, pid), rootfs)
+            processes += 1
+        except (OSError, procwalk.ProcessGone):
+            shutil.rmtree(os.path.join(dest, pid), ignore_errors=True)
+        finally:
+            os.close(pid_fd)
+
+    # Processes are never found empty of fds, see inotify-instances
+    os.makedirs(os.path.join(dest, 'self', 'fd'))
+    inotify = os.path.join(dest, 'sys', 'fs', 'inotify')
+    os.makedirs(inotify)
+    for name in ('max_user_instances', 'max_user_watches'):
+        copy_file(os.path.join(proc_root, 'sys', 'fs', 'inotify', name),
+                  os.path.join(inotify, name))
+    return processes
+
+
+def snapshot_sysfs(dest, sysfs_root='/sys/fs/btrfs'):
+    """Snapshot the btrfs directory of sysfs.
+
+    The device links are copied as directories holding the device size.
+    """
+    os.makedirs(dest)
+    if not os.path.isdir(sysfs_root):
+        return
+    for path, dirs, files in os.walk(sysfs_root):
+        relative = os.path.relpath(path, sysfs_root)
+        target = os.path.join(dest, relative)
+        os.makedirs(target, exist_ok=True)
+        if os.path.basename(path) == 'devices':
+            links = [f for f in files
+                     if os.path.islink(os.path.join(path, f))]
+            for device in dirs + links:
+                os.makedirs(os.path.join(target, device), exist_ok=True)
+                copy_file(os.path.join(path, device, 'size'),
+                          os.path.join(target, device, 'size'))
+            dirs[:] = []
+            continue
+        for name in files:
+            copy_file(os.path.join(path, name), os.path.join(target, name))
+
+
+def collector_argv(fixture, config):
+    """Arguments of the collector of a fixture, pointing at its snapshots."""
+    argv = list(config['args'])
+    for option, path in sorted(config.get('snapshots', {}).items()):
+        argv += [option, os.path.join(fixture, path)]
+    return argv
+
+
+def load_fixture(fixture):
+    """Load a fixture.
+
+    Returns:
+        (collector module, argv, Commands) tuple.
+    """
+    with open(os.path.join(fixture, 'collector.json')) as f:
+        config = json.load(f)
+    return (load_collector(config['collector']),
+            collector_argv(fixture, config), Commands.load(fixture))
+
+
+def record(fixture, collector, args, proc_root=None, sysfs_root=None):
+    """Record a fixture of a collector.
+
+    Args:
+        fixture: (str) directory of the new fixture.
+        collector: (str) module name of the collector.
+        args: (list) arguments of the collector.
+        proc_root: (str) proc filesystem to snapshot, if any.
+        sysfs_root: (str) btrfs directory of sysfs to snapshot, if any.
+
+    Returns:
+        (str) the metrics of the recorded run.
+    """
+    os.makedirs(fixture)
+    config = {'collector': collector, 'args': list(args), 'snapshots': {}}
+    if proc_root:
+        snapshot_proc(os.path.join(fixture, 'proc'), proc_root)
+        config['snapshots']['--proc-root'] = 'proc'
+    if sysfs_root:
+        snapshot_sysfs(os.path.join(fixture, 'sysfs'), sysfs_root)
+        open(os.path.join(fixture, 'mounts'), 'w').close()
+        config['snapshots']['--sysfs-root'] = 'sysfs'
+        config['snapshots']['--mounts'] = 'mounts'
+    with open(os.path.join(fixture, 'collector.json'), 'w') as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+    module = load_collector(collector)
+    argv = collector_argv(fixture, config)
+    commands = Commands()
+    with recording(commands):
+        output = module.collect(module.parse_args(argv)).render()
+    commands.save(fixture)
+    with open(os.path.join(fixture, 'expected.prom'), 'w') as f:
+        f.write(output)
+    return output
+
+
+def replay(fixture):
+    """Run the collector of a fixture on its recordings.
+
+    Returns:
+        (str) the metrics.
+    """
+    module, argv, commands = load_fixture(fixture)
+    with patched_popen(commands):
+        return module.collect(module.parse_args(argv)).render()
+
+
+def stable_lines(output, collector):
+    volatile = (instrumentation.TIMING_METRICS +
+                tuple(VOLATILE_METRICS.get(collector, [])))
+    return [line for line in output.splitlines(True)
+            if not line.startswith(volatile)]
+
+
+def check(fixture):
+    """Check that a replay reproduces the metrics of the recorded run.
+
+    Returns:
+        (list) the lines of a unified diff, empty if it does.
+    """
+    with open(os.path.join(fixture, 'collector.json')) as f:
+        collector = json.load(f)['collector']
+    with open(os.path.join(fixture, 'expected.prom')) as f:
+        expected = stable_lines(f.read(), collector)
+    actual = stable_lines(replay(fixture), collector)
+    return list(difflib.unified_diff(
+        expected, actual, 'expected.prom', 'replay'))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n\n')[0])
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    record_parser = subparsers.add_parser('record', help='record a fixture')
+    record_parser.add_argument(
+        '--proc', nargs='?', const='/proc', metavar='PATH',
+        help='snapshot the proc filesystem')
+    record_parser.add_argument(
+        '--sysfs', nargs='?', const='/sys/fs/btrfs', metavar='PATH',
+        help='snapshot the btrfs directory of sysfs')
+    record_parser.add_argument(
+        'fixture', help='directory of the new fixture')
+    record_parser.add_argument(
+        'collector', help='module name of the collector')
+    record_parser.add_argument(
+        'args', nargs=argparse.REMAINDER, help='arguments of the collector')
+    replay_parser = subparsers.add_parser('replay', help='replay a fixture')
+    replay_parser.add_argument(
+        '--check', action='store_true',
+        help='compare the metrics to the recorded ones')
+    replay_parser.add_argument('fixture', help='directory of the fixture')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        sys.stdout.write(record(args.fixture, args.collector, args.args,
+                                args.proc, args.sysfs))
+    elif args.check:
+        diff = check(args.fixture)
+        if diff:
+            sys.stdout.writelines(diff)
+            sys.exit(1)
+    else:
+        sys.stdout.write(replay(args.fixture))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Benchmark the collectors offline, on the fixtures of replay.py and on
+synthetic inputs at scale, and report the wall time, CPU time and peak memory
+of each scenario.
+
+Every run of a scenario is forked, so runs do not share caches and the CPU
+time and peak resident memory are the ones of the run. Peak memory is
+reported above the one of a forked run doing nothing. The best of --number
+runs is reported.
+
+The scale scenarios are 1000 disks for smartmon.py, 8 controllers of 240
+drives for storcli.py and 50000 processes for procwalk.py. The proc tree of
+the latter is created once in --scale-dir.
+
+With --save, the results are written to a JSON file. With --baseline, they
+are compared to such a file, and the script fails if a scenario got slower
+or larger by more than --tolerance.
+
+Usage: ./run.py [--scale] [--number N] [--save FILE] [--baseline FILE]
+                [SCENARIO...]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import traceback
+
+import replay
+import scale
+
+# Scenarios on the recorded fixtures: name, fixture, extra collector arguments
+FIXTURE_SCENARIOS = [
+    ('smartmon_text', 'smartmon_text', []),
+    ('smartmon_json', 'smartmon_json', []),
+    ('storcli', 'storcli', []),
+    ('storcli_stream', 'storcli', ['--stream']),
+    ('ntpd_metrics', 'ntpd_metrics', []),
+    ('btrfs_stats', 'btrfs_stats', []),
+    ('procwalk', 'procwalk', []),
+]
+
+PROC_TREE = (50000, 20, 10)
+
+
+def fixture_setup(fixture, extra):
+    def setup(args):
+        module, argv, commands = replay.load_fixture(
+            os.path.join(replay.FIXTURES, fixture))
+        return module, argv + extra, commands
+    return setup
+
+
+def smartmon_scale(args):
+    fixture = os.path.join(replay.FIXTURES, 'smartmon_json')
+    module, argv, _ = replay.load_fixture(fixture)
+    return module, argv, scale.SmartctlScale(fixture, 1000)
+
+
+def storcli_scale(extra):
+    def setup(args):
+        fixture = os.path.join(replay.FIXTURES, 'storcli')
+        module, argv, _ = replay.load_fixture(fixture)
+        return module, argv + extra, scale.StorcliScale(fixture, 8, 240)
+    return setup
+
+
+def procwalk_scale(args):
+    root = scale.proc_tree(args.scale_dir, *PROC_TREE)
+    argv = ['--proc-root', root, '--by-cgroup']
+    return replay.load_collector('procwalk'), argv, None
+
+
+SCENARIOS = [(name, fixture_setup(fixture, extra), False)
+             for name, fixture, extra in FIXTURE_SCENARIOS] + [
+    ('smartmon_1000', smartmon_scale, True),
+    ('storcli_8x240', storcli_scale([]), True),
+    ('storcli_8x240_stream', storcli_scale(['--stream']), True),
+    ('procwalk_50k', procwalk_scale, True),
+]
+
+
+def run_forked(function):
+    """Run function in a forked process.
+
+    Returns:
+        (wall time, resource usage, JSON result of function) tuple.
+    """
+    read_fd, write_fd = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            os.close(read_fd)
+            result = function()
+            with os.fdopen(write_fd, 'w') as f:
+                json.dump(result, f)
+        except BaseException:
+            status = 1
+            traceback.print_exc()
+        finally:
+            sys.stderr.flush()
+            os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        output = f.read()
+    _, status, rusage = os.wait4(pid, 0)
+    wall = time.perf_counter() - start
+    if status != 0:
+        raise RuntimeError('run failed')
+    return wall, rusage, json.loads(output)
+
+
+def collect(module, args, responder):
+    """Run a collector, with its commands served by responder."""
+    if responder is None:
+        output = module.collect(args).render()
+    else:
+        with replay.patched_popen(responder):
+            output = module.collect(args).render()
+    return sum(1 for line in output.splitlines() if not line.startswith('#'))
+
+
+def benchmark(setup, args):
+    """Benchmark a scenario.
+
+    Returns:
+        (dict) best wall and CPU time in seconds, peak memory in bytes and the
+        number of samples.
+    """
+    module, argv, responder = setup(args)
+    collector_args = module.parse_args(argv)
+    idle = run_forked(lambda: None)[1].ru_maxrss
+    result = None
+    for _ in range(args.number):
+        wall, rusage, samples = run_forked(
+            lambda: collect(module, collector_args, responder))
+        run = {
+            'wall': wall,
+            'cpu': rusage.ru_utime + rusage.ru_stime,
+            'memory': max(0, rusage.ru_maxrss - idle) * 1024,
+            'samples': samples,
+        }
+        if result is None:
+            result = run
+        else:
+            result = {key: min(result[key], run[key]) for key in run}
+    return result
+
+
+def regressions(results, baseline, tolerance, min_time=0.005,
+                min_memory=1 << 20):
+    """Compare results to a baseline.
+
+    Differences below min_time seconds and min_memory bytes are noise.
+
+    Yields:
+        (str) descriptions of the regressions.
+    """
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key, minimum in (('wall', min_time), ('cpu', min_time),
+                             ('memory', min_memory)):
+            if (result[key] > base[key] * (1 + tolerance) and
+                    result[key] - base[key] > minimum):
+                yield '{}: {} {:.4g} -> {:.4g}'.format(
+                    name, key, base[key], result[key])
+        if result['samples'] != base['samples']:
+            yield '{}: samples {} -> {}'.format(
+                name, base['samples'], result['samples'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument(
+        '--scale', action='store_true',
+        help='also run the scenarios at scale')
+    parser.add_argument(
+        '--scale-dir',
+        default=os.path.join(tempfile.gettempdir(), 'collector-bench'),
+        help='directory caching the synthetic proc tree')
+    parser.add_argument(
+        '--number', type=int, default=3,
+        help='runs per scenario')
+    parser.add_argument(
+        '--save', metavar='FILE',
+        help='write the results to FILE')
+    parser.add_argument(
+        '--baseline', metavar='FILE',
+        help='compare the results to the ones saved in FILE')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help='fraction by which a result may exceed the baseline')
+    parser.add_argument(
+        'scenarios', nargs='*', metavar='SCENARIO',
+        help='run only these scenarios, out of: {}'.format(
+            ', '.join(name for name, _, _ in SCENARIOS)))
+    args = parser.parse_args()
+
+    names = [name for name, _, _ in SCENARIOS]
+    unknown = set(args.scenarios) - set(names)
+    if unknown:
+        parser.error(
+            'unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+    os.makedirs(args.scale_dir, exist_ok=True)
+
+    results = {}
+    print('{:<22} {:>10} {:>10} {:>10} {:>8}'.format(
+        'scenario', 'wall ms', 'cpu ms', 'peak MiB', 'samples'))
+    for name, setup, at_scale in SCENARIOS:
+        if args.scenarios and name not in args.scenarios:
+            continue
+        if not args.scenarios and at_scale and not args.scale:
+            continue
+        result = results[name] = benchmark(setup, args)
+        print('{:<22} {:10.1f} {:10.1f} {:10.1f} {:8d}'.format(
+            name, result['wall'] * 1e3, result['cpu'] * 1e3,
+            result['memory'] / (1 << 20), result['samples']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = list(regressions(results, json.load(f), args.tolerance))
+        for regression in found:
+            print('Regression: ' + regression, file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+"""
+Synthetic inputs of the collectors at the scale of large hosts.
+
+The smartctl and storcli responders multiply the recordings of a fixture, see
+replay.py, and serve them like replay.Commands:
+
+    SmartctlScale(fixture, 1000)    smartctl of a host with 1000 disks
+    StorcliScale(fixture, 8, 240)   storcli of 8 controllers, 240 drives each
+
+create_proc_tree() writes a proc tree of processes with their mappings and
+fds, proc_tree() caches one for reuse between runs.
+"""
+
+import copy
+import json
+import os
+import random
+import re
+import shutil
+import string
+
+import replay
+
+SERIAL_RES = [re.compile(rb'"serial_number": "([^"]+)"'),
+              re.compile(rb'Serial Number:\s+(\S+)')]
+
+
+def disk_name(prefix, i):
+    """Name the i-th disk like the kernel: sda ... sdz, sdaa ... sdzz, ..."""
+    letters = ''
+    i += 1
+    while i:
+        i, remainder = divmod(i - 1, 26)
+        letters = string.ascii_lowercase[remainder] + letters
+    return prefix + letters
+
+
+class SmartctlScale(object):
+    """smartctl of a host with many disks, copying a smartmon fixture.
+
+    The disks take turns at copying a recorded disk, each with a serial
+    number of its own.
+    """
+
+    def __init__(self, fixture, disks):
+        self.commands = replay.Commands.load(fixture)
+        returncode, output = self.commands(['smartctl', '--scan-open'])
+        lines = output.decode().splitlines()
+        scan = []
+        # device path to (recorded device path, serial suffix)
+        self.devices = {}
+        counts = {}
+        for i in range(disks):
+            line = lines[i % len(lines)]
+            template = line.split()[0]
+            if template.startswith('/dev/nvme'):
+                prefix = '/dev/nvme'
+            else:
+                prefix = '/dev/sd'
+            n = counts[prefix] = counts.get(prefix, -1) + 1
+            if prefix == '/dev/nvme':
+                device = prefix + str(n)
+            else:
+                device = disk_name(prefix, n)
+            self.devices[device] = (template, '-{:04d}'.format(i))
+            scan.append(line.replace(template, device))
+        output = ''.join(line + '\n' for line in scan)
+        self.scan = (returncode, output.encode())
+
+    def __call__(self, argv):
+        if argv[1:] == ['--scan-open']:
+            return self.scan
+        device = next((arg for arg in argv if arg in self.devices), None)
+        if device is None:
+            return self.commands(argv)
+        template, suffix = self.devices[device]
+        returncode, output = self.commands(
+            [template if arg == device else arg for arg in argv])
+        for serial_re in SERIAL_RES:
+            for serial in set(serial_re.findall(output)):
+                output = output.replace(serial, serial + suffix.encode())
+        return returncode, output.replace(template.encode(), device.encode())
+
+
+class StorcliScale(object):
+    """storcli of controllers with many drives, from the first controller and
+    drive of a storcli fixture.
+
+    The outputs of all controllers and of each, as queried with --parallel,
+    are generated upfront, so they do not count towards a benchmarked run.
+    """
+
+    def __init__(self, fixture, controllers, drives):
+        commands = replay.Commands.load(fixture)
+        show = json.loads(
+            commands(['storcli64', '/cALL', 'show', 'all', 'J'])[1])
+        show_drives = json.loads(
+            commands(['storcli64', '/cALL/eALL/sALL', 'show', 'all', 'J'])[1])
+
+        controller_template = show['Controllers'][0]
+        drives_template = show_drives['Controllers'][0]
+        pd_template = controller_template['Response Data']['PD LIST'][0]
+        enclosure, slot = pd_template['EID:Slt'].split(':')
+        drive_prefix = 'Drive /c0/e{}/s{}'.format(enclosure, slot)
+        drive_template = json.dumps(
+            {key: value
+             for key, value in drives_template['Response Data'].items()
+             if key.startswith(drive_prefix + ' ') or key == drive_prefix})
+
+        controller_outputs = []
+        drive_outputs = []
+        for c in range(controllers):
+            controller = copy.deepcopy(controller_template)
+            controller['Command Status']['Controller'] = c
+            data = controller['Response Data']
+            data['Basics']['Controller'] = c
+            data['Basics']['Serial Number'] = '{}-{}'.format(
+                data['Basics']['Serial Number'], c)
+            data['Physical Drives'] = drives
+            data['PD LIST'] = []
+            response = {}
+            for s in range(drives):
+                pd = dict(pd_template, DID=s)
+                pd['EID:Slt'] = '{}:{}'.format(enclosure, s)
+                data['PD LIST'].append(pd)
+                drive = json.loads(drive_template.replace(
+                    drive_prefix,
+                    'Drive /c{}/e{}/s{}'.format(c, enclosure, s)))
+                for value in drive.values():
+                    if isinstance(value, list):
+                        value[0].update(pd)
+                response.update(drive)
+            controller_outputs.append(controller)
+            status = dict(drives_template['Command Status'], Controller=c)
+            drive_outputs.append(dict(drives_template, **{
+                'Command Status': status,
+                'Response Data': response}))
+
+        # selector of the command to its output
+        self.outputs = {}
+        for selector, outputs in (('', controller_outputs),
+                                  ('/eALL/sALL', drive_outputs)):
+            self.outputs['/cALL' + selector] = self.encode(outputs)
+            for c, output in enumerate(outputs):
+                self.outputs['/c{}{}'.format(c, selector)] = self.encode(
+                    [output])
+
+    @staticmethod
+    def encode(controllers):
+        return json.dumps({'Controllers': controllers}, indent=4).encode()
+
+    def __call__(self, argv):
+        return 0, self.outputs[argv[1]]
+
+
+LIBRARIES = ['/usr/lib/x86_64-linux-gnu/lib{}.so.6'.format(name)
+             for name in ('c', 'ssl', 'crypto', 'z', 'm', 'stdc++')]
+FD_TARGETS = ['socket:[{0}]', 'pipe:[{0}]', '/var/lib/app/data-{0}.db',
+              '/dev/null']
+INOTIFY_FDINFO = ('pos:\t0\nflags:\t02004000\n'
+                  'inotify wd:1 ino:2 sdev:3 mask:fc6\n')
+
+
+def create_proc_tree(root, processes, mappings, fds):
+    """Create a proc tree with maps files and fds.
+
+    One in ten processes is a kernel thread without mappings and fds, one in
+    five maps a deleted library and one in fifty holds an inotify instance.
+    """
+    rand = random.Random(0)
+    for pid in range(1, processes + 1):
+        pid_dir = os.path.join(root, str(pid))
+        os.makedirs(os.path.join(pid_dir, 'fd'))
+        os.mkdir(os.path.join(pid_dir, 'fdinfo'))
+        with open(os.path.join(pid_dir, 'cgroup'), 'w') as f:
+            f.write('0::/system.slice/app{}.service\n'.format(pid % 7))
+        kernel_thread = pid % 10 == 0
+        lines = []
+        with open(os.path.join(pid_dir, 'cmdline'), 'w') as f:
+            if not kernel_thread:
+                f.write('/usr/bin/app\0')
+        with open(os.path.join(pid_dir, 'stat'), 'w') as f:
+            vsize = 0 if kernel_thread else 10 ** 7 + mappings
+            f.write('{0} (app) S 1 {0} {0} 0 -1 4194560 100 0 0 0 1 1 0 0 20 '
+                    '0 1 0 {1} {2} 300 18446744073709551615\n'.format(
+                        pid, 1000 + pid, vsize))
+        if not kernel_thread:
+            for i in range(mappings):
+                address = 0x7f0000000000 + i * 0x1000
+                deleted = pid % 5 == 0 and i == 0
+                lines.append(
+                    '{:012x}-{:012x} r-xp 00000000 fd:01 {:<10d}       '
+                    '{}{}\n'.format(
+                        address, address + 0x1000, i, rand.choice(LIBRARIES),
+                        ' (deleted)' if deleted else ''))
+            for fd in range(fds):
+                target = rand.choice(FD_TARGETS).format(
+                    rand.randint(1, 10 ** 6))
+                if pid % 50 == 5 and fd == 3:
+                    target = 'anon_inode:inotify'
+                    fdinfo = os.path.join(pid_dir, 'fdinfo', str(fd))
+                    with open(fdinfo, 'w') as f:
+                        f.write(INOTIFY_FDINFO)
+                os.symlink(target, os.path.join(pid_dir, 'fd', str(fd)))
+        with open(os.path.join(pid_dir, 'maps'), 'w') as f:
+            f.write(''.join(lines))
+
+
+def proc_tree(directory, processes, mappings, fds):
+    """Get a proc tree of create_proc_tree() in directory, creating it once.
+
+    Returns:
+        (str) path of the proc tree.
+    """
+    root = os.path.join(
+        directory, 'proc-{}x{}x{}'.format(processes, mappings, fds))
+    if not os.path.isdir(root):
+        partial = root + '.partial'
+        shutil.rmtree(partial, ignore_errors=True)
+        create_proc_tree(partial, processes, mappings, fds)
+        os.rename(partial, root)
+    return root
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Benchmark the SMART attribute table parser of smartmon.py against the
+csv.DictReader based parser it replaced, on the recorded smartctl outputs
+in fixtures/.
+
+Usage: ./smartmon_attributes.py [--number N]
+"""
+
+import argparse
+import csv
+import glob
+import os
+import re
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import smartmon  # noqa: E402
+
+
+def legacy_parse(attributes):
+    """The attribute parsing of smartmon.py before the single pass parser.
+
+    Returns:
+        (list) (name, value, worst, threshold, raw_value) of whitelisted
+        attributes.
+    """
+    result = []
+    attributes = re.sub(r'[\t\x20]+', ' ', attributes)
+    attribute_lines = attributes.strip().split('\n')[7:]
+
+    reader = csv.DictReader(
+        (l.strip() for l in attribute_lines),
+        fieldnames=smartmon.SmartAttribute._fields[:-1],
+        restkey=smartmon.SmartAttribute._fields[-1], delimiter=' ')
+    for entry in reader:
+        entry['name'] = entry['name'].lower()
+        if entry['name'] not in smartmon.smart_attributes_whitelist:
+            continue
+
+        m = re.match(r'^(\d+)', ' '.join(entry['raw_value']))
+        if not m:
+            continue
+
+        result.append((entry['name'], entry['value'], entry['worst'],
+                       entry['threshold'], int(m.group(1))))
+    return result
+
+
+def current_parse(attributes):
+    """The attribute parsing of smartmon.py, with the same result."""
+    result = []
+    for attr in smartmon.parse_ata_attributes(attributes):
+        name = attr.name.lower()
+        if name not in smartmon.smart_attributes_whitelist:
+            continue
+
+        raw = smartmon.decode_raw_value(attr.raw_value)
+        if raw is None:
+            continue
+
+        result.append((name, attr.value, attr.worst, attr.threshold, raw))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--number', type=int, default=2000,
+                        help='parses per fixture and parser')
+    args = parser.parse_args()
+
+    for path in sorted(glob.glob(
+            os.path.join(HERE, 'fixtures', 'smartctl_attributes_*.txt'))):
+        with open(path) as f:
+            output = f.read()
+
+        if legacy_parse(output) != current_parse(output):
+            sys.exit('{}: parsers disagree'.format(path))
+
+        legacy = timeit.timeit(
+            lambda: legacy_parse(output), number=args.number)
+        current = timeit.timeit(
+            lambda: current_parse(output), number=args.number)
+        print('{:<32} legacy {:8.1f}us  current {:8.1f}us  speedup {:.1f}x'
+              .format(os.path.basename(path),
+                      legacy / args.number * 1e6,
+                      current / args.number * 1e6,
+                      legacy / current))
+
+
+if __name__ == '__main__':
+    main()
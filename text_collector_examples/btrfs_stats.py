@@ -1,25 +1,119 @@
 #!/usr/bin/env python3
 
 # Collect per-device btrfs filesystem errors.
-# Designed to work on Debian and Centos 6 (with python2.6).
+# Requires Python 3.3 or later.
 
+import argparse
+import binascii
 import collections
-import glob
+import errno
+import fcntl
 import os
 import re
+import struct
 import subprocess
+import sys
 
-def get_btrfs_mount_points():
-    """List all btrfs mount points.
+import exposition
+import instrumentation
+
+# ioctl request numbers from linux/btrfs.h, with the _IOC encoding shared by
+# most architectures (x86, arm, ...).
+BTRFS_IOCTL_MAGIC = 0x94
+_IOC_WRITE = 1
+_IOC_READ = 2
+
+def _ioc(direction, nr, size):
+    return (direction << 30) | (size << 16) | (BTRFS_IOCTL_MAGIC << 8) | nr
+
+BTRFS_IOC_DEV_INFO = _ioc(_IOC_READ | _IOC_WRITE, 30, 4096)
+BTRFS_IOC_FS_INFO = _ioc(_IOC_READ, 31, 1024)
+BTRFS_IOC_GET_DEV_STATS = _ioc(_IOC_READ | _IOC_WRITE, 52, 1032)
+
+# Offset of the path in struct btrfs_ioctl_dev_info_args.
+BTRFS_DEV_INFO_PATH_OFFSET = 3072
+
+# Names of the values of struct btrfs_ioctl_get_dev_stats, as printed by
+# `btrfs device stats`.
+BTRFS_DEV_STATS = ('write_io_errs', 'read_io_errs', 'flush_io_errs',
+                   'corruption_errs', 'generation_errs')
+
+def get_btrfs_mounts(mounts="/proc/mounts"):
+    """List all btrfs mounts.
+
+    Args:
+        mounts: (string) path to the list of mounted filesystems.
 
     Yields:
-        (string) filesystem mount points.
+        (device, mountpoint) tuples of the mounted block device and the
+        filesystem mount point.
     """
-    with open("/proc/mounts") as f:
+    with open(mounts) as f:
         for line in f:
             parts = line.split()
             if parts[2] == "btrfs":
-                yield parts[1]
+                yield parts[0], parts[1]
+
+def get_btrfs_mount_points(mounts="/proc/mounts"):
+    """List all btrfs mount points.
+
+    Yields:
+        (string) filesystem mount points.
+    """
+    for _, mountpoint in get_btrfs_mounts(mounts):
+        yield mountpoint
+
+def get_btrfs_fs_info(fd):
+    """Get the filesystem information with BTRFS_IOC_FS_INFO.
+
+    Args:
+        fd: (int) file descriptor of the opened mount point.
+
+    Returns:
+        (max_id, fsid) tuple of the highest device ID and the filesystem UUID
+        as hex string.
+    """
+    buf = bytearray(1024)
+    fcntl.ioctl(fd, BTRFS_IOC_FS_INFO, buf, True)
+    max_id, _, fsid = struct.unpack_from("=QQ16s", buf)
+    return max_id, binascii.hexlify(fsid).decode('ascii')
+
+def get_btrfs_errors_ioctl(fd, max_id):
+    """Get per-device errors with the DEV_INFO and GET_DEV_STATS ioctls.
+
+    Args:
+        fd: (int) file descriptor of the opened mount point.
+        max_id: (int) highest device ID of the filesystem.
+
+    Yields:
+        (device, error_type, error_count) tuples, as get_btrfs_errors().
+    """
+    # Device IDs may have gaps after device removal, ID 0 is the target of a
+    # running device replace.
+    for devid in range(max_id + 1):
+        dev_info = bytearray(4096)
+        struct.pack_into("=Q", dev_info, 0, devid)
+        try:
+            fcntl.ioctl(fd, BTRFS_IOC_DEV_INFO, dev_info, True)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENODEV:
+                continue
+            raise
+        path = dev_info[BTRFS_DEV_INFO_PATH_OFFSET:].split(b"\0", 1)[0]
+
+        dev_stats = bytearray(1032)
+        struct.pack_into("=QQQ", dev_stats, 0, devid, len(BTRFS_DEV_STATS), 0)
+        try:
+            fcntl.ioctl(fd, BTRFS_IOC_GET_DEV_STATS, dev_stats, True)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENODEV:
+                continue
+            raise
+        nr_items = min(struct.unpack_from("=Q", dev_stats, 8)[0],
+                       len(BTRFS_DEV_STATS))
+        values = struct.unpack_from("=%dQ" % nr_items, dev_stats, 24)
+        for error_type, error_count in zip(BTRFS_DEV_STATS, values):
+            yield path.decode("utf-8"), error_type, error_count
 
 def get_btrfs_errors(mountpoint):
     """Get per-device errors for a btrfs mount point.
@@ -33,9 +127,11 @@ def get_btrfs_errors(mountpoint):
             error_type: (string) type of btrfs error.
             error_count: (int) number of btrfs errors of a given type.
     """
-    p = subprocess.Popen(["btrfs", "device", "stats", mountpoint],
-                         stdout=subprocess.PIPE)
-    (stdout, stderr) = p.communicate()
+    with instrumentation.command():
+        p = subprocess.Popen(["btrfs", "device", "stats", mountpoint],
+                             stdout=subprocess.PIPE)
+        (stdout, stderr) = p.communicate()
+    instrumentation.parsed(len(stdout))
     if p.returncode != 0:
         raise RuntimeError("btrfs returned exit code %d" % p.returncode)
     for line in stdout.splitlines():
@@ -48,65 +144,247 @@ def get_btrfs_errors(mountpoint):
             raise RuntimeError("unexpected output from btrfs: '%s'" % line)
         yield m.group(1), m.group(2), int(m.group(3))
 
-def btrfs_error_metrics():
+def btrfs_error_metrics(metrics, mounts="/proc/mounts"):
     """Collect btrfs error metrics.
 
-    Returns:
-        a list of strings to be exposed as Prometheus metrics.
+    Args:
+        metrics: (exposition.Exposition) metrics to add to.
+        mounts: (string) path to the list of mounted filesystems.
     """
     metric = "node_btrfs_errors_total"
-    contents = [
-        "# TYPE %s counter" % metric,
-        "# HELP %s number of btrfs errors" % metric,
+    # Subvolumes of a filesystem may be mounted many times, query each
+    # filesystem once: by UUID, else by mounted device.
+    seen = set()
+    for mount_device, mountpoint in get_btrfs_mounts(mounts):
+        fd = None
+        fsid = None
+        try:
+            fd = os.open(mountpoint, os.O_RDONLY | os.O_DIRECTORY)
+            max_id, fsid = get_btrfs_fs_info(fd)
+        except (IOError, OSError):
+            if fd is not None:
+                os.close(fd)
+                fd = None
+
+        key = fsid or mount_device
+        if key in seen:
+            if fd is not None:
+                os.close(fd)
+            continue
+        seen.add(key)
+
+        errors = None
+        if fd is not None:
+            try:
+                errors = list(get_btrfs_errors_ioctl(fd, max_id))
+            except (IOError, OSError):
+                pass
+            finally:
+                os.close(fd)
+        if errors is None:
+            errors = get_btrfs_errors(mountpoint)
+
+        for device, error_type, error_count in errors:
+            labels = [("mountpoint", mountpoint), ("device", device),
+                      ("type", error_type)]
+            metrics.add(metric, error_count, labels,
+                        help="number of btrfs errors", type="counter")
+
+class SysfsDirectory(object):
+    """A sysfs directory, opened to read its attributes relative to it.
+
+    Attributes are read into a buffer shared by the directory and all of its
+    subdirectories, so reading a value costs a single open, read and close.
+    """
+
+    def __init__(self, path, dir_fd=None, buf=None):
+        self.fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY, dir_fd=dir_fd)
+        self.buf = buf if buf is not None else bytearray(4096)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        os.close(self.fd)
+
+    def subdirectory(self, name):
+        return SysfsDirectory(name, dir_fd=self.fd, buf=self.buf)
+
+    def listdir(self):
+        return os.listdir(self.fd)
+
+    def read_int(self, name):
+        """Read an integer attribute.
+
+        Returns:
+            (int) value of the attribute, None if it does not exist.
+        """
+        try:
+            fd = os.open(name, os.O_RDONLY, dir_fd=self.fd)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            size = os.readv(fd, [self.buf])
+        finally:
+            os.close(fd)
+        instrumentation.parsed(size)
+        return int(self.buf[:size])
+
+# Block group profiles, subdirectories of /sys/fs/btrfs/<fs>/allocation/<type>.
+BTRFS_PROFILES = frozenset(('single', 'dup', 'raid0', 'raid1', 'raid1c3',
+                            'raid1c4', 'raid10', 'raid5', 'raid6'))
+
+def read_btrfs_allocation(alloc, fs, metrics):
+    """Read the allocation of a btrfs filesystem.
+
+    Args:
+        alloc: (SysfsDirectory) allocation directory of the filesystem.
+        fs: (string) UUID of the filesystem.
+        metrics: (dict) metric name to list of (labels, value) tuples, to add
+            to.
+    """
+    prefix = 'node_btrfs_allocation'
+    metric_to_filename = [
+        ('size_bytes', 'total_bytes'),
+        ('used_bytes', 'bytes_used'),
+        ('reserved_bytes', 'bytes_reserved'),
+        ('pinned_bytes', 'bytes_pinned'),
+        ('disk_size_bytes', 'disk_total'),
+        ('disk_used_bytes', 'disk_used'),
+    ]
+    profile_metric_to_filename = [
+        ('profile_size_bytes', 'total_bytes'),
+        ('profile_used_bytes', 'used_bytes'),
     ]
-    errors_by_device = collections.defaultdict(dict)
-    for mountpoint in get_btrfs_mount_points():
-        for device, error_type, error_count in get_btrfs_errors(mountpoint):
-            contents.append(
-                '%s{mountpoint="%s",device="%s",type="%s"} %d' %
-                (metric, mountpoint, device, error_type, error_count))
+    for type_ in ('data', 'metadata', 'system'):
+        with alloc.subdirectory(type_) as type_dir:
+            labels = [('fs', fs), ('type', type_)]
+            for m, f in metric_to_filename:
+                metrics['%s_%s' % (prefix, m)].append(
+                    (labels, type_dir.read_int(f)))
+            profiles = BTRFS_PROFILES.intersection(type_dir.listdir())
+            for profile in sorted(profiles):
+                profile_labels = labels + [('profile', profile)]
+                with type_dir.subdirectory(profile) as profile_dir:
+                    for m, f in profile_metric_to_filename:
+                        metrics['%s_%s' % (prefix, m)].append(
+                            (profile_labels, profile_dir.read_int(f)))
 
-    if len(contents) > 2:
-        # return metrics if there are actual btrfs filesystems found
-        # (i.e. `contents` contains more than just TYPE and HELP).
-        return contents
+def read_btrfs_sysfs(sysfs_root="/sys/fs/btrfs"):
+    """Read the allocation and device information of all btrfs filesystems.
 
-def btrfs_allocation_metrics():
-    """Collect btrfs allocation metrics.
+    Args:
+        sysfs_root: (string) path to the btrfs sysfs directory.
 
     Returns:
-        a list of strings to be exposed as Prometheus metrics.
+        a dict of metric name to list of (labels, value) tuples, where labels
+        is a list of (name, value) tuples.
     """
-    prefix = 'node_btrfs_allocation'
-    metric_to_filename = {
-        'size_bytes': 'total_bytes',
-        'used_bytes': 'bytes_used',
-        'reserved_bytes': 'bytes_reserved',
-        'pinned_bytes': 'bytes_pinned',
-        'disk_size_bytes': 'disk_total',
-        'disk_used_bytes': 'disk_used',
+    devinfo_attributes = ('in_fs_metadata', 'missing', 'replace_target',
+                          'writeable')
+
+    metrics = collections.defaultdict(list)
+    if not os.path.isdir(sysfs_root):
+        return metrics
+
+    with SysfsDirectory(sysfs_root) as root:
+        for fs in sorted(root.listdir()):
+            if fs == 'features':
+                continue
+            with root.subdirectory(fs) as fs_dir:
+                entries = set(fs_dir.listdir())
+
+                if 'allocation' in entries:
+                    with fs_dir.subdirectory('allocation') as alloc:
+                        read_btrfs_allocation(alloc, fs, metrics)
+
+                # devices/<name> links to the block device, its size is in
+                # 512 byte sectors.
+                if 'devices' in entries:
+                    with fs_dir.subdirectory('devices') as devices:
+                        for device in sorted(devices.listdir()):
+                            with devices.subdirectory(device) as device_dir:
+                                sectors = device_dir.read_int('size')
+                            if sectors is not None:
+                                labels = [('fs', fs), ('device', device)]
+                                metrics['node_btrfs_device_size_bytes'].append(
+                                    (labels, sectors * 512))
+
+                if 'devinfo' in entries:
+                    with fs_dir.subdirectory('devinfo') as devinfo:
+                        for devid in sorted(devinfo.listdir(), key=int):
+                            labels = [('fs', fs), ('devid', devid)]
+                            with devinfo.subdirectory(devid) as devid_dir:
+                                for attribute in devinfo_attributes:
+                                    value = devid_dir.read_int(attribute)
+                                    metrics['node_btrfs_device_%s' %
+                                            attribute].append((labels, value))
+    return metrics
+
+def btrfs_allocation_metrics(metrics, sysfs_root="/sys/fs/btrfs"):
+    """Collect btrfs allocation and device metrics.
+
+    Args:
+        metrics: (exposition.Exposition) metrics to add to.
+        sysfs_root: (string) path to the btrfs sysfs directory.
+    """
+    help_texts = {
+        'node_btrfs_allocation_size_bytes':
+            'btrfs allocation data (total_bytes)',
+        'node_btrfs_allocation_used_bytes':
+            'btrfs allocation data (bytes_used)',
+        'node_btrfs_allocation_reserved_bytes':
+            'btrfs allocation data (bytes_reserved)',
+        'node_btrfs_allocation_pinned_bytes':
+            'btrfs allocation data (bytes_pinned)',
+        'node_btrfs_allocation_disk_size_bytes':
+            'btrfs allocation data (disk_total)',
+        'node_btrfs_allocation_disk_used_bytes':
+            'btrfs allocation data (disk_used)',
+        'node_btrfs_allocation_profile_size_bytes':
+            'btrfs allocation data of a block group profile (total_bytes)',
+        'node_btrfs_allocation_profile_used_bytes':
+            'btrfs allocation data of a block group profile (used_bytes)',
+        'node_btrfs_device_size_bytes': 'size of a btrfs device',
+        'node_btrfs_device_in_fs_metadata':
+            'btrfs device information (in_fs_metadata)',
+        'node_btrfs_device_missing': 'btrfs device information (missing)',
+        'node_btrfs_device_replace_target':
+            'btrfs device information (replace_target)',
+        'node_btrfs_device_writeable': 'btrfs device information (writeable)',
     }
-    contents = []
-    for m, f in metric_to_filename.items():
-        contents += [
-            "# TYPE %s_%s gauge" % (prefix, m),
-            "# HELP %s_%s btrfs allocation data (%s)" % (prefix, m, f),
-        ]
-
-    for alloc in glob.glob("/sys/fs/btrfs/*/allocation"):
-        fs = alloc.split('/')[4]
-        for type_ in ('data', 'metadata', 'system'):
-            for m, f in metric_to_filename.items():
-                filename = os.path.join(alloc, type_, f)
-                with open(filename) as f:
-                    value = int(f.read().strip())
-                    contents.append('%s_%s{fs="%s",type="%s"} %d' % (
-                        prefix, m, fs, type_, value))
-    if len(contents) > 2*len(metric_to_filename):
-        return contents
 
-if __name__ == "__main__":
-    contents = ((btrfs_error_metrics() or []) +
-                (btrfs_allocation_metrics() or []))
+    for metric, samples in read_btrfs_sysfs(sysfs_root).items():
+        for labels, value in samples:
+            if value is not None:
+                metrics.add(metric, value, labels, help=help_texts[metric])
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Expose btrfs device errors and allocation.')
+    parser.add_argument('--sysfs-root', default='/sys/fs/btrfs',
+                        help='btrfs directory in sysfs')
+    parser.add_argument('--mounts', default='/proc/mounts',
+                        help='list of mounted filesystems')
+    instrumentation.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+@instrumentation.instrumented("btrfs_stats")
+def collect(args):
+    """Collect all btrfs metrics.
 
-    print("\n".join(contents))
+    Returns:
+        exposition.Exposition of the metrics.
+    """
+    metrics = exposition.Exposition()
+    with instrumentation.phase("errors"):
+        btrfs_error_metrics(metrics, args.mounts)
+    with instrumentation.phase("allocation"):
+        btrfs_allocation_metrics(metrics, args.sysfs_root)
+    return metrics
+
+if __name__ == "__main__":
+    collect(parse_args()).write(sys.stdout)
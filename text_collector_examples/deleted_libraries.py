@@ -7,63 +7,488 @@ The aim is to discover processes that are still using libraries that have since
 been updated, perhaps due security vulnerabilities.
 """
 
+import argparse
+import collections
 import errno
-import glob
+import functools
+import json
 import os
 import sys
+import time
 
+import exposition
+import instrumentation
+import procwalk
+import textfile_writer
 
-def main():
-    processes_linking_deleted_libraries = {}
+DELETED_MARKER = b' (deleted)\n'
+LIBRARY_MARKER = b'/lib/'
+FILE_MARKER = b' /'
+# Shared memory shows up as deleted files, but is not backed by one
+SHARED_MEMORY_PREFIXES = (b'/memfd:', b'/SYSV', b'/dev/zero')
+OTHER = 'other'
+READ_SIZE = 1 << 20
+DEFAULT_CACHE_MAX_AGE = 3600
+VMLIB = b'\nVmLib:'
 
-    for path in glob.glob('/proc/*/maps'):
-        try:
-            with open(path, 'rb') as file:
-                for line in file:
-                    part = line.decode().strip().split()
-
-                    if len(part) == 7:
-                        library = part[5]
-                        comment = part[6]
-
-                        if '/lib/' in library and '(deleted)' in comment:
-                            if path not in processes_linking_deleted_libraries:
-                                processes_linking_deleted_libraries[path] = {}
-
-                                if library in processes_linking_deleted_libraries[path]:
-                                    processes_linking_deleted_libraries[path][library] += 1
-                                else:
-                                    processes_linking_deleted_libraries[path][library] = 1
-        except EnvironmentError as e:
-            # Ignore non-existent files, since the files may have changed since
-            # we globbed.
-            if e.errno != errno.ENOENT:
-                sys.exit('Failed to open file: {0}'.format(path))
-
-    num_processes_per_library = {}
-
-    for process, library_count in processes_linking_deleted_libraries.items():
-        libraries_seen = set()
-        for library, count in library_count.items():
-            if library in libraries_seen:
+
+def deleted_mappings(data, libraries, marker=LIBRARY_MARKER):
+    """Count the deleted libraries mapped in a chunk of a maps file.
+
+    Lines are only located around the ' (deleted)' marker, so the bulk of the
+    mappings is never decoded or split.
+
+    Args:
+        data: (bytes) complete lines of a /proc/PID/maps file.
+        libraries: (dict) library path to mapping count, updated in place.
+        marker: (bytes) only count the lines containing it, LIBRARY_MARKER for
+            libraries or FILE_MARKER for all files.
+    """
+    pos = data.find(DELETED_MARKER)
+    while pos != -1:
+        line_start = data.rfind(b'\n', 0, pos) + 1
+        line = data[line_start:pos]
+        if marker in line:
+            # address perms offset dev inode pathname
+            part = line.split(None, 5)
+            if len(part) == 6 and not part[5].startswith(SHARED_MEMORY_PREFIXES):
+                library = part[5].decode(errors='replace')
+                libraries[library] = libraries.get(library, 0) + 1
+        pos = data.find(DELETED_MARKER, pos + len(DELETED_MARKER))
+
+
+def library_mappings(data, mapped, marker=LIBRARY_MARKER):
+    """Count the mappings of each library which is not deleted in a chunk of a maps file.
+
+    Args:
+        data: (bytes) complete lines of a /proc/PID/maps file.
+        mapped: (dict) library path to mapping count, updated in place.
+        marker: (bytes) only count the lines containing it.
+    """
+    pos = data.find(marker)
+    while pos != -1:
+        line_start = data.rfind(b'\n', 0, pos) + 1
+        line_end = data.find(b'\n', pos)
+        if data[line_end - len(DELETED_MARKER) + 1:line_end] != DELETED_MARKER[:-1]:
+            part = data[line_start:line_end].split(None, 5)
+            if len(part) == 6 and not part[5].startswith(SHARED_MEMORY_PREFIXES):
+                library = part[5].decode(errors='replace')
+                mapped[library] = mapped.get(library, 0) + 1
+        pos = data.find(marker, line_end)
+
+
+def scan_maps(path, mapped=None, marker=LIBRARY_MARKER, dir_fd=None):
+    """Scan a /proc/PID/maps file for deleted libraries.
+
+    Args:
+        path: (str) path of the maps file.
+        mapped: (dict) if given, the mapping count of each library which is not
+            deleted is added to it.
+        marker: (bytes) only consider the lines containing it.
+        dir_fd: (int) directory which path is relative to.
+
+    Returns:
+        (dict) library path to number of mappings. Empty for kernel threads and
+        processes which have exited meanwhile.
+    """
+    libraries = {}
+    try:
+        fd = os.open(path, os.O_RDONLY, dir_fd=dir_fd)
+    except OSError as e:
+        if e.errno in (errno.ENOENT, errno.ESRCH):
+            return libraries
+        raise
+
+    try:
+        tail = b''
+        while True:
+            chunk = os.read(fd, READ_SIZE)
+            if not chunk:
+                break
+            instrumentation.parsed(len(chunk))
+            # Only pass complete lines on, the rest is scanned with the next read
+            line_end = chunk.rfind(b'\n') + 1
+            if line_end == 0:
+                tail += chunk
                 continue
+            data = tail + chunk[:line_end] if tail else chunk[:line_end]
+            deleted_mappings(data, libraries, marker)
+            if mapped is not None:
+                library_mappings(data, mapped, marker)
+            tail = chunk[line_end:]
+    except OSError as e:
+        if e.errno not in (errno.ENOENT, errno.ESRCH):
+            raise
+    finally:
+        os.close(fd)
+    return libraries
+
+
+def process_identity(pid_fd):
+    """Identify a process by its start time and the size of its libraries.
+
+    Together with its process ID, the start time tells a process apart from
+    a later one reusing the ID. VmLib, the size of the executable mappings
+    besides the program, changes when the process maps or unmaps a library.
+    The virtual memory size changes with every heap or stack growth, so it
+    would send most busy processes to a rescan.
+
+    Args:
+        pid_fd: (int) /proc/PID directory.
 
-            libraries_seen.add(library)
-            if library in num_processes_per_library:
-                num_processes_per_library[library] += 1
+    Returns:
+        (list) [starttime from /proc/PID/stat, VmLib from /proc/PID/status],
+        VmLib is 0 for kernel threads.
+    """
+    stat = procwalk.read_bytes('stat', pid_fd)
+    # The command name may contain spaces and parentheses, skip past it
+    fields = stat[stat.rfind(b')') + 2:].split()
+    if len(fields) < 20:
+        raise procwalk.ProcessGone()
+    status = procwalk.read_bytes('status', pid_fd)
+    pos = status.find(VMLIB)
+    vmlib = int(status[pos + len(VMLIB):].split(None, 1)[0]) if pos != -1 else 0
+    return [int(fields[19]), vmlib]
+
+
+def library_identity(pid_fd, root_key, library, memo):
+    """Get [st_dev, st_ino] of a library as seen from the root of a process.
+
+    Results are shared between processes with the same root directory.
+
+    Returns:
+        (list) [st_dev, st_ino], None if the library does not exist.
+    """
+    key = (root_key, library)
+    if key not in memo:
+        try:
+            st = os.stat('root' + library, dir_fd=pid_fd)
+            memo[key] = [st.st_dev, st.st_ino]
+        except OSError:
+            memo[key] = None
+    return memo[key]
+
+
+def root_key(pid_fd):
+    st = os.stat('root', dir_fd=pid_fd)
+    return (st.st_dev, st.st_ino)
+
+
+def scan_process(pid_fd, incremental=False, marker=LIBRARY_MARKER, memo=None):
+    """Scan the mappings of a process.
+
+    Args:
+        pid_fd: (int) /proc/PID directory.
+        incremental: (bool) also record the identity of the process and of its
+            mapped libraries, to revalidate the result without rescanning.
+        marker: (bytes) only consider the mappings containing it.
+        memo: (dict) library identities, shared between processes.
+
+    Returns:
+        (dict) with the 'deleted' libraries and their mapping counts, and when
+        incremental the process 'identity', the time it was 'scanned' and the
+        'mapped' libraries with [st_dev, st_ino, count].
+    """
+    if not incremental:
+        return {'deleted': scan_maps('maps', marker=marker, dir_fd=pid_fd)}
+
+    scanned = int(time.time())
+    identity = process_identity(pid_fd)
+    mapped = {}
+    deleted = scan_maps('maps', mapped, marker, pid_fd)
+
+    if mapped:
+        memo = {} if memo is None else memo
+        key = root_key(pid_fd)
+        for library, count in list(mapped.items()):
+            file_identity = library_identity(pid_fd, key, library, memo)
+            if file_identity is None:
+                # Deleted since the maps were read
+                del mapped[library]
+                deleted[library] = deleted.get(library, 0) + count
             else:
-                num_processes_per_library[library] = 1
+                mapped[library] = file_identity + [count]
+    return {'identity': identity, 'scanned': scanned, 'deleted': deleted,
+            'mapped': mapped}
+
+
+def revalidate(pid_fd, scan, memo):
+    """Move libraries of a previous scan which have been deleted since to 'deleted'."""
+    mapped = scan['mapped']
+    if not mapped:
+        return
+    key = root_key(pid_fd)
+    for library, (st_dev, st_ino, count) in list(mapped.items()):
+        if library_identity(pid_fd, key, library, memo) != [st_dev, st_ino]:
+            del mapped[library]
+            scan['deleted'][library] = scan['deleted'].get(library, 0) + count
+
+
+def extract_maps(pid_fd, pid, results, incremental=False, marker=LIBRARY_MARKER, memo=None,
+                 max_age=DEFAULT_CACHE_MAX_AGE):
+    """procwalk extractor scanning the mappings of a process, see scan_process().
+
+    When incremental, the scan of a previous walk is reused if the process
+    has the same identity and the scan is younger than max_age seconds, only
+    its libraries are checked for deletion. Files mapped since which are not
+    executable, like data files with --all-files, are only seen once the scan
+    is max_age old.
+    """
+    previous = results.get('maps')
+    if incremental and previous is not None:
+        age = time.time() - previous.get('scanned', 0)
+        if age < max_age and process_identity(pid_fd) == previous['identity']:
+            revalidate(pid_fd, previous, {} if memo is None else memo)
+            return previous
+    return scan_process(pid_fd, incremental, marker, memo)
+
+
+def extract_cgroup(pid_fd, pid, results):
+    """procwalk extractor getting the cgroup of processes mapping deleted files."""
+    if results['maps'] and results['maps']['deleted']:
+        return process_cgroup(pid_fd)
+    return None
+
+
+def maps_extractors(incremental=False, all_files=False, by_cgroup=False,
+                    max_age=DEFAULT_CACHE_MAX_AGE):
+    """Get the procwalk extractors finding the deleted libraries.
+
+    The mappings are scanned as 'maps', see scan_process(). With by_cgroup,
+    'cgroup' is the cgroup of the processes mapping deleted files.
+    """
+    marker = FILE_MARKER if all_files else LIBRARY_MARKER
+    extractors = [('maps', functools.partial(
+        extract_maps, incremental=incremental, marker=marker, memo={},
+        max_age=max_age))]
+    if by_cgroup:
+        extractors.append(('cgroup', extract_cgroup))
+    return extractors
+
+
+def deleted_by_process(processes):
+    """Get process ID to {library path: number of mappings} from a walk."""
+    return {pid: results['maps']['deleted']
+            for pid, results in processes.items()
+            if results['maps'] and results['maps']['deleted']}
+
+
+def process_cgroup(pid_fd):
+    """Get the cgroup of a process from /proc/PID/cgroup.
+
+    This is the cgroup v2 path, else the path in the systemd named hierarchy of
+    cgroup v1, else the path in the first hierarchy.
+
+    Args:
+        pid_fd: (int) /proc/PID directory.
+
+    Returns:
+        (str) cgroup path.
+    """
+    lines = procwalk.read_bytes('cgroup', pid_fd).decode(errors='replace').splitlines()
+
+    hierarchies = {}
+    for line in lines:
+        # hierarchy-ID:controller-list:cgroup-path
+        part = line.split(':', 2)
+        if len(part) == 3:
+            hierarchies.setdefault(part[1], part[2])
+    for controllers in ('', 'name=systemd'):
+        if controllers in hierarchies:
+            return hierarchies[controllers]
+    return next(iter(hierarchies.values()), '/')
+
+
+def top(counts, n):
+    """Split counts into the n largest and the remaining keys.
+
+    Returns:
+        (list, set) (key, count) of the n largest counts, keys of the others.
+        All counts are returned if n is 0.
+    """
+    if not n or len(counts) <= n:
+        return counts.most_common(), set()
+    largest = counts.most_common(n)
+    kept = {key for key, _ in largest}
+    return largest, set(counts) - kept
+
+
+def count_by_library(processes, n):
+    """Count the processes linking each deleted library.
+
+    Returns:
+        (list) (library, process count) pairs. With n, the n libraries linked by
+        the most processes, and OTHER counting the processes linking any of the
+        other libraries.
+    """
+    counts = collections.Counter(
+        library for libraries in processes.values() for library in libraries)
+    largest, others = top(counts, n)
+    if others:
+        largest.append(
+            (OTHER, sum(1 for libraries in processes.values() if not others.isdisjoint(libraries))))
+    return largest
+
+
+def count_by_cgroup(processes, cgroups, n):
+    """Count the processes and mappings of deleted files in each cgroup.
+
+    Args:
+        processes: (dict) process ID to {library path: number of mappings}.
+        cgroups: (dict) process ID to cgroup path.
+        n: (int) number of cgroups to keep.
+
+    Returns:
+        (list) (cgroup, process count, mapping count). With n, the n cgroups with
+        the most processes, and OTHER summing up the other cgroups.
+    """
+    process_counts = collections.Counter()
+    mapping_counts = collections.Counter()
+    for pid, libraries in processes.items():
+        cgroup = cgroups[pid]
+        process_counts[cgroup] += 1
+        mapping_counts[cgroup] += sum(libraries.values())
+
+    largest, others = top(process_counts, n)
+    result = [(cgroup, count, mapping_counts[cgroup]) for cgroup, count in largest]
+    if others:
+        result.append((OTHER, sum(process_counts[cgroup] for cgroup in others),
+                       sum(mapping_counts[cgroup] for cgroup in others)))
+    return result
+
+
+def load_cache(path, all_files=False):
+    """Load the scans of the previous run.
+
+    Returns:
+        (dict) process ID to scan, empty if there are none or they were made
+        for another all_files mode.
+    """
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        if cache['all_files'] != all_files:
+            return {}
+        return cache['processes']
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+
+
+def save_cache(path, processes, all_files=False):
+    """Atomically replace the scan cache.
+
+    The scans, process ID to scan, are stored under 'processes' next to the
+    all_files mode they were made in.
+    """
+    cache = {'all_files': all_files, 'processes': processes}
+    try:
+        textfile_writer.write_atomic(path, json.dumps(cache))
+    except OSError as e:
+        print('Failed to write cache {0}: {1}'.format(path, e), file=sys.stderr)
+
+
+def add_arguments(parser):
+    parser.add_argument('--proc-root', default='/proc',
+                        help='mount point of the proc filesystem')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes scanning /proc/PID/maps')
+    parser.add_argument('--cache-file',
+                        help='keep the scan results in this file, to only scan new '
+                        'processes and check the libraries of known ones for deletion')
+    parser.add_argument('--cache-max-age', type=int, default=DEFAULT_CACHE_MAX_AGE,
+                        help='rescan processes whose cached scan is older than this '
+                        'many seconds (default: %(default)s)')
+    parser.add_argument('--all-files', action='store_true',
+                        help='count all deleted files that are mapped, not only libraries')
+    parser.add_argument('--by-cgroup', action='store_true',
+                        help='aggregate by the cgroup of the processes instead of by library')
+    parser.add_argument('--top', type=int, default=0,
+                        help='only export the N libraries or cgroups with the most '
+                        'processes, and sum up the rest as "other"')
+    instrumentation.add_arguments(parser)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+class DeletedLibrariesPlugin(procwalk.Plugin):
+    """Deleted library metrics in a procwalk walk, see procwalk.collect_plugins()."""
+
+    def __init__(self, args):
+        self.args = args
+        self.cache = None
+        if args.cache_file:
+            self.cache = load_cache(args.cache_file, args.all_files)
+
+    def extractors(self):
+        return maps_extractors(self.cache is not None, self.args.all_files,
+                               self.args.by_cgroup, self.args.cache_max_age)
+
+    def previous(self):
+        if self.cache is None:
+            return None
+        return {pid: {'maps': scan} for pid, scan in self.cache.items()}
+
+    def metrics(self, processes):
+        if self.cache is not None:
+            cache = {pid: results['maps'] for pid, results in processes.items()
+                     if results['maps'] is not None}
+            save_cache(self.args.cache_file, cache, self.args.all_files)
+        return deleted_library_metrics(self.args, processes)
+
+
+def deleted_library_metrics(args, processes):
+    """Get the deleted library metrics from the results of a walk.
+
+    Returns:
+        exposition.Exposition of the metrics.
+    """
+    processes_linking_deleted_libraries = deleted_by_process(processes)
+
+    metrics = exposition.Exposition()
+    if args.by_cgroup:
+        process_metric = 'node_cgroup_processes_linking_deleted_files'
+        mapping_metric = 'node_cgroup_deleted_file_mappings'
+        metrics.family(process_metric,
+                       'Count of processes in the cgroup that map a deleted file')
+        metrics.family(mapping_metric,
+                       'Count of mappings of deleted files by processes in the cgroup')
+        cgroups = {pid: processes[pid]['cgroup'] for pid in processes_linking_deleted_libraries}
+        for cgroup, process_count, mappings in count_by_cgroup(
+                processes_linking_deleted_libraries, cgroups, args.top):
+            metrics.add(process_metric, process_count, {'cgroup': cgroup})
+            metrics.add(mapping_metric, mappings, {'cgroup': cgroup})
+        return metrics
 
     metric_name = 'node_processes_linking_deleted_libraries'
     description = 'Count of running processes that link a deleted library'
-    print('# HELP {0} {1}'.format(metric_name, description))
-    print('# TYPE {0} gauge'.format(metric_name))
+    metrics.family(metric_name, description)
 
-    for library, count in num_processes_per_library.items():
+    for library, count in count_by_library(processes_linking_deleted_libraries, args.top):
         dir_path, basename = os.path.split(library)
-        basename = basename.replace('"', '\\"')
-        dir_path = dir_path.replace('"', '\\"')
-        print('{0}{{library_path="{1}", library_name="{2}"}} {3}'.format(metric_name, dir_path, basename, count))
+        metrics.add(metric_name, count, [('library_path', dir_path), ('library_name', basename)])
+    return metrics
+
+
+@instrumentation.instrumented('deleted_libraries')
+def collect(args):
+    """Collect the deleted library metrics.
+
+    Returns:
+        exposition.Exposition of the metrics.
+    """
+    try:
+        return procwalk.collect_plugins(
+            [DeletedLibrariesPlugin(args)], args.proc_root, workers=args.workers)
+    except EnvironmentError as e:
+        sys.exit('Failed to open file: {0}'.format(e.filename))
+
+
+def main():
+    collect(parse_args()).write(sys.stdout)
 
 
 if __name__ == "__main__":
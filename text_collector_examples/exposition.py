@@ -0,0 +1,157 @@
+"""
+Encoder of the Prometheus text exposition format, shared by the text
+collectors.
+
+Samples are grouped by metric family, whatever the order they are added in,
+and written with a single write call:
+
+    metrics = exposition.Exposition()
+    metrics.add('node_foo_bytes', 1024, {'device': 'sda'}, help='Size of foo.')
+    metrics.write(sys.stdout)
+"""
+
+import collections
+import math
+import re
+
+_label_value_special = re.compile(r'[\\"\n]').search
+_backslash_or_newline = re.compile(r'[\\\n]').search
+
+
+def escape_label_value(value):
+    """Escape a label value: backslash, double quote and line feed."""
+    if value.__class__ is not str:
+        value = str(value)
+    if _label_value_special(value) is not None:
+        value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return value
+
+
+def escape_help(text):
+    """Escape a HELP text: backslash and line feed."""
+    if '\\' in text or '\n' in text:
+        text = text.replace('\\', '\\\\').replace('\n', '\\n')
+    return text
+
+
+def format_labels(labels):
+    """Format a label set.
+
+    Args:
+        labels: dict or sequence of (name, value) pairs.
+
+    Returns:
+        (str) the label set with braces, empty if there are no labels.
+    """
+    if not labels:
+        return ''
+    if isinstance(labels, dict):
+        labels = labels.items()
+    elif not isinstance(labels, (list, tuple)):
+        labels = list(labels)
+    formatted = '{' + ','.join([name + '="' + str(value) + '"' for name, value in labels]) + '}'
+    # Label names cannot hold any of the escaped characters, so the whole
+    # label set tells whether any value needs escaping.
+    if formatted.count('"') == 2 * len(labels) and _backslash_or_newline(formatted) is None:
+        return formatted
+    return '{' + ','.join([
+        name + '="' + escape_label_value(value) + '"' for name, value in labels]) + '}'
+
+
+def format_value(value):
+    """Format a sample value.
+
+    Integral values are printed without a fraction, other floats with the
+    shortest representation which reads back to the same float.
+
+    Args:
+        value: int, float, bool or a string holding a number.
+    """
+    cls = value.__class__
+    if cls is int:
+        return str(value)
+    if cls is not float:
+        if isinstance(value, int):
+            return str(int(value))
+        if isinstance(value, str):
+            try:
+                return str(int(value))
+            except ValueError:
+                pass
+        value = float(value)
+    if value.is_integer():
+        if -_max_exact_int < value < _max_exact_int:
+            return str(int(value))
+    elif value != value:
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+# Integral floats up to this magnitude are printed as integer.
+_max_exact_int = float(2 ** 53)
+
+
+class Exposition(object):
+    """Metrics in the text exposition format."""
+
+    def __init__(self):
+        # name to [HELP text, type, sample lines]
+        self._families = collections.OrderedDict()
+
+    def __len__(self):
+        return sum(len(family[2]) for family in self._families.values())
+
+    def family(self, name, help=None, type='gauge'):
+        """Declare a metric family, to set its HELP text and type.
+
+        Families without samples are written with HELP and TYPE only.
+        """
+        family = self._families.get(name)
+        if family is None:
+            self._families[name] = [help or name, type, []]
+        else:
+            if help is not None:
+                family[0] = help
+            family[1] = type
+
+    def add(self, name, value, labels=None, help=None, type='gauge'):
+        """Add a sample.
+
+        Args:
+            name: (str) metric name.
+            value: sample value, see format_value().
+            labels: dict or sequence of (name, value) pairs, or a label set
+                formatted by format_labels().
+            help: (str) HELP text, if the family is new.
+            type: (str) metric type, if the family is new.
+        """
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = [help or name, type, []]
+        if not isinstance(labels, str):
+            labels = format_labels(labels)
+        family[2].append(name + labels + ' ' + format_value(value))
+
+    def merge(self, other):
+        """Add all families and samples of another exposition."""
+        for name, (help, type, samples) in other._families.items():
+            family = self._families.get(name)
+            if family is None:
+                self._families[name] = [help, type, list(samples)]
+            else:
+                family[2].extend(samples)
+
+    def render(self):
+        lines = []
+        for name, (help, type, samples) in self._families.items():
+            lines.append('# HELP {0} {1}'.format(name, escape_help(help)))
+            lines.append('# TYPE {0} {1}'.format(name, type))
+            lines.extend(samples)
+        if not lines:
+            return ''
+        return '\n'.join(lines) + '\n'
+
+    def write(self, stream):
+        stream.write(self.render())
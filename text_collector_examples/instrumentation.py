@@ -0,0 +1,195 @@
+"""
+Self-instrumentation of the text collectors.
+
+A collector run exports where its time went, next to its metrics:
+
+    textfile_collector_phase_duration_seconds{collector,phase}
+    textfile_collector_subprocesses{collector}
+    textfile_collector_subprocess_duration_seconds{collector}
+    textfile_collector_parsed_bytes{collector}
+    textfile_collector_samples{collector}
+
+Subprocess durations are summed over all subprocesses, so they exceed the
+run time when subprocesses run concurrently. The samples are the ones of the
+collector, without these metrics.
+
+The collect() function of a collector is decorated, and the collector reports
+its phases, subprocesses and input:
+
+    @instrumentation.instrumented('btrfs_stats')
+    def collect(args):
+        with instrumentation.phase('allocation'):
+            ...
+        with instrumentation.command():
+            output = subprocess.check_output(...)
+        instrumentation.parsed(len(output))
+
+Outside of an instrumented run, these do nothing. With the --profile FILE
+option of add_arguments(), the run is profiled with cProfile: the statistics
+are dumped to FILE for pstats, and the functions taking the most cumulative
+time are printed to stderr. Only the calling thread is profiled, so profile
+with a single worker.
+"""
+
+import collections
+import contextlib
+import cProfile
+import functools
+import pstats
+import sys
+import threading
+import time
+
+import exposition
+
+# Samples holding durations, which differ from run to run
+TIMING_METRICS = ('textfile_collector_phase_duration_seconds',
+                  'textfile_collector_subprocess_duration_seconds')
+
+# The run in progress, if any
+_current = None
+
+
+class Run(object):
+    """Measurements of a collector run."""
+
+    def __init__(self, collector):
+        self.collector = collector
+        self.phases = collections.OrderedDict()
+        self.subprocesses = 0
+        self.subprocess_seconds = 0.0
+        self.parsed_bytes = 0
+        self._lock = threading.Lock()
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_subprocess(self, seconds):
+        with self._lock:
+            self.subprocesses += 1
+            self.subprocess_seconds += seconds
+
+    def add_parsed(self, nbytes):
+        with self._lock:
+            self.parsed_bytes += nbytes
+
+    def metrics(self, samples):
+        """Get the metrics of the run.
+
+        Args:
+            samples: (int) number of samples the collector emitted.
+
+        Returns:
+            exposition.Exposition of the metrics.
+        """
+        labels = exposition.format_labels([('collector', self.collector)])
+        metrics = exposition.Exposition()
+        metrics.family('textfile_collector_phase_duration_seconds',
+                       'Duration of a phase of the text collector run.')
+        for name, seconds in self.phases.items():
+            metrics.add('textfile_collector_phase_duration_seconds', seconds,
+                        [('collector', self.collector), ('phase', name)])
+        metrics.add('textfile_collector_subprocesses', self.subprocesses,
+                    labels,
+                    help='Number of subprocesses started by the text '
+                    'collector run.')
+        metrics.add('textfile_collector_subprocess_duration_seconds',
+                    self.subprocess_seconds, labels,
+                    help='Total duration of the subprocesses of the text '
+                    'collector run.')
+        metrics.add('textfile_collector_parsed_bytes', self.parsed_bytes,
+                    labels,
+                    help='Bytes of command output and files parsed by the '
+                    'text collector run.')
+        metrics.add('textfile_collector_samples', samples, labels,
+                    help='Number of samples emitted by the text collector '
+                    'run.')
+        return metrics
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time a phase of the run, added up if it is entered repeatedly."""
+    run = _current
+    if run is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        run.add_phase(name, time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def command():
+    """Count and time a subprocess, from its start until it is waited for."""
+    run = _current
+    if run is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        run.add_subprocess(time.perf_counter() - start)
+
+
+def parsed(nbytes):
+    """Count bytes of input handed to a parser."""
+    run = _current
+    if run is not None:
+        run.add_parsed(nbytes)
+
+
+def parsed_bytes():
+    """Get the bytes parsed so far in the run, 0 outside of a run."""
+    run = _current
+    return 0 if run is None else run.parsed_bytes
+
+
+def add_arguments(parser):
+    parser.add_argument('--profile', metavar='FILE',
+                        help='profile the run with cProfile and dump the '
+                        'statistics to FILE')
+
+
+def print_profile(profiler, stream=sys.stderr, limit=30):
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats('cumulative').print_stats(limit)
+
+
+def instrumented(collector):
+    """Decorate the collect(args) function of a collector.
+
+    The returned exposition.Exposition gets the metrics of the run added. A
+    run within a run, like a collector calling another one, is measured as
+    part of the outer run.
+    """
+    def decorate(collect):
+        @functools.wraps(collect)
+        def wrapper(args):
+            global _current
+            if _current is not None:
+                return collect(args)
+
+            profile = getattr(args, 'profile', None)
+            profiler = cProfile.Profile() if profile else None
+            run = _current = Run(collector)
+            try:
+                if profiler is not None:
+                    profiler.enable()
+                try:
+                    metrics = collect(args)
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+                        profiler.dump_stats(profile)
+                        print_profile(profiler)
+            finally:
+                _current = None
+            metrics.merge(run.metrics(len(metrics)))
+            return metrics
+        return wrapper
+    return decorate
@@ -1,11 +1,22 @@
 #!/usr/bin/env python3
 #
-# Description: Extract NTPd metrics from ntpq -np.
+# Description: Extract NTPd metrics with NTP control messages (mode 6),
+#              or from ntpq -np. Extract the same metrics from chronyd with
+#              its command protocol.
 # Author: Ben Kochie <superq@gmail.com>
 
+import argparse
+import collections
+import os
 import re
+import socket
+import struct
 import subprocess
 import sys
+import time
+
+import exposition
+import instrumentation
 
 # NTP peers status, with no DNS lookups.
 ntpq_cmd = ['ntpq', '-np']
@@ -50,26 +61,427 @@ status_types = {
 }
 
 
+# NTP control messages (mode 6), see RFC 1305 appendix B.
+# Header: li_vn_mode, response/error/more bits and opcode, sequence, status,
+# association ID, offset and count of the data.
+control_header = struct.Struct('!BBHHHHH')
+control_version = 2
+control_mode = 6
+control_response = 0x80
+control_error = 0x40
+control_more = 0x20
+control_op_readstat = 1
+control_op_readvar = 2
+
+peer_variables = b'srcadr,refid,stratum,hmode,delay,offset,jitter'
+system_variables = b'offset,sys_jitter,rootdisp,rootdelay'
+
+# Association modes (hmode)
+mode_broadcast = 5
+mode_bclient = 6
+
+# A peer as shown by ntpq -np, status is one of the values of status_types.
+Peer = collections.namedtuple(
+    'Peer', ['remote', 'refid', 'stratum', 'type', 'status', 'delay',
+             'offset', 'jitter'])
+
+
+class ControlError(Exception):
+    pass
+
+
+class ControlClient(object):
+    """NTP control message client."""
+
+    def __init__(self, host, port, timeout, retries=1):
+        family, socktype, proto, _, address = socket.getaddrinfo(
+            host, port, 0, socket.SOCK_DGRAM)[0]
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.connect(address)
+        self.timeout = timeout
+        self.retries = retries
+        self.sequence = 0
+
+    def close(self):
+        self.sock.close()
+
+    def _request(self, sequence, opcode, association, data):
+        packet = control_header.pack(
+            control_version << 3 | control_mode, opcode, sequence, 0,
+            association, 0, len(data)) + data
+        # Pad to a multiple of 32 bits
+        self.sock.send(packet + b'\0' * (-len(packet) % 4))
+
+    def query(self, requests):
+        """Send a batch of requests at once, and wait for all responses.
+
+        Args:
+            requests: list of (opcode, association ID, data) tuples.
+
+        Returns:
+            list of the response data of each request.
+        """
+        pending = {}
+        for opcode, association, data in requests:
+            self.sequence = self.sequence % 0xffff + 1
+            # fragments by offset, and the end of the data once known
+            pending[self.sequence] = (opcode, association, data, {}, [None])
+        sequences = list(pending)
+        responses = {}
+
+        for _ in range(self.retries + 1):
+            for sequence, (opcode, association, data, _, _) in pending.items():
+                self._request(sequence, opcode, association, data)
+            deadline = time.time() + self.timeout
+            while pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.sock.settimeout(remaining)
+                try:
+                    packet = self.sock.recv(4096)
+                except socket.timeout:
+                    break
+                instrumentation.parsed(len(packet))
+                self._receive(packet, pending, responses)
+            if not pending:
+                return [responses[sequence] for sequence in sequences]
+        raise ControlError('timeout waiting for %d of %d responses' % (
+            len(pending), len(sequences)))
+
+    def _receive(self, packet, pending, responses):
+        if len(packet) < control_header.size:
+            return
+        _, flags, sequence, status, _, offset, count = \
+            control_header.unpack_from(packet)
+        if not flags & control_response or sequence not in pending:
+            return
+        if flags & control_error:
+            raise ControlError('error response, code %d' % (status >> 8))
+        fragments, end = pending[sequence][3:]
+        start = control_header.size
+        fragments[offset] = packet[start:start + count]
+        if not flags & control_more:
+            end[0] = offset + count
+
+        # Complete once the fragments add up to the end of the data
+        if end[0] is None:
+            return
+        data = b''.join(fragments[o] for o in sorted(fragments))
+        if len(data) == end[0]:
+            responses[sequence] = data
+            del pending[sequence]
+
+
+# Parse the variable list of a read variables response.
+def parse_variables(data):
+    variables = {}
+    text = data.decode('ascii', 'replace')
+    for match in re.finditer(
+            r'\s*([^=,\s]+)(?:=("[^"]*"|[^,]*))?\s*(?:,|$)', text):
+        value = (match.group(2) or '').strip()
+        if value.startswith('"') and value.endswith('"'):
+            value = value[1:-1]
+        variables[match.group(1)] = value
+    return variables
+
+
+# Type of a peer, as in the t column of ntpq -p.
+def peer_type(srcadr, hmode):
+    if srcadr.startswith('127.127.'):
+        return 'l'
+    if hmode in (mode_broadcast, mode_bclient):
+        if (srcadr.lower().startswith('ff') or
+                re.match(r'2(2[4-9]|3\d)\.', srcadr)):
+            return 'm'
+        return 'b'
+    return 'u'
+
+
+# Get peers and system variables with NTP control messages.
+def collect_control(host, port, timeout):
+    client = ControlClient(host, port, timeout)
+    try:
+        status_data, system_data = client.query([
+            (control_op_readstat, 0, b''),
+            (control_op_readvar, 0, system_variables),
+        ])
+        # association ID and peer status word pairs
+        associations = [struct.unpack_from('!HH', status_data, offset)
+                        for offset in range(0, len(status_data) - 3, 4)]
+        responses = client.query([
+            (control_op_readvar, association, peer_variables)
+            for association, _ in associations
+        ])
+    finally:
+        client.close()
+
+    peers = []
+    for (_, status), data in zip(associations, responses):
+        variables = parse_variables(data)
+        refid = variables.get('refid', '')
+        if refid in ('LOCL', 'POOL'):
+            continue
+        # ntpq shows reference IDs which are not addresses in dots
+        if not re.match(r'^\d+\.\d+\.\d+\.\d+$', refid):
+            refid = '.%s.' % refid
+        srcadr = variables.get('srcadr', '')
+        peers.append(Peer(
+            remote=srcadr,
+            refid=refid,
+            stratum=variables.get('stratum', ''),
+            type=peer_type(srcadr, int(variables.get('hmode', 0))),
+            # The peer selection is bits 8-10 of the peer status word
+            status=(status >> 8) & 0x7,
+            delay=float(variables.get('delay', 0)),
+            offset=float(variables.get('offset', 0)),
+            jitter=float(variables.get('jitter', 0)),
+        ))
+
+    system = [(name, float(value))
+              for name, value in parse_variables(system_data).items()]
+    return peers, system
+
+
+# chronyd command protocol, see candm.h of chrony.
+chrony_socket = '/var/run/chrony/chronyd.sock'
+chrony_port = 323
+chrony_version = 6
+chrony_request_header = struct.Struct('!BBBBHHIII')
+chrony_reply_header = struct.Struct('!BBBBHHHHHHIII')
+chrony_pkt_type_request = 1
+chrony_pkt_type_reply = 2
+chrony_status_success = 0
+
+# Requests: command and length of the reply data, which the request has to
+# be padded to.
+chrony_n_sources = (14, 4)
+chrony_source_data = (15, 48)
+chrony_tracking = (33, 76)
+chrony_sourcestats = (34, 56)
+chrony_ntp_data = (57, 124)
+
+chrony_family_inet4 = 1
+chrony_family_inet6 = 2
+chrony_family_id = 3
+
+chrony_mode_ref = 2
+
+# Source states of chronyc sources, mapped to status_types: selected '*',
+# nonselectable '?', falseticker 'x', jittery '~', unselected '+',
+# selectable '-'.
+chrony_states = {0: 6, 1: 0, 2: 1, 3: 2, 4: 4, 5: 3}
+
+
+class ChronyClient(object):
+    """chronyd command protocol client, over its Unix socket or UDP."""
+
+    def __init__(self, path, host, port, timeout, retries=1):
+        self.local_path = None
+        if path is not None:
+            # chronyd replies to the address of the client socket, which has
+            # to be in the directory of the chronyd socket.
+            self.local_path = os.path.join(
+                os.path.dirname(path), 'ntpd_metrics.%d.sock' % os.getpid())
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            try:
+                if os.path.exists(self.local_path):
+                    os.unlink(self.local_path)
+                self.sock.bind(self.local_path)
+                os.chmod(self.local_path, 0o666)
+                self.sock.connect(path)
+            except socket.error:
+                self.close()
+                raise
+        else:
+            family, socktype, proto, _, address = socket.getaddrinfo(
+                host, port, 0, socket.SOCK_DGRAM)[0]
+            self.sock = socket.socket(family, socktype, proto)
+            self.sock.connect(address)
+        self.timeout = timeout
+        self.retries = retries
+        self.sequence = 0
+
+    def close(self):
+        self.sock.close()
+        if self.local_path is not None:
+            try:
+                os.unlink(self.local_path)
+            except OSError:
+                pass
+
+    def query(self, requests):
+        """Send a batch of requests at once, and wait for all replies.
+
+        Args:
+            requests: list of ((command, reply length), data) tuples.
+
+        Returns:
+            list of the reply data of each request, None for failed requests.
+        """
+        pending = {}
+        for (command, reply_length), data in requests:
+            self.sequence = (self.sequence + 1) & 0xffffffff
+            packet = chrony_request_header.pack(
+                chrony_version, chrony_pkt_type_request, 0, 0, command, 0,
+                self.sequence, 0, 0) + data
+            padding = chrony_reply_header.size + reply_length - len(packet)
+            pending[self.sequence] = packet + b'\0' * max(0, padding)
+        sequences = list(pending)
+        replies = {}
+
+        for _ in range(self.retries + 1):
+            for packet in pending.values():
+                self.sock.send(packet)
+            deadline = time.time() + self.timeout
+            while pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.sock.settimeout(remaining)
+                try:
+                    packet = self.sock.recv(4096)
+                except socket.timeout:
+                    break
+                instrumentation.parsed(len(packet))
+                if len(packet) < chrony_reply_header.size:
+                    continue
+                header = chrony_reply_header.unpack_from(packet)
+                version, pkt_type = header[0], header[1]
+                status, sequence = header[6], header[10]
+                if (pkt_type != chrony_pkt_type_reply or
+                        sequence not in pending):
+                    continue
+                if version != chrony_version:
+                    raise ControlError(
+                        'unsupported chronyd protocol version %d' % version)
+                del pending[sequence]
+                replies[sequence] = (
+                    packet[chrony_reply_header.size:]
+                    if status == chrony_status_success else None)
+            if not pending:
+                return [replies[sequence] for sequence in sequences]
+        raise ControlError('timeout waiting for %d of %d replies' % (
+            len(pending), len(sequences)))
+
+
+# Convert the floating point format of chronyd: a 7 bit exponent and a 25 bit
+# coefficient, both signed.
+def chrony_float(data, offset):
+    x = struct.unpack_from('!I', data, offset)[0]
+    exp = x >> 25
+    if exp >= 1 << 6:
+        exp -= 1 << 7
+    coef = x & ((1 << 25) - 1)
+    if coef >= 1 << 24:
+        coef -= 1 << 25
+    return coef * 2.0 ** (exp - 25)
+
+
+# Convert a reference ID to a string, as in ntpq.
+def chrony_refid(refid, stratum):
+    if stratum <= 1:
+        name = struct.pack('!I', refid).rstrip(b'\0')
+        return '.%s.' % name.decode('ascii', 'replace')
+    return socket.inet_ntoa(struct.pack('!I', refid))
+
+
+# Get the address of a source, and the address as request data.
+def chrony_address(data, offset):
+    address, family = struct.unpack_from('!16sH', data, offset)
+    raw = data[offset:offset + 20]
+    if family == chrony_family_inet4:
+        return socket.inet_ntop(socket.AF_INET, address[:4]), raw
+    if family == chrony_family_inet6:
+        return socket.inet_ntop(socket.AF_INET6, address), raw
+    if family == chrony_family_id:
+        return address[:4].rstrip(b'\0').decode('ascii', 'replace'), raw
+    return '', raw
+
+
+# Get peers and system variables from chronyd.
+def collect_chrony(path, host, port, timeout):
+    client = ChronyClient(path, host, port, timeout)
+    try:
+        n_sources, tracking = client.query([
+            (chrony_n_sources, b''),
+            (chrony_tracking, b''),
+        ])
+        if n_sources is None or tracking is None:
+            raise ControlError('chronyd refused the request')
+        n_sources = struct.unpack_from('!I', n_sources)[0]
+
+        requests = []
+        for index in range(n_sources):
+            index_data = struct.pack('!i', index)
+            requests += [(chrony_source_data, index_data),
+                         (chrony_sourcestats, index_data)]
+        replies = client.query(requests)
+        sources = [(replies[i], replies[i + 1])
+                   for i in range(0, len(replies), 2)
+                   if replies[i] is not None]
+
+        # The NTP details of sources are only available to privileged clients
+        # over the Unix socket.
+        ntp_data = [None] * len(sources)
+        ntp_sources = [
+            i for i, (source_data, _) in enumerate(sources)
+            if struct.unpack_from('!H', source_data, 26)[0] != chrony_mode_ref]
+        if path is not None and ntp_sources:
+            replies = client.query([(chrony_ntp_data, sources[i][0][:20])
+                                    for i in ntp_sources])
+            for i, reply in zip(ntp_sources, replies):
+                ntp_data[i] = reply
+    finally:
+        client.close()
+
+    peers = []
+    for (source_data, sourcestats), details in zip(sources, ntp_data):
+        remote, _ = chrony_address(source_data, 0)
+        _, stratum, state, mode = struct.unpack_from('!hHHH', source_data, 20)
+        refid = ''
+        delay = None
+        if details is not None:
+            refid = chrony_refid(
+                struct.unpack_from('!I', details, 56)[0], details[45])
+            delay = chrony_float(details, 76) * 1000
+        elif mode == chrony_mode_ref:
+            refid = '.%s.' % remote
+        peers.append(Peer(
+            remote=remote,
+            refid=refid,
+            stratum=str(stratum),
+            type='l' if mode == chrony_mode_ref else 'u',
+            status=chrony_states.get(state, 0),
+            delay=delay,
+            # latest_meas, the measured offset which chronyc sources shows in
+            # brackets, rather than orig_latest_meas adjusted for slewing
+            offset=chrony_float(source_data, 40) * 1000,
+            jitter=(chrony_float(sourcestats, 36) * 1000
+                    if sourcestats is not None else None),
+        ))
+
+    system = [
+        ('offset', chrony_float(tracking, 44) * 1000),
+        ('sys_jitter', chrony_float(tracking, 48) * 1000),
+        ('rootdisp', chrony_float(tracking, 68) * 1000),
+        ('rootdelay', chrony_float(tracking, 64) * 1000),
+    ]
+    return peers, system
+
+
 # Run the ntpq command.
 def get_output(command):
     try:
-        output = subprocess.check_output(command, stderr=subprocess.DEVNULL)
+        with instrumentation.command():
+            output = subprocess.check_output(
+                command, stderr=subprocess.DEVNULL)
     except subprocess.CalledProcessError as e:
         return None
+    instrumentation.parsed(len(output))
     return output.decode()
 
 
-# Print metrics in Prometheus format.
-def print_prometheus(metric, values):
-    print("# HELP ntpd_%s NTPd metric for %s" % (metric, metric))
-    print("# TYPE ntpd_%s gauge" % (metric))
-    for labels in values:
-        if labels is None:
-            print("ntpd_%s %f" % (metric, values[labels]))
-        else:
-            print("ntpd_%s{%s} %f" % (metric, labels, values[labels]))
-
-
 # Parse raw ntpq lines.
 def parse_line(line):
     if re.match('\s+remote\s+refid', line):
@@ -83,38 +495,136 @@ def parse_line(line):
     return re.match(metrics_re, line)
 
 
-# Main function
-def main(argv):
+# Get peers and system variables from ntpq.
+def collect_ntpq():
     ntpq = get_output(ntpq_cmd)
-    peer_status_metrics = {}
-    delay_metrics = {}
-    offset_metrics = {}
-    jitter_metrics = {}
+    if ntpq is None:
+        raise RuntimeError('%s failed' % ' '.join(ntpq_cmd))
+    peers = []
     for line in ntpq.split('\n'):
         metric_match = parse_line(line)
         if metric_match is None:
             continue
-        remote = metric_match.group('remote')
-        refid = metric_match.group('refid')
-        stratum = metric_match.group('stratum')
-        remote_type = remote_types[metric_match.group('type')]
-        common_labels = "remote=\"%s\",reference=\"%s\"" % (remote, refid)
-        peer_labels = "%s,stratum=\"%s\",type=\"%s\"" % (common_labels, stratum, remote_type)
-
-        peer_status_metrics[peer_labels] = float(status_types[metric_match.group('status')])
-        delay_metrics[common_labels] = float(metric_match.group('delay'))
-        offset_metrics[common_labels] = float(metric_match.group('offset'))
-        jitter_metrics[common_labels] = float(metric_match.group('jitter'))
- 
-    print_prometheus('peer_status', peer_status_metrics)
-    print_prometheus('delay_milliseconds', delay_metrics)
-    print_prometheus('offset_milliseconds', offset_metrics)
-    print_prometheus('jitter_milliseconds', jitter_metrics)
+        peers.append(Peer(
+            remote=metric_match.group('remote'),
+            refid=metric_match.group('refid'),
+            stratum=metric_match.group('stratum'),
+            type=metric_match.group('type'),
+            status=status_types[metric_match.group('status')],
+            delay=float(metric_match.group('delay')),
+            offset=float(metric_match.group('offset')),
+            jitter=float(metric_match.group('jitter')),
+        ))
 
     ntpq_rv = get_output(ntpq_rv_cmd)
+    if ntpq_rv is None:
+        raise RuntimeError('%s failed' % ' '.join(ntpq_rv_cmd))
+    system = []
     for metric in ntpq_rv.split(','):
         metric_name, metric_value = metric.strip().split('=')
-        print_prometheus(metric_name, {None: float(metric_value)})
+        system.append((metric_name, float(metric_value)))
+    return peers, system
+
+
+# Convert peers and system variables to metrics.
+def ntpd_metrics(peers, system):
+    metrics = exposition.Exposition()
+    for metric in ('peer_status', 'delay_milliseconds', 'offset_milliseconds',
+                   'jitter_milliseconds'):
+        metrics.family('ntpd_%s' % metric, 'NTPd metric for %s' % metric)
+
+    for peer in peers:
+        remote_type = remote_types.get(peer.type, 'unknown')
+        common_labels = [('remote', peer.remote), ('reference', peer.refid)]
+        peer_labels = common_labels + [
+            ('stratum', peer.stratum), ('type', remote_type)]
+
+        metrics.add('ntpd_peer_status', peer.status, peer_labels)
+        # Not every backend knows all values
+        if peer.delay is not None:
+            metrics.add('ntpd_delay_milliseconds', peer.delay, common_labels)
+        if peer.offset is not None:
+            metrics.add('ntpd_offset_milliseconds', peer.offset, common_labels)
+        if peer.jitter is not None:
+            metrics.add('ntpd_jitter_milliseconds', peer.jitter, common_labels)
+
+    for metric_name, metric_value in system:
+        metrics.add('ntpd_%s' % metric_name, metric_value,
+                    help='NTPd metric for %s' % metric_name)
+    return metrics
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Extract NTPd metrics.')
+    parser.add_argument('--backend',
+                        choices=['auto', 'control', 'ntpq', 'chrony'],
+                        default='auto',
+                        help='query ntpd with NTP control messages, run ntpq, '
+                        'query chronyd, or detect the daemon (default)')
+    parser.add_argument('--host', default='localhost',
+                        help='host running ntpd or chronyd')
+    parser.add_argument('--port', type=int, default=123,
+                        help='NTP port of ntpd')
+    parser.add_argument('--chrony-socket', default=chrony_socket,
+                        help='Unix socket of chronyd, used instead of UDP if '
+                        'it exists')
+    parser.add_argument('--chrony-port', type=int, default=chrony_port,
+                        help='command port of chronyd')
+    parser.add_argument('--timeout', type=float, default=1.0,
+                        help='seconds to wait for responses, before a retry')
+    instrumentation.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+# Query the NTP daemon with the selected backend.
+@instrumentation.instrumented('ntpd_metrics')
+def collect(args):
+    def chrony():
+        if os.path.exists(args.chrony_socket):
+            try:
+                return collect_chrony(
+                    args.chrony_socket, None, None, args.timeout)
+            except socket.error:
+                # No permission to create the client socket
+                pass
+        return collect_chrony(None, args.host, args.chrony_port, args.timeout)
+
+    backends = {
+        'control': [
+            lambda: collect_control(args.host, args.port, args.timeout)],
+        'ntpq': [collect_ntpq],
+        'chrony': [chrony],
+    }
+    # Without a chronyd socket, ntpd is more likely.
+    if os.path.exists(args.chrony_socket):
+        backends['auto'] = (backends['chrony'] + backends['control'] +
+                            backends['ntpq'])
+    else:
+        backends['auto'] = (backends['control'] + backends['chrony'] +
+                            backends['ntpq'])
+
+    collectors = backends[args.backend]
+    with instrumentation.phase('query'):
+        for i, collect_backend in enumerate(collectors):
+            try:
+                peers, system = collect_backend()
+                break
+            except (ControlError, socket.error, RuntimeError, OSError,
+                    ValueError, struct.error) as e:
+                if i == len(collectors) - 1:
+                    raise RuntimeError(
+                        'Failed to query the NTP daemon: %s' % e)
+    with instrumentation.phase('format'):
+        return ntpd_metrics(peers, system)
+
+
+# Main function
+def main(argv):
+    try:
+        metrics = collect(parse_args(argv))
+    except RuntimeError as e:
+        sys.exit(str(e))
+    metrics.write(sys.stdout)
 
 
 # Go go go!
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Walk the process table once for several collectors.
+
+The process directories of the proc filesystem are listed once, and every
+process directory is opened once. Its directory fd is handed to extractors,
+functions reading what a collector needs from the process relative to that
+fd:
+
+    def extract_cmdline(pid_fd, pid, results):
+        return procwalk.read_bytes('cmdline', pid_fd)
+
+    processes = procwalk.walk([('cmdline', extract_cmdline)])
+
+An extractor is called with the directory fd, the process ID as str and the
+results of the process so far, which hold the results of the extractors
+before it and of a previous walk. Its return value is stored under its name.
+A process which exits during the walk is left out of the results. An
+extractor denied access to a process, like to the maps of processes of other
+users when unprivileged, gets None as its result for that process.
+
+Collectors take part in a walk with a plugin, see Plugin. Run as a script,
+the metrics of deleted_libraries.py and inotify-instances are collected in a
+single walk:
+
+    ./procwalk.py [--workers N] [deleted_libraries.py options]
+"""
+
+import argparse
+import functools
+import importlib.machinery
+import importlib.util
+import multiprocessing
+import os
+import sys
+
+import exposition
+import instrumentation
+
+# Most files of a process fit into a single read
+READ_SIZE = 1 << 16
+
+
+class ProcessGone(Exception):
+    """The process exited while it was read."""
+
+
+def list_pids(proc_root='/proc'):
+    """List the process directories of the proc filesystem."""
+    with os.scandir(proc_root) as it:
+        return [entry.name for entry in it if entry.name.isdigit()]
+
+
+def open_dir(name, dir_fd=None):
+    return os.open(name, os.O_RDONLY | os.O_DIRECTORY, dir_fd=dir_fd)
+
+
+def read_bytes(name, dir_fd=None):
+    fd = os.open(name, os.O_RDONLY, dir_fd=dir_fd)
+    try:
+        data = os.read(fd, READ_SIZE)
+        if len(data) < READ_SIZE:
+            instrumentation.parsed(len(data))
+            return data
+        chunks = [data]
+        while data:
+            data = os.read(fd, READ_SIZE)
+            chunks.append(data)
+        data = b''.join(chunks)
+        instrumentation.parsed(len(data))
+        return data
+    finally:
+        os.close(fd)
+
+
+def walk_process(extractors, proc_root, item):
+    """Run the extractors on a process.
+
+    Args:
+        extractors: list of (name, extractor) pairs.
+        proc_root: (str) mount point of the proc filesystem.
+        item: (pid, results) with the results of a previous walk.
+
+    Returns:
+        (dict) name to result of each extractor, None for the extractors
+        denied access to the process, or None if the process has exited.
+    """
+    pid, results = item
+    try:
+        pid_fd = open_dir(os.path.join(proc_root, pid))
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    try:
+        for name, extract in extractors:
+            try:
+                results[name] = extract(pid_fd, pid, results)
+            except PermissionError:
+                results[name] = None
+    except (ProcessGone, FileNotFoundError, ProcessLookupError):
+        return None
+    except OSError as e:
+        # Name the file of the process, not the one relative to its directory
+        if isinstance(e.filename, str) and not os.path.isabs(e.filename):
+            e.filename = os.path.join(proc_root, pid, e.filename)
+        raise
+    finally:
+        os.close(pid_fd)
+    return results
+
+
+def walk_process_counted(extractors, proc_root, item):
+    """walk_process() in a worker, also returning the bytes it parsed."""
+    before = instrumentation.parsed_bytes()
+    results = walk_process(extractors, proc_root, item)
+    return results, instrumentation.parsed_bytes() - before
+
+
+def walk(extractors, proc_root='/proc', workers=1, previous=None):
+    """Walk all processes once, running the extractors on each.
+
+    Args:
+        extractors: list of (name, extractor) pairs, run in this order. With
+            workers, they must be picklable, like module level functions.
+        proc_root: (str) mount point of the proc filesystem.
+        workers: (int) number of processes walking the process table.
+        previous: (dict) process ID to the results of a previous walk, which
+            the extractors find in the results of the process.
+
+    Returns:
+        (dict) process ID to {extractor name: result}.
+    """
+    previous = previous or {}
+    items = [(pid, dict(previous.get(pid, ())))
+             for pid in list_pids(proc_root)]
+    if workers > 1 and len(items) > 1:
+        walk_pid = functools.partial(
+            walk_process_counted, extractors, proc_root)
+        chunksize = max(1, len(items) // (workers * 8))
+        with multiprocessing.Pool(workers) as pool:
+            counted = pool.map(walk_pid, items, chunksize=chunksize)
+        results = [result for result, _ in counted]
+        instrumentation.parsed(sum(nbytes for _, nbytes in counted))
+    else:
+        results = map(
+            functools.partial(walk_process, extractors, proc_root), items)
+    return {pid: result for (pid, _), result in zip(items, results)
+            if result is not None}
+
+
+class Plugin(object):
+    """A collector reading the processes in a walk."""
+
+    def extractors(self):
+        """Get the (name, extractor) pairs of the collector.
+
+        The names must differ from the ones of the other plugins in a walk.
+        """
+        return []
+
+    def previous(self):
+        """Get the results of a previous walk, process ID to {name: result}."""
+        return None
+
+    def metrics(self, processes):
+        """Get the metrics of the collector from the results of a walk.
+
+        Returns:
+            exposition.Exposition of the metrics.
+        """
+        return exposition.Exposition()
+
+
+def collect_plugins(plugins, proc_root='/proc', workers=1):
+    """Walk the processes once for several plugins.
+
+    Returns:
+        exposition.Exposition of the metrics of all plugins.
+    """
+    extractors = []
+    previous = {}
+    for plugin in plugins:
+        extractors.extend(plugin.extractors())
+        for pid, results in (plugin.previous() or {}).items():
+            previous.setdefault(pid, {}).update(results)
+    names = [name for name, _ in extractors]
+    if len(set(names)) != len(names):
+        raise ValueError(
+            'extractor names of the plugins overlap: {0}'.format(names))
+
+    with instrumentation.phase('walk'):
+        processes = walk(extractors, proc_root, workers, previous)
+    metrics = exposition.Exposition()
+    with instrumentation.phase('metrics'):
+        for plugin in plugins:
+            metrics.merge(plugin.metrics(processes))
+    return metrics
+
+
+def load_inotify_instances():
+    """Import the inotify-instances script as the inotify_instances module."""
+    name = 'inotify_instances'
+    if name not in sys.modules:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'inotify-instances')
+        loader = importlib.machinery.SourceFileLoader(name, path)
+        spec = importlib.util.spec_from_loader(name, loader)
+        module = importlib.util.module_from_spec(spec)
+        # Worker processes look the module up to unpickle the results
+        sys.modules[name] = module
+        loader.exec_module(module)
+    return sys.modules[name]
+
+
+def parse_args(argv=None):
+    import deleted_libraries
+
+    parser = argparse.ArgumentParser(
+        description='Collect the metrics of deleted_libraries.py and '
+        'inotify-instances in a single walk of the process table.')
+    deleted_libraries.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+@instrumentation.instrumented('procwalk')
+def collect(args):
+    """Collect the metrics of deleted_libraries.py and inotify-instances.
+
+    Returns:
+        exposition.Exposition of the metrics.
+    """
+    import deleted_libraries
+
+    inotify_instances = load_inotify_instances()
+    try:
+        return collect_plugins(
+            [deleted_libraries.DeletedLibrariesPlugin(args),
+             inotify_instances.InotifyPlugin(args.proc_root)],
+            args.proc_root, workers=args.workers)
+    except EnvironmentError as e:
+        sys.exit('Failed to open file: {0}'.format(e.filename))
+
+
+def main():
+    collect(parse_args()).write(sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
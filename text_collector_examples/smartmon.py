@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 import argparse
 import collections
-import csv
+import concurrent.futures
 import datetime
 import decimal
+import json
+import os
 import re
 import shlex
 import subprocess
+import sys
+import threading
+import time
+
+import exposition
+import instrumentation
+import textfile_writer
 
 device_info_re = re.compile(r'^(?P<k>[^:]+?)(?:(?:\sis|):)\s*(?P<v>.*)$')
 
@@ -15,6 +24,16 @@ ata_error_count_re = re.compile(
 
 self_test_re = re.compile(r'^SMART.*(PASSED|OK)$', re.MULTILINE)
 
+# A row of the SMART attribute table printed by smartctl --attributes:
+# ID# ATTRIBUTE_NAME FLAG VALUE WORST THRESH TYPE UPDATED WHEN_FAILED RAW_VALUE
+smart_attribute_re = re.compile(
+    r'^\s*(\d+)\s+(\S+)\s+(0x[0-9a-fA-F]+)\s+(\d+)\s+(\d+)\s+(\d+|---)'
+    r'\s+(\S+)\s+(\S+)\s+(\S+)\s+(.*?)\s*$', re.MULTILINE)
+
+# Raw values start with the actual value, optionally followed by vendor
+# specific details, e.g. "36 (Min/Max 24/40)" or "1234h+05m+06.789s".
+raw_value_re = re.compile(r'^\s*(\d+)')
+
 device_info_map = {
     'Vendor': 'vendor',
     'Product': 'product',
@@ -22,10 +41,121 @@ device_info_map = {
     'Logical Unit id': 'lun_id',
     'Model Family': 'model_family',
     'Device Model': 'device_model',
+    'Model Number': 'device_model',
     'Serial Number': 'serial_number',
     'Firmware Version': 'firmware_version',
 }
 
+# Keys of the device information in smartctl's JSON output, mapped to the
+# same labels as device_info_map.  SCSI keys got a prefix in smartctl 7.2.
+device_info_json_map = {
+    'scsi_vendor': 'vendor',
+    'vendor': 'vendor',
+    'scsi_product': 'product',
+    'product': 'product',
+    'scsi_revision': 'revision',
+    'revision': 'revision',
+    'logical_unit_id': 'lun_id',
+    'model_family': 'model_family',
+    'model_name': 'device_model',
+    'serial_number': 'serial_number',
+    'firmware_version': 'firmware_version',
+}
+
+
+def _percent_to_ratio(value):
+    return value / 100
+
+
+def _minutes_to_seconds(value):
+    return value * 60
+
+
+# Fields of the NVMe SMART/health information log in smartctl's JSON output,
+# mapped to metric names and an optional conversion of the value.
+nvme_health_metrics = [
+    ('critical_warning', 'nvme_critical_warning', None),
+    ('temperature', 'nvme_temperature_celsius', None),
+    ('available_spare', 'nvme_available_spare_ratio', _percent_to_ratio),
+    ('available_spare_threshold', 'nvme_available_spare_threshold_ratio',
+     _percent_to_ratio),
+    ('percentage_used', 'nvme_percentage_used_ratio', _percent_to_ratio),
+    ('data_units_read', 'nvme_data_units_read_total', None),
+    ('data_units_written', 'nvme_data_units_written_total', None),
+    ('host_reads', 'nvme_host_read_commands_total', None),
+    ('host_writes', 'nvme_host_write_commands_total', None),
+    ('controller_busy_time', 'nvme_controller_busy_time_seconds_total',
+     _minutes_to_seconds),
+    ('power_cycles', 'nvme_power_cycles_total', None),
+    ('power_on_hours', 'nvme_power_on_hours_total', None),
+    ('unsafe_shutdowns', 'nvme_unsafe_shutdowns_total', None),
+    ('media_errors', 'nvme_media_errors_total', None),
+    ('num_err_log_entries', 'nvme_num_err_log_entries_total', None),
+    ('warning_temp_time', 'nvme_warning_temperature_time_seconds_total',
+     _minutes_to_seconds),
+    ('critical_comp_time', 'nvme_critical_temperature_time_seconds_total',
+     _minutes_to_seconds),
+]
+
+# Lines of the NVMe SMART/health information log printed by smartctl
+# --attributes, mapped to the keys of smartctl's JSON output.
+nvme_health_text_map = {
+    'Critical Warning': 'critical_warning',
+    'Temperature': 'temperature',
+    'Available Spare': 'available_spare',
+    'Available Spare Threshold': 'available_spare_threshold',
+    'Percentage Used': 'percentage_used',
+    'Data Units Read': 'data_units_read',
+    'Data Units Written': 'data_units_written',
+    'Host Read Commands': 'host_reads',
+    'Host Write Commands': 'host_writes',
+    'Controller Busy Time': 'controller_busy_time',
+    'Power Cycles': 'power_cycles',
+    'Power On Hours': 'power_on_hours',
+    'Unsafe Shutdowns': 'unsafe_shutdowns',
+    'Media and Data Integrity Errors': 'media_errors',
+    'Error Information Log Entries': 'num_err_log_entries',
+    'Warning Comp. Temperature Time': 'warning_temp_time',
+    'Critical Comp. Temperature Time': 'critical_comp_time',
+}
+
+# A line of the NVMe health information log, e.g.
+# "Data Units Read:                    1,234,567 [632 GB]"
+nvme_health_line_re = re.compile(
+    r'^(\S.*?):\s+(0x[0-9a-fA-F]+|[\d,]+)', re.MULTILINE)
+
+# Fields of each operation of the SCSI error counter log in smartctl's JSON
+# output, mapped to metric names.
+scsi_error_counter_metrics = [
+    ('total_errors_corrected', 'scsi_errors_corrected_total'),
+    ('total_uncorrected_errors', 'scsi_errors_uncorrected_total'),
+    ('correction_algorithm_invocations',
+     'scsi_correction_algorithm_invocations_total'),
+]
+
+# Columns of the rows of the SCSI error counter log printed by smartctl
+# --log=error, as keys of smartctl's JSON output.
+scsi_error_counter_fields = [
+    'errors_corrected_by_eccfast', 'errors_corrected_by_eccdelayed',
+    'errors_corrected_by_rereads_rewrites', 'total_errors_corrected',
+    'correction_algorithm_invocations', 'gigabytes_processed',
+    'total_uncorrected_errors',
+]
+
+scsi_error_counter_re = re.compile(
+    r'^(read|write|verify):' + r'\s+(\d+)' * 5 + r'\s+([\d.]+)\s+(\d+)\s*$',
+    re.MULTILINE)
+scsi_temperature_re = re.compile(
+    r'^Current Drive Temperature:\s+(\d+) C', re.MULTILINE)
+scsi_trip_temperature_re = re.compile(
+    r'^Drive Trip Temperature:\s+(\d+) C', re.MULTILINE)
+scsi_grown_defects_re = re.compile(
+    r'^Elements in grown defect list:\s+(\d+)', re.MULTILINE)
+
+# smartctl exit status bit set when the device could not be opened or is in
+# a low-power mode and --nocheck told smartctl to leave it alone.
+SMARTCTL_EXIT_DEVICE_UNAVAILABLE = 0x02
+
 smart_attributes_whitelist = {
     'airflow_temperature_cel',
     'command_timeout',
@@ -69,6 +199,17 @@ smart_attributes_whitelist = {
 
 Metric = collections.namedtuple('Metric', 'name labels value')
 
+# Which SMART attributes to export: names is a set of lower case attribute
+# names or None for all of them, raw_values adds an attr_raw_value metric.
+AttributeSelection = collections.namedtuple(
+    'AttributeSelection', 'names raw_values')
+
+DEFAULT_ATTRIBUTES = AttributeSelection(smart_attributes_whitelist, False)
+
+# Per-thread collection state, currently only holding the deadline of the
+# device being collected by the calling worker.
+_collection = threading.local()
+
 SmartAttribute = collections.namedtuple('SmartAttribute', [
     'id', 'name', 'flag', 'value', 'worst', 'threshold', 'type', 'updated',
     'when_failed', 'raw_value',
@@ -94,25 +235,40 @@ def metric_key(metric, prefix=''):
     return '{prefix}{metric.name}'.format(prefix=prefix, metric=metric)
 
 
-def metric_format(metric, prefix=''):
-    key = metric_key(metric, prefix)
-    labels = ','.join(
-        '{k}="{v}"'.format(k=k, v=v) for k, v in metric.labels.items())
-    value = decimal.Decimal(metric.value)
+def metric_add(metrics, metric, prefix=''):
+    """Add a Metric to an exposition.Exposition.
+
+    Metrics named *_total are counters, all others gauges.
+    """
+    metrics.add(metric_key(metric, prefix), metric.value, metric.labels,
+                help='SMART metric {}'.format(metric.name),
+                type='counter' if metric.name.endswith('_total') else 'gauge')
 
-    return '{key}{{{labels}}} {value}'.format(
-        key=key, labels=labels, value=value)
 
+def smart_ctl_process(*args):
+    """Run the smartctl binary.
 
-def metric_print_meta(metric, prefix=''):
-    key = metric_key(metric, prefix)
-    print('# HELP {key} SMART metric {metric.name}'.format(
-        key=key, metric=metric))
-    print('# TYPE {key} gauge'.format(key=key, metric=metric))
+    If the calling thread is collecting a device with a deadline, the
+    subprocess is only given the time that is left until that deadline.
+
+    Returns:
+        (subprocess.CompletedProcess) The finished smartctl subprocess.
 
+    Raises:
+        subprocess.TimeoutExpired: the device deadline has passed.
+    """
+    timeout = None
+    deadline = getattr(_collection, 'deadline', None)
+    if deadline is not None:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            raise subprocess.TimeoutExpired(['smartctl', *args], 0)
 
-def metric_print(metric, prefix=''):
-    print(metric_format(metric, prefix))
+    with instrumentation.command():
+        proc = subprocess.run(
+            ['smartctl', *args], stdout=subprocess.PIPE, timeout=timeout)
+    instrumentation.parsed(len(proc.stdout))
+    return proc
 
 
 def smart_ctl(*args, check=True):
@@ -122,9 +278,10 @@ def smart_ctl(*args, check=True):
         (str) Data piped to stdout by the smartctl subprocess.
     """
     try:
-        return subprocess.run(
-            ['smartctl', *args], stdout=subprocess.PIPE, check=check
-        ).stdout.decode('utf-8')
+        proc = smart_ctl_process(*args)
+        if check:
+            proc.check_returncode()
+        return proc.stdout.decode('utf-8')
     except subprocess.CalledProcessError as e:
         return e.output.decode('utf-8')
 
@@ -132,6 +289,37 @@ def smart_ctl_version():
     return smart_ctl('-V').split('\n')[0].split()[1]
 
 
+def smart_ctl_supports_json(version):
+    """Returns whenever the given smartctl version supports JSON output.
+
+    Args:
+        version: (str) Version as reported by smart_ctl_version().
+
+    Returns:
+        (bool) True for smartctl 7.0 and later, False otherwise.
+    """
+    try:
+        return int(version.split('.', 1)[0]) >= 7
+    except ValueError:
+        return False
+
+
+def smart_ctl_json(*args):
+    """Invoke smartctl with JSON output.
+
+    smartctl uses its exit status as a bit mask of device problems, so a
+    non-zero exit status is not treated as an error here.  It is available
+    as data['smartctl']['exit_status'].
+
+    Returns:
+        (dict) Decoded JSON document, None if smartctl did not produce one.
+    """
+    try:
+        return json.loads(smart_ctl('--json', *args, check=False))
+    except ValueError:
+        return None
+
+
 def find_devices():
     """Find SMART devices.
 
@@ -155,6 +343,268 @@ def find_devices():
         yield Device(tokens[0], parser.parse_args(tokens[1:]))
 
 
+def block_device_inventory(sys_block='/sys/block', dev='/dev'):
+    """Fingerprint the block devices of the system.
+
+    Args:
+        sys_block: (str) Directory listing the block devices.
+        dev: (str) Directory holding the device nodes.
+
+    Returns:
+        (list) [name, inode, mtime] of every block device, sorted by name.
+    """
+    inventory = []
+    for name in sorted(os.listdir(sys_block)):
+        try:
+            st = os.stat(os.path.join(dev, name))
+        except FileNotFoundError:
+            inventory.append([name, None, None])
+            continue
+        inventory.append([name, st.st_ino, st.st_mtime_ns])
+
+    return inventory
+
+
+def find_devices_cached(cache_path, rescan=False):
+    """Find SMART devices, reusing the result of a previous scan.
+
+    The devices found by find_devices() are stored in cache_path together
+    with the block device inventory.  They are reused as long as that
+    inventory does not change, sparing the `smartctl --scan-open` run which
+    opens every block device.
+
+    Args:
+        cache_path: (str) Path of the device cache file.
+        rescan: (bool) Ignore and replace the cached devices.
+
+    Returns:
+        (list) Device objects.
+    """
+    inventory = block_device_inventory()
+
+    if not rescan:
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+            if cache['inventory'] == inventory:
+                return [
+                    Device(path, argparse.Namespace(type=type_))
+                    for path, type_ in cache['devices']]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    devices = list(find_devices())
+
+    write_json_atomic(cache_path, {
+        'inventory': inventory,
+        'devices': [[d.path, d.type] for d in devices],
+    })
+
+    return devices
+
+
+def write_json_atomic(path, obj):
+    """Replace the file at path with obj encoded as JSON.
+
+    The file is replaced with textfile_writer.write_atomic(), so readers
+    never see a partial file.  Failures are reported on stderr but are not
+    fatal.
+
+    Args:
+        path: (str) Destination path.
+        obj: JSON serializable object.
+    """
+    try:
+        textfile_writer.write_atomic(path, json.dumps(obj))
+    except OSError as e:
+        print('smartmon: unable to write {}: {}'.format(path, e),
+              file=sys.stderr)
+
+
+class ResultStore(object):
+    """Persistent store of the last collected metrics of every device.
+
+    Results are keyed by the serial number of the device, with a mapping
+    from device path to serial number so sleeping devices, which cannot be
+    asked for their serial number, are still found.
+
+    Everything but the metrics describing the run itself is served from the
+    store while a device sleeps, and SMART attributes and the error log are
+    served from it until their refresh interval has passed.
+
+    Every SMART attribute keeps the time it was last refreshed. An attribute
+    with an interval of its own is served from the store until that interval
+    has passed, even if the device was read for the other data in between.
+    """
+
+    live_metrics = {'smartctl_run', 'device_active'}
+
+    def __init__(self, path, refresh_interval=0, attribute_intervals=None):
+        """
+        Args:
+            path: (str) Path of the state file.
+            refresh_interval: (float) Seconds between reads of the SMART
+                attributes and the error log of a device.
+            attribute_intervals: (dict) Refresh interval per attribute name,
+                overriding refresh_interval.
+        """
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.attribute_intervals = attribute_intervals or {}
+        self._lock = threading.Lock()
+
+        self.devices = {}
+        self.serials = {}
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            self.devices = state['devices']
+            self.serials = state['serials']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def save(self):
+        with self._lock:
+            write_json_atomic(self.path, {
+                'devices': self.devices,
+                'serials': self.serials,
+            })
+
+    def _entry(self, device):
+        serial = self.serials.get(device.path)
+        return serial, self.devices.get(serial)
+
+    @staticmethod
+    def _attribute_key(labels):
+        """Get the key of an attribute, its ID and name if labeled by ID."""
+        if 'id' in labels:
+            return '{0}:{1}'.format(labels['id'], labels['name'])
+        return labels['name']
+
+    @staticmethod
+    def _refreshed(entry):
+        """Get attribute key to its name and the time it was last refreshed."""
+        refreshed = entry.get('refreshed', {})
+        attributes = {}
+        for name, labels, value in entry['metrics']:
+            if name.startswith('attr_'):
+                key = ResultStore._attribute_key(labels)
+                attributes[key] = (
+                    labels['name'], refreshed.get(key, entry['updated']))
+        return attributes
+
+    def _attribute_due(self, attribute, refreshed, now):
+        interval = self.attribute_intervals.get(attribute)
+        return interval is None or now - refreshed >= interval
+
+    def is_due(self, device):
+        """Returns whenever the slow changing data of a device is due.
+
+        A refresh is due once the refresh interval has passed since the last
+        one, or the interval of a stored SMART attribute with an interval of
+        its own has passed since that attribute was refreshed.
+
+        Args:
+            device: (Device) Device in question.
+
+        Returns:
+            (bool) True if everything has to be read from the device.
+        """
+        with self._lock:
+            _, entry = self._entry(device)
+        if entry is None:
+            return True
+
+        now = time.time()
+        if now - entry['updated'] >= self.refresh_interval:
+            return True
+        return any(
+            attribute in self.attribute_intervals and
+            self._attribute_due(attribute, refreshed, now)
+            for attribute, refreshed in self._refreshed(entry).values())
+
+    def update(self, device, metrics, refresh):
+        """Merge freshly collected metrics of a device with the store.
+
+        Args:
+            device: (Device) Device in question.
+            metrics: (list) Metric objects collected from the device.
+            refresh: (bool) Whenever metrics hold everything the device
+                reports, rather than only the cheap parts.
+
+        Returns:
+            (list) Metric objects to report for the device.
+        """
+        now = time.time()
+        names = {m.name for m in metrics}
+        serial = next((
+            m.labels.get('serial_number') for m in metrics
+            if m.name == 'device_info'), None)
+
+        with self._lock:
+            old_serial, entry = self._entry(device)
+
+            if 'device_info' not in names:
+                # Sleeping device, serve its last known metrics.
+                if entry is None:
+                    return metrics
+            elif refresh:
+                key = serial or 'path:' + device.path
+                # Attributes not due yet keep their stored values
+                refreshed = {}
+                held = []
+                if entry is not None and key == old_serial:
+                    # Only hold series the device still reports, the keys
+                    # change when --all-attributes is switched.
+                    collected = {
+                        self._attribute_key(m.labels) for m in metrics
+                        if m.name.startswith('attr_')}
+                    for key, (attribute, last) in \
+                            self._refreshed(entry).items():
+                        if key in collected and \
+                                not self._attribute_due(attribute, last, now):
+                            refreshed[key] = last
+                    held = [
+                        Metric(name, {**labels, **device.base_labels}, value)
+                        for name, labels, value in entry['metrics']
+                        if name.startswith('attr_') and
+                        self._attribute_key(labels) in refreshed]
+                metrics = [
+                    m for m in metrics
+                    if not (m.name.startswith('attr_') and
+                            self._attribute_key(m.labels) in refreshed)
+                ] + held
+                for m in metrics:
+                    if m.name.startswith('attr_'):
+                        refreshed.setdefault(
+                            self._attribute_key(m.labels), now)
+
+                entry = self.devices[key] = {
+                    'updated': now,
+                    'refreshed': refreshed,
+                    'metrics': [
+                        [m.name, m.labels, m.value] for m in metrics
+                        if m.name not in self.live_metrics],
+                }
+                self.serials[device.path] = key
+            elif entry is None or (serial or 'path:' + device.path) != \
+                    old_serial:
+                # Another disk took the place of the stored one, make sure
+                # the next run reads everything.
+                self.serials.pop(device.path, None)
+                return metrics
+
+        # The same disk may be reachable through several paths, so the
+        # stored labels are adjusted to the path the device was found at.
+        cached = [
+            Metric(name, {**labels, **device.base_labels}, value)
+            for name, labels, value in entry['metrics'] if name not in names]
+
+        return metrics + cached + [Metric(
+            'device_data_age_seconds', device.base_labels,
+            int(now - entry['updated']))]
+
+
 def device_is_active(device):
     """Returns whenever the given device is currently active or not.
 
@@ -164,12 +614,10 @@ def device_is_active(device):
     Returns:
         (bool) True if the device is active and False otherwise.
     """
-    try:
-        smart_ctl('--nocheck', 'standby', *device.smartctl_select())
-    except subprocess.CalledProcessError:
-        return False
+    proc = smart_ctl_process(
+        '--nocheck', 'standby', *device.smartctl_select())
 
-    return True
+    return not proc.returncode & SMARTCTL_EXIT_DEVICE_UNAVAILABLE
 
 
 def device_info(device):
@@ -210,8 +658,11 @@ def device_smart_capabilities(device):
         g[1].split(' ', 1)[0]
         for g in groups if g[0] == 'SMART support'}
 
-    smart_available = 'Available' in state
-    smart_enabled = 'Enabled' in state
+    # NVMe devices always support SMART, smartctl does not report it for
+    # them.
+    nvme = device.type.startswith('nvme')
+    smart_available = 'Available' in state if state else nvme
+    smart_enabled = 'Enabled' in state if state else nvme
 
     return smart_available, smart_enabled
 
@@ -252,50 +703,99 @@ def collect_device_health_self_assessment(device):
         'device_smart_healthy', device.base_labels, self_assessment_passed)
 
 
-def collect_ata_metrics(device):
-    # Fetch SMART attributes for the given device.
-    attributes = smart_ctl(
-        '--attributes', *device.smartctl_select()
-    )
-
-    # replace multiple occurrences of whitespace with a single whitespace
-    # so that the CSV Parser recognizes individual columns properly.
-    attributes = re.sub(r'[\t\x20]+', ' ', attributes)
-
-    # Turn smartctl output into a list of lines and skip to the table of
-    # SMART attributes.
-    attribute_lines = attributes.strip().split('\n')[7:]
-
-    reader = csv.DictReader(
-        (l.strip() for l in attribute_lines),
-        fieldnames=SmartAttribute._fields[:-1],
-        restkey=SmartAttribute._fields[-1], delimiter=' ')
-    for entry in reader:
-        # We're only interested in the SMART attributes that are
-        # whitelisted here.
-        entry['name'] = entry['name'].lower()
-        if entry['name'] not in smart_attributes_whitelist:
-            continue
+def parse_ata_attributes(output):
+    """Parse the SMART attribute table printed by smartctl --attributes.
 
-        # Ensure that only the numeric parts are fetched from the raw_value.
-        # Attributes such as 194 Temperature_Celsius reported by my SSD
-        # are in the format of "36 (Min/Max 24/40)" which can't be expressed
-        # properly as a prometheus metric.
-        m = re.match('^(\d+)', ' '.join(entry['raw_value']))
-        if not m:
-            continue
-        entry['raw_value'] = m.group(1)
+    The table is matched in a single pass over the whole output, anything
+    that isn't a table row is skipped.
+
+    Args:
+        output: (str) Output of smartctl --attributes.
+
+    Yields:
+        (SmartAttribute) Attribute as printed by smartctl, all fields being
+        strings.
+    """
+    for m in smart_attribute_re.finditer(output):
+        yield SmartAttribute._make(m.groups())
+
+
+def decode_raw_value(raw_value):
+    """Decode the numeric part of a SMART attribute raw value.
+
+    Attributes such as 194 Temperature_Celsius are reported in the format of
+    "36 (Min/Max 24/40)" which can't be expressed properly as a prometheus
+    metric, so only the leading number is kept.
+
+    Args:
+        raw_value: (str) Raw value as printed by smartctl.
+
+    Returns:
+        (int) The decoded value, None if there is no numeric value.
+    """
+    m = raw_value_re.match(raw_value)
+    if m is None:
+        return None
+    return int(m.group(1))
+
+
+def attribute_metrics(device, attr_id, name, value, worst, threshold,
+                      raw_value, attributes):
+    """Turn a single SMART attribute into metrics.
+
+    With all attributes exported, the series are labeled with the attribute
+    ID next to the name, as names like Unknown_Attribute are shared by
+    several attributes.
+
+    Args:
+        device: (Device) Device in question.
+        attr_id: ID of the attribute.
+        name: (str) Attribute name as printed by smartctl.
+        value, worst, threshold: Normalized values of the attribute.
+        raw_value: (str) Raw value as printed by smartctl.
+        attributes: (AttributeSelection) Attributes to export.
+
+    Yields:
+        (Metric) metrics of the attribute.
+    """
+    name = name.lower()
+    if attributes.names is not None and name not in attributes.names:
+        return
+
+    # Attributes without a numeric raw value are skipped entirely.
+    raw = decode_raw_value(raw_value)
+    if raw is None:
+        return
+
+    labels = {'name': name}
+    if attributes.names is None:
+        labels['id'] = int(attr_id)
+    labels.update(device.base_labels)
 
-        if entry['name'] in smart_attributes_whitelist:
-            labels = {
-                'name': entry['name'],
-                **device.base_labels,
-            }
+    yield Metric('attr_value', labels, value)
+    yield Metric('attr_worst', labels, worst)
+    if threshold != '---':
+        yield Metric('attr_threshold', labels, threshold)
+    if attributes.raw_values:
+        yield Metric('attr_raw_value', labels, raw)
 
-            for col in 'value', 'worst', 'threshold':
-                yield Metric(
-                    'attr_{col}'.format(name=entry["name"], col=col),
-                    labels, entry[col])
+
+def collect_ata_metrics(device, attributes=DEFAULT_ATTRIBUTES):
+    """Collect SMART attributes from smartctl's text output.
+
+    Args:
+        device: (Device) Device in question.
+        attributes: (AttributeSelection) Attributes to export.
+
+    Yields:
+        (Metric) metrics of each attribute.
+    """
+    output = smart_ctl('--attributes', *device.smartctl_select())
+
+    for attr in parse_ata_attributes(output):
+        yield from attribute_metrics(
+            device, attr.id, attr.name, attr.value, attr.worst, attr.threshold,
+            attr.raw_value, attributes)
 
 
 def collect_ata_error_count(device):
@@ -317,62 +817,548 @@ def collect_ata_error_count(device):
     yield Metric('device_errors', device.base_labels, error_count)
 
 
-def collect_disks_smart_metrics():
+def parse_nvme_health(output):
+    """Parse the NVMe health information log printed by smartctl --attributes.
+
+    Args:
+        output: (str) Output of smartctl --attributes of an NVMe device.
+
+    Returns:
+        (dict) the log as in smartctl's JSON output, see
+        collect_nvme_metrics_json().
+    """
+    log = {}
+    for m in nvme_health_line_re.finditer(output):
+        key = nvme_health_text_map.get(' '.join(m.group(1).split()))
+        if key is None:
+            continue
+        value = m.group(2)
+        if value.startswith('0x'):
+            log[key] = int(value, 16)
+        else:
+            log[key] = int(value.replace(',', ''))
+    return {'nvme_smart_health_information_log': log}
+
+
+def collect_nvme_metrics(device):
+    """Collect the NVMe SMART/health information log from smartctl's text
+    output.
+
+    Args:
+        device: (Device) Device in question.
+
+    Yields:
+        (Metric) metrics of the health information log.
+    """
+    output = smart_ctl('--attributes', *device.smartctl_select())
+    yield from collect_nvme_metrics_json(device, parse_nvme_health(output))
+
+
+def parse_scsi_counters(output):
+    """Parse the temperatures, grown defect list and error counter log printed
+    by smartctl --attributes --log=error for a SCSI device.
+
+    Args:
+        output: (str) Output of smartctl.
+
+    Returns:
+        (dict) the values as in smartctl's JSON output, see
+        collect_scsi_metrics_json().
+    """
+    data = {}
+    m = scsi_grown_defects_re.search(output)
+    if m is not None:
+        data['scsi_grown_defect_list'] = int(m.group(1))
+
+    error_log = {}
+    for m in scsi_error_counter_re.finditer(output):
+        counters = dict(zip(scsi_error_counter_fields, m.groups()[1:]))
+        error_log[m.group(1)] = {
+            key: value if key == 'gigabytes_processed' else int(value)
+            for key, value in counters.items()}
+    if error_log:
+        data['scsi_error_counter_log'] = error_log
+
+    temperature = {}
+    for key, regex in (('current', scsi_temperature_re),
+                       ('drive_trip', scsi_trip_temperature_re)):
+        m = regex.search(output)
+        if m is not None:
+            temperature[key] = int(m.group(1))
+    if temperature:
+        data['temperature'] = temperature
+    return data
+
+
+def collect_scsi_metrics(device):
+    """Collect SCSI error counters and the grown defect list from smartctl's
+    text output.
+
+    Args:
+        device: (Device) Device in question.
+
+    Yields:
+        (Metric) error counter, defect and temperature metrics.
+    """
+    output = smart_ctl(
+        '--attributes', '--log=error', *device.smartctl_select(), check=False)
+    yield from collect_scsi_metrics_json(device, parse_scsi_counters(output))
+
+
+def collect_device_metrics_text(device, refresh=True,
+                                attributes=DEFAULT_ATTRIBUTES):
+    """Collect all metrics of a single device from smartctl's text output.
+
+    Args:
+        device: (Device) Device in question.
+        refresh: (bool) Whenever to read the SMART attributes and the error
+            log, which are the expensive part of the collection.
+        attributes: (AttributeSelection) SMART attributes to export.
+
+    Yields:
+        (Metric) metrics of the device.
+    """
     now = int(datetime.datetime.utcnow().timestamp())
 
-    for device in find_devices():
-        yield Metric('smartctl_run', device.base_labels, now)
+    yield Metric('smartctl_run', device.base_labels, now)
+
+    is_active = device_is_active(device)
+
+    yield Metric('device_active', device.base_labels, is_active)
+
+    # Skip further metrics collection to prevent the disk from
+    # spinning up.
+    if not is_active:
+        return
+
+    yield from collect_device_info(device)
+
+    smart_available, smart_enabled = device_smart_capabilities(device)
+
+    yield Metric(
+        'device_smart_available', device.base_labels, smart_available)
+    yield Metric(
+        'device_smart_enabled', device.base_labels, smart_enabled)
+
+    # Skip further metrics collection here if SMART is disabled
+    # on the device.  Further smartctl invocations would fail
+    # anyways.
+    if not smart_available:
+        return
+
+    yield from collect_device_health_self_assessment(device)
+
+    if refresh and device.type.startswith('sat'):
+        yield from collect_ata_metrics(device, attributes)
+
+        yield from collect_ata_error_count(device)
+
+    if refresh and device.type.startswith('nvme'):
+        yield from collect_nvme_metrics(device)
+
+    if refresh and device.type.startswith('scsi'):
+        yield from collect_scsi_metrics(device)
+
+
+def collect_device_info_json(device, data):
+    """Collect basic device information from smartctl's JSON output.
+
+    Args:
+        device: (Device) Device in question.
+        data: (dict) smartctl JSON document of the device.
+
+    Yields:
+        (Metric) metrics describing general device information.
+    """
+    info = {
+        label: str(data[key]) for key, label in device_info_json_map.items()
+        if key in data}
+    # Keep the label order of the text based collection.
+    yield Metric('device_info', {
+        **device.base_labels,
+        **{v: info[v] for v in device_info_map.values() if v in info}
+    }, True)
+
+
+def collect_ata_metrics_json(device, data, attributes=DEFAULT_ATTRIBUTES):
+    """Collect SMART attributes from smartctl's JSON output.
+
+    Args:
+        device: (Device) Device in question.
+        data: (dict) smartctl JSON document of the device.
+        attributes: (AttributeSelection) Attributes to export.
+
+    Yields:
+        (Metric) metrics of each attribute.
+    """
+    table = data.get('ata_smart_attributes', {}).get('table', [])
+    for entry in table:
+        # The raw value is decoded from its string form, as the numeric
+        # form packs all vendor specific details into a single integer.
+        yield from attribute_metrics(
+            device, entry['id'], entry['name'], entry['value'], entry['worst'],
+            entry['thresh'], entry.get('raw', {}).get('string', ''),
+            attributes)
+
+
+def collect_ata_error_count_json(device, data):
+    """Report the amount of device error log entries from smartctl's JSON.
+
+    Args:
+        device: (Device) Device in question.
+        data: (dict) smartctl JSON document of the device.
+
+    Yields:
+        (Metric) Device error count.
+    """
+    error_log = data.get('ata_smart_error_log', {})
+    log = error_log.get('extended', error_log.get('summary', {}))
+
+    yield Metric('device_errors', device.base_labels, log.get('count', 0))
+
 
-        is_active = device_is_active(device)
+def collect_nvme_metrics_json(device, data):
+    """Collect the NVMe SMART/health information log from smartctl's JSON.
 
-        yield Metric('device_active', device.base_labels, is_active)
+    Args:
+        device: (Device) Device in question.
+        data: (dict) smartctl JSON document of the device.
 
-        # Skip further metrics collection to prevent the disk from
-        # spinning up.
-        if not is_active:
+    Yields:
+        (Metric) metrics of the health information log.
+    """
+    log = data.get('nvme_smart_health_information_log', {})
+    for key, name, convert in nvme_health_metrics:
+        if key not in log:
             continue
+        value = log[key]
+        if convert is not None:
+            value = convert(value)
+        yield Metric(name, device.base_labels, value)
 
-        yield from collect_device_info(device)
 
-        smart_available, smart_enabled = device_smart_capabilities(device)
+def collect_scsi_metrics_json(device, data):
+    """Collect SCSI error counters and the grown defect list from smartctl's
+    JSON output.
 
-        yield Metric(
-            'device_smart_available', device.base_labels, smart_available)
-        yield Metric(
-            'device_smart_enabled', device.base_labels, smart_enabled)
+    Args:
+        device: (Device) Device in question.
+        data: (dict) smartctl JSON document of the device.
+
+    Yields:
+        (Metric) error counter, defect and temperature metrics.
+    """
+    if 'scsi_grown_defect_list' in data:
+        yield Metric('scsi_grown_defects', device.base_labels,
+                     data['scsi_grown_defect_list'])
 
-        # Skip further metrics collection here if SMART is disabled
-        # on the device.  Further smartctl invocations would fail
-        # anyways.
-        if not smart_available:
+    error_log = data.get('scsi_error_counter_log', {})
+    for operation in 'read', 'write', 'verify':
+        if operation not in error_log:
             continue
+        counters = error_log[operation]
+        labels = {
+            'operation': operation,
+            **device.base_labels,
+        }
+
+        for key, name in scsi_error_counter_metrics:
+            if key in counters:
+                yield Metric(name, labels, counters[key])
+
+        if 'gigabytes_processed' in counters:
+            yield Metric(
+                'scsi_processed_bytes_total', labels,
+                int(decimal.Decimal(counters['gigabytes_processed']) * 10**9))
+
+    temperature = data.get('temperature', {})
+    if 'current' in temperature:
+        yield Metric('scsi_temperature_celsius', device.base_labels,
+                     temperature['current'])
+    if 'drive_trip' in temperature:
+        yield Metric('scsi_temperature_trip_celsius', device.base_labels,
+                     temperature['drive_trip'])
+
+
+def collect_device_metrics_json(device, data, refresh=True,
+                                attributes=DEFAULT_ATTRIBUTES):
+    """Collect all metrics of a single device from one smartctl JSON document.
+
+    Args:
+        device: (Device) Device in question.
+        data: (dict) Output of smartctl --json --xall --nocheck standby.
+        refresh: (bool) False if data only holds --info and --health, in
+            which case SMART attributes, error logs and the NVMe and SCSI
+            counters are skipped.
+        attributes: (AttributeSelection) SMART attributes to export.
 
-        yield from collect_device_health_self_assessment(device)
+    Yields:
+        (Metric) metrics of the device.
+    """
+    now = int(datetime.datetime.utcnow().timestamp())
 
-        if device.type.startswith('sat'):
-            yield from collect_ata_metrics(device)
+    yield Metric('smartctl_run', device.base_labels, now)
 
-            yield from collect_ata_error_count(device)
+    exit_status = data.get('smartctl', {}).get('exit_status', 0)
+    is_active = not exit_status & SMARTCTL_EXIT_DEVICE_UNAVAILABLE
 
+    yield Metric('device_active', device.base_labels, is_active)
+
+    if not is_active:
+        return
+
+    yield from collect_device_info_json(device, data)
+
+    # NVMe devices always support SMART, smartctl does not report it for
+    # them.
+    protocol = data.get('device', {}).get('protocol')
+    smart_support = data.get('smart_support', {})
+    smart_available = smart_support.get('available', protocol == 'NVMe')
+    smart_enabled = smart_support.get('enabled', protocol == 'NVMe')
+
+    yield Metric(
+        'device_smart_available', device.base_labels, smart_available)
+    yield Metric(
+        'device_smart_enabled', device.base_labels, smart_enabled)
+
+    if not smart_available:
+        return
+
+    yield Metric(
+        'device_smart_healthy', device.base_labels,
+        data.get('smart_status', {}).get('passed', False))
+
+    if refresh and device.type.startswith('sat'):
+        yield from collect_ata_metrics_json(device, data, attributes)
+
+        yield from collect_ata_error_count_json(device, data)
+
+    if refresh and protocol == 'NVMe':
+        yield from collect_nvme_metrics_json(device, data)
+
+    if refresh and protocol == 'SCSI':
+        yield from collect_scsi_metrics_json(device, data)
+
+
+def collect_device_metrics(device, use_json=False, store=None,
+                           attributes=DEFAULT_ATTRIBUTES):
+    """Collect all metrics of a single device.
+
+    With use_json, everything is derived from a single smartctl invocation.
+    The text based collection is used for smartctl builds without JSON
+    support, or if the JSON output could not be decoded.
+
+    With a store, SMART attributes and the error log are only read from the
+    device once their refresh interval passed, and sleeping devices report
+    their last known values.
+
+    Args:
+        device: (Device) Device in question.
+        use_json: (bool) Whenever smartctl supports JSON output.
+        store: (ResultStore) Last known results of the devices, or None.
+        attributes: (AttributeSelection) SMART attributes to export.
+
+    Yields:
+        (Metric) metrics of the device.
+    """
+    refresh = store is None or store.is_due(device)
+
+    metrics = None
+    if use_json:
+        # --nocheck standby makes smartctl bail out before touching a
+        # sleeping disk, which is reported through its exit status.
+        query = ['--xall'] if refresh else ['--info', '--health']
+        data = smart_ctl_json(
+            *query, '--nocheck', 'standby', *device.smartctl_select())
+        if data is not None:
+            metrics = collect_device_metrics_json(
+                device, data, refresh, attributes)
+
+    if metrics is None:
+        metrics = collect_device_metrics_text(device, refresh, attributes)
+
+    if store is None:
+        yield from metrics
+        return
+
+    yield from store.update(device, list(metrics), refresh)
+
+
+def collect_device_metrics_until(device, timeout=None, use_json=False,
+                                 store=None, attributes=DEFAULT_ATTRIBUTES):
+    """Collect the metrics of a device within an optional deadline.
+
+    Once the deadline has passed, the metrics collected so far are kept
+    and no further smartctl invocations are made for the device.
+
+    Args:
+        device: (Device) Device in question.
+        timeout: (float) Seconds allowed for the device, None for no limit.
+        use_json: (bool) Whenever smartctl supports JSON output.
+        store: (ResultStore) Last known results of the devices, or None.
+        attributes: (AttributeSelection) SMART attributes to export.
+
+    Returns:
+        (list) Metric objects collected for the device.
+    """
+    metrics = []
+    _collection.deadline = None
+    if timeout is not None:
+        _collection.deadline = time.monotonic() + timeout
+    try:
+        for metric in collect_device_metrics(
+                device, use_json, store, attributes):
+            metrics.append(metric)
+    except subprocess.TimeoutExpired:
+        print('smartmon: collecting {} exceeded {}s deadline'.format(
+            device.path, timeout), file=sys.stderr)
+    finally:
+        _collection.deadline = None
+
+    return metrics
+
+
+def collect_disks_smart_metrics(workers=1, device_timeout=None,
+                                use_json=False, devices=None, store=None,
+                                attributes=DEFAULT_ATTRIBUTES):
+    """Collect the metrics of all devices found by smartctl.
+
+    Args:
+        workers: (int) Number of devices collected concurrently.
+        device_timeout: (float) Seconds allowed per device, None for no
+            limit.
+        use_json: (bool) Whenever smartctl supports JSON output.
+        devices: (list) Device objects to collect, defaults to the devices
+            found by find_devices().
+        store: (ResultStore) Last known results of the devices, or None.
+        attributes: (AttributeSelection) SMART attributes to export.
+
+    Yields:
+        (Metric) metrics of all devices, grouped per device in the order
+        the devices were found.
+    """
+    if devices is None:
+        devices = list(find_devices())
+
+    if workers <= 1:
+        for device in devices:
+            yield from collect_device_metrics_until(
+                device, device_timeout, use_json, store, attributes)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for metrics in pool.map(
+                lambda d: collect_device_metrics_until(
+                    d, device_timeout, use_json, store, attributes),
+                devices):
+            yield from metrics
+
+
+def attribute_interval(value):
+    """Parse a NAME=SECONDS attribute refresh interval."""
+    name, _, seconds = value.partition('=')
+    try:
+        return name.lower(), float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'invalid attribute refresh interval {}'.format(value))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Expose SMART metrics of all disks found by smartctl.')
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='number of devices to collect concurrently')
+    parser.add_argument(
+        '--device-timeout', type=float, default=None,
+        help='seconds allowed for collecting a single device')
+    parser.add_argument(
+        '--no-json', action='store_true',
+        help='parse the text output of smartctl even if it supports JSON')
+    parser.add_argument(
+        '--device-cache', metavar='PATH',
+        help='cache the devices found by smartctl --scan-open in PATH until '
+             'the block devices of the system change')
+    parser.add_argument(
+        '--rescan', action='store_true',
+        help='ignore the device cache and scan for devices again')
+    parser.add_argument(
+        '--state-file', metavar='PATH',
+        help='keep the last known metrics of every device in PATH, to '
+             'report them while the device sleeps')
+    parser.add_argument(
+        '--refresh-interval', type=float, default=0, metavar='SECONDS',
+        help='with --state-file, seconds between reads of the SMART '
+             'attributes and error log of a device')
+    parser.add_argument(
+        '--attribute-refresh-interval', action='append', default=[],
+        type=attribute_interval, metavar='NAME=SECONDS',
+        help='with --state-file, refresh interval of a single SMART '
+             'attribute, overriding --refresh-interval')
+    parser.add_argument(
+        '--all-attributes', action='store_true',
+        help='export all SMART attributes instead of a fixed set, labeled '
+             'with their ID as several share a name')
+    parser.add_argument(
+        '--raw-values', action='store_true',
+        help='export the decoded raw value of SMART attributes')
+    instrumentation.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+@instrumentation.instrumented('smartmon')
+def collect(args):
+    """Collect the SMART metrics of all disks.
+
+    Returns:
+        exposition.Exposition of the metrics.
+    """
+    metrics = exposition.Exposition()
+
+    with instrumentation.phase('version'):
+        version = smart_ctl_version()
+    use_json = not args.no_json and smart_ctl_supports_json(version)
 
-def main():
     version_metric = Metric('smartctl_version', {
-        'version': smart_ctl_version()
+        'version': version
     }, True)
-    metric_print_meta(version_metric, 'smartmon_')
-    metric_print(version_metric, 'smartmon_')
+    metric_add(metrics, version_metric, 'smartmon_')
+
+    with instrumentation.phase('scan'):
+        if args.device_cache:
+            devices = find_devices_cached(args.device_cache, args.rescan)
+        else:
+            devices = list(find_devices())
+
+    store = None
+    if args.state_file:
+        store = ResultStore(
+            args.state_file, args.refresh_interval,
+            dict(args.attribute_refresh_interval))
 
-    metrics = list(collect_disks_smart_metrics())
-    metrics.sort(key=lambda i: i.name)
+    attributes = AttributeSelection(
+        None if args.all_attributes else smart_attributes_whitelist,
+        args.raw_values)
 
-    previous_name = None
-    for m in metrics:
-        if m.name != previous_name:
-            metric_print_meta(m, 'smartmon_')
+    with instrumentation.phase('devices'):
+        device_metrics = list(collect_disks_smart_metrics(
+            args.workers, args.device_timeout, use_json, devices, store,
+            attributes))
 
-            previous_name = m.name
+        if store is not None:
+            store.save()
+
+    with instrumentation.phase('format'):
+        device_metrics.sort(key=lambda i: i.name)
+        for m in device_metrics:
+            metric_add(metrics, m, 'smartmon_')
+    return metrics
+
+
+def main():
+    collect(parse_args()).write(sys.stdout)
 
-        metric_print(m, 'smartmon_')
 
 if __name__ == '__main__':
     main()
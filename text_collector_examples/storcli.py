@@ -20,89 +20,151 @@ $ yapf -i --style '{COLUMN_LIMIT: 99}' storcli.py
 from __future__ import print_function
 from datetime import datetime
 import argparse
+import codecs
 import collections
+import concurrent.futures
+import hashlib
 import json
 import os
+import re
 import shlex
 import subprocess
+import sys
+import time
+
+import exposition
+import instrumentation
+import textfile_writer
 
 DESCRIPTION = """Parses StorCLI's JSON output and exposes MegaRAID health as
     Prometheus metrics."""
 VERSION = '0.0.3'
 
-storcli_path = ''
 metric_prefix = 'megaraid_'
-metric_list = {}
-metric_list = collections.defaultdict(list)
+
+DETAILED_INFORMATION_SUFFIX = ' - Detailed Information'
+drive_key_re = re.compile(r'^Drive /c(\d+)/')
 
 
 def main(args):
     """ main """
-    global storcli_path
+    collect(args).write(sys.stdout)
+
+
+@instrumentation.instrumented('storcli')
+def collect(args):
+    """Collect the metrics of all controllers.
+
+    Returns:
+        exposition.Exposition of the metrics.
+    """
     storcli_path = args.storcli_path
-    data = get_storcli_json('/cALL show all J')
+    registry = MetricRegistry(metric_prefix)
+    with instrumentation.phase('controllers'):
+        data = get_storcli_json(storcli_path, '/cALL show all J')
 
     try:
         # All the information is collected underneath the Controllers key
         data = data['Controllers']
 
-        for controller in data:
-            response = controller['Response Data']
-            
-            handle_common_controller(response)
-            if response['Version']['Driver Name'] == 'megaraid_sas':
-                handle_megaraid_controller(response)
-            elif response['Version']['Driver Name'] == 'mpt3sas':
-                handle_sas_controller(response)
+        # MegaRAID physical drive metrics are kept apart, to cache them
+        drive_registry = registry
+        cached_drives = None
+        if args.cache_file:
+            fingerprint = controller_fingerprint(data)
+            cached_drives = load_drive_cache(args.cache_file, fingerprint, args.max_age)
+            drive_registry = MetricRegistry(metric_prefix)
+        refresh_drives = cached_drives is None
+
+        # Detailed information of the physical drives, by controller index
+        physical_drive_info = None
+        if refresh_drives and not args.stream:
+            with instrumentation.phase('drives'):
+                physical_drive_info = get_physical_drive_info(storcli_path, data, args.parallel)
+
+        with instrumentation.phase('metrics'):
+            for controller in data:
+                response = controller['Response Data']
+
+                handle_common_controller(registry, response)
+                if response['Version']['Driver Name'] == 'megaraid_sas':
+                    handle_megaraid_controller(registry,
+                                               response,
+                                               physical_drive_info=physical_drive_info,
+                                               drive_registry=drive_registry)
+                elif response['Version']['Driver Name'] == 'mpt3sas':
+                    handle_sas_controller(registry, response)
+
+        if refresh_drives and args.stream:
+            with instrumentation.phase('drives'):
+                stream_physical_drives(storcli_path, drive_registry, data, args.parallel)
+
+        if args.cache_file:
+            if refresh_drives:
+                save_drive_cache(args.cache_file, fingerprint, drive_registry)
+            else:
+                drive_registry = cached_drives
+            registry.merge(drive_registry)
     except KeyError:
         pass
 
-    print_all_metrics(metric_list)
+    with instrumentation.phase('format'):
+        return registry.exposition()
+
 
-def handle_common_controller(response):
-    (controller_index, baselabel) = get_basic_controller_info(response)
+def handle_common_controller(registry, response):
+    (controller_index, baselabel) = get_basic_controller_info(registry, response)
 
     # Split up string to not trigger CodeSpell issues
     if 'ROC temperature(Degree Celc' + 'ius)' in response['HwCfg'].keys():
         response['HwCfg']['ROC temperature(Degree Celsius)'] = response['HwCfg'].pop('ROC temperature(Degree Celc' + 'ius)')
-    add_metric('temperature', baselabel, int(response['HwCfg']['ROC temperature(Degree Celsius)']))
+    registry.add('temperature', baselabel,
+                 int(response['HwCfg']['ROC temperature(Degree Celsius)']))
+
 
-def handle_sas_controller(response):
-    (controller_index, baselabel) = get_basic_controller_info(response)
-    add_metric('healthy', baselabel, int(response['Status']['Controller Status'] == 'OK'))
-    add_metric('ports', baselabel, response['HwCfg']['Backend Port Count'])
+def handle_sas_controller(registry, response):
+    (controller_index, baselabel) = get_basic_controller_info(registry, response)
+    registry.add('healthy', baselabel, int(response['Status']['Controller Status'] == 'OK'))
+    registry.add('ports', baselabel, response['HwCfg']['Backend Port Count'])
     try:
         # The number of physical disks is half of the number of items in this dict
         # Every disk is listed twice - once for basic info, again for detailed info
-        add_metric('physical_drives', baselabel,
-                   len(response['Physical Device Information'].keys()) / 2)
+        registry.add('physical_drives', baselabel,
+                     len(response['Physical Device Information'].keys()) / 2)
     except AttributeError:
         pass
 
     for key, basic_disk_info in response['Physical Device Information'].items():
         if 'Detailed Information' in key:
             continue
-        create_metrcis_of_physical_drive(basic_disk_info[0],
+        create_metrcis_of_physical_drive(registry, basic_disk_info[0],
                                          response['Physical Device Information'], controller_index)
 
 
-def handle_megaraid_controller(response):
-    (controller_index, baselabel) = get_basic_controller_info(response)
+def handle_megaraid_controller(registry, response, physical_drive_info=None, drive_registry=None):
+    """Create the metrics of a MegaRAID controller.
+
+    The physical drive metrics are created from physical_drive_info, the
+    detailed physical drive information by controller index, and left out
+    without it.
+    """
+    (controller_index, baselabel) = get_basic_controller_info(registry, response)
 
     # BBU Status Optimal value is 0 for cachevault and 32 for BBU
-    add_metric('battery_backup_healthy', baselabel,
-               int(response['Status']['BBU Status'] in [0, 32]))
-    add_metric('degraded', baselabel, int(response['Status']['Controller Status'] == 'Degraded'))
-    add_metric('failed', baselabel, int(response['Status']['Controller Status'] == 'Failed'))
-    add_metric('healthy', baselabel, int(response['Status']['Controller Status'] == 'Optimal'))
-    add_metric('drive_groups', baselabel, response['Drive Groups'])
-    add_metric('virtual_drives', baselabel, response['Virtual Drives'])
-    add_metric('physical_drives', baselabel, response['Physical Drives'])
-    add_metric('ports', baselabel, response['HwCfg']['Backend Port Count'])
-    add_metric('scheduled_patrol_read', baselabel,
-               int('hrs' in response['Scheduled Tasks']['Patrol Read Reoccurrence']))
+    registry.add('battery_backup_healthy', baselabel,
+                 int(response['Status']['BBU Status'] in [0, 32]))
+    registry.add('degraded', baselabel, int(response['Status']['Controller Status'] == 'Degraded'))
+    registry.add('failed', baselabel, int(response['Status']['Controller Status'] == 'Failed'))
+    registry.add('healthy', baselabel, int(response['Status']['Controller Status'] == 'Optimal'))
+    registry.add('drive_groups', baselabel, response['Drive Groups'])
+    registry.add('virtual_drives', baselabel, response['Virtual Drives'])
+    registry.add('physical_drives', baselabel, response['Physical Drives'])
+    registry.add('ports', baselabel, response['HwCfg']['Backend Port Count'])
+    registry.add('scheduled_patrol_read', baselabel,
+                 int('hrs' in response['Scheduled Tasks']['Patrol Read Reoccurrence']))
     for cvidx, cvinfo in enumerate(response['Cachevault_Info']):
-        add_metric('cv_temperature', baselabel + ',cvidx="' + str(cvidx) + '"', int(cvinfo['Temp'].replace('C','')))
+        registry.add('cv_temperature', baselabel + (('cvidx', cvidx), ),
+                     int(cvinfo['Temp'].replace('C', '')))
 
     time_difference_seconds = -1
     system_time = datetime.strptime(response['Basics'].get('Current System Date/time'),
@@ -111,7 +173,7 @@ def handle_megaraid_controller(response):
                                         "%m/%d/%Y, %H:%M:%S")
     if system_time and controller_time:
         time_difference_seconds = abs(system_time - controller_time).seconds
-        add_metric('time_difference', baselabel, time_difference_seconds)
+        registry.add('time_difference', baselabel, time_difference_seconds)
 
     for virtual_drive in response['VD LIST']:
         vd_position = virtual_drive.get('DG/VD')
@@ -119,50 +181,208 @@ def handle_megaraid_controller(response):
         if vd_position:
             drive_group = vd_position.split('/')[0]
             volume_group = vd_position.split('/')[1]
-        vd_baselabel = 'controller="{0}",DG="{1}",VG="{2}"'.format(controller_index, drive_group,
-                                                                volume_group)
-        vd_info_label = vd_baselabel + ',name="{0}",cache="{1}",type="{2}",state="{3}"'.format(
-            str(virtual_drive.get('Name')).strip(),
-            str(virtual_drive.get('Cache')).strip(),
-            str(virtual_drive.get('TYPE')).strip(),
-            str(virtual_drive.get('State')).strip())
-        add_metric('vd_info', vd_info_label, 1)
-
-    if response['Physical Drives'] > 0:
-        data = get_storcli_json('/cALL/eALL/sALL show all J')
-        drive_info = data['Controllers'][controller_index]['Response Data']
+        vd_baselabel = (('controller', controller_index), ('DG', drive_group), ('VG',
+                                                                                volume_group))
+        vd_info_label = vd_baselabel + (
+            ('name', str(virtual_drive.get('Name')).strip()),
+            ('cache', str(virtual_drive.get('Cache')).strip()),
+            ('type', str(virtual_drive.get('TYPE')).strip()),
+            ('state', str(virtual_drive.get('State')).strip()),
+        )
+        registry.add('vd_info', vd_info_label, 1)
+
+    if physical_drive_info is None:
+        return
+    if drive_registry is None:
+        drive_registry = registry
+    drive_info = physical_drive_info.get(controller_index, {})
     for physical_drive in response['PD LIST']:
-        create_metrcis_of_physical_drive(physical_drive, drive_info, controller_index)
+        create_metrcis_of_physical_drive(drive_registry, physical_drive, drive_info,
+                                         controller_index)
+
+
+def controller_fingerprint(controllers):
+    """Fingerprint the state of all controllers from '/cALL show all J'.
+
+    The fingerprint covers the drive counts, the controller status including its
+    error counters, and the state of every physical and virtual drive.
+    """
+    state = []
+    for controller in controllers:
+        response = controller['Response Data']
+        state.append([
+            response['Basics']['Controller'],
+            response.get('Status'),
+            response.get('Drive Groups'),
+            response.get('Virtual Drives'),
+            response.get('Physical Drives'),
+            [[vd.get('DG/VD'), vd.get('State')] for vd in response.get('VD LIST', [])],
+            [[pd.get('EID:Slt'), pd.get('DID'),
+              pd.get('State'), pd.get('DG')] for pd in response.get('PD LIST', [])],
+        ])
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_drive_cache(path, fingerprint, max_age):
+    """Load cached physical drive metrics.
+
+    Returns:
+        MetricRegistry of the cached metrics, None if there is no cache, the
+        controller fingerprint changed or the cache is older than max_age seconds.
+    """
+    try:
+        with open(path) as cache_file:
+            cache = json.load(cache_file)
+        if cache['fingerprint'] != fingerprint or time.time() - cache['time'] >= max_age:
+            return None
+        return MetricRegistry.load(metric_prefix, cache['metrics'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_drive_cache(path, fingerprint, registry):
+    """Atomically replace the physical drive metrics cache."""
+    cache = {
+        'fingerprint': fingerprint,
+        'time': time.time(),
+        'metrics': registry.dump(),
+    }
+    try:
+        textfile_writer.write_atomic(path, json.dumps(cache))
+    except OSError as e:
+        print('storcli: unable to write cache {0}: {1}'.format(path, e), file=sys.stderr)
+
+
+def index_by_controller(data):
+    """Index the response data of a storcli command by controller index."""
+    responses = {}
+    for position, controller in enumerate(data['Controllers']):
+        controller_index = controller['Command Status'].get('Controller', position)
+        responses[controller_index] = controller.get('Response Data', {})
+    return responses
+
+
+def get_physical_drive_info(storcli_path, controllers, parallel=False):
+    """Get the detailed physical drive information of all MegaRAID controllers.
+
+    Without parallel, the information of all controllers is queried at once
+    with '/cALL/eALL/sALL show all J', and only if any controller has physical
+    drives.
+
+    Returns:
+        (dict) response data of the drive information, by controller index.
+    """
+    if parallel:
+        return get_physical_drive_info_parallel(storcli_path, controllers)
+    if not get_megaraid_drive_controllers(controllers):
+        return {}
+    return index_by_controller(get_storcli_json(storcli_path, '/cALL/eALL/sALL show all J'))
+
+
+def get_megaraid_drive_controllers(controllers):
+    """List the indexes of the MegaRAID controllers with physical drives."""
+    return [
+        controller['Response Data']['Basics']['Controller'] for controller in controllers
+        if controller['Response Data']['Version']['Driver Name'] == 'megaraid_sas'
+        and controller['Response Data']['Physical Drives'] > 0
+    ]
+
+
+def get_physical_drive_info_parallel(storcli_path, controllers):
+    """Query the detailed physical drive information of each MegaRAID controller
+    in parallel, using one '/cN/eALL/sALL show all J' call per controller."""
+    indexes = get_megaraid_drive_controllers(controllers)
+    if not indexes:
+        return {}
+
+    responses = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(indexes)) as pool:
+        for data in pool.map(
+                lambda index: get_storcli_json(storcli_path, '/c{0}/eALL/sALL show all J'.format(
+                    index)), indexes):
+            responses.update(index_by_controller(data))
+    return responses
+
+
+def stream_physical_drives(storcli_path, registry, controllers, parallel=False):
+    """Create the physical drive metrics of all MegaRAID controllers while the
+    detailed drive information is read from storcli.
+
+    Only the information of a single drive is held in memory at any time.
+    """
+    indexes = get_megaraid_drive_controllers(controllers)
+    if not indexes:
+        return
+
+    if not parallel:
+        handle_physical_drive_stream(storcli_path, registry, '/cALL/eALL/sALL show all J', indexes)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(indexes)) as pool:
+        list(
+            pool.map(
+                lambda index: handle_physical_drive_stream(
+                    storcli_path, registry, '/c{0}/eALL/sALL show all J'.format(index), indexes),
+                indexes))
+
+
+def handle_physical_drive_stream(storcli_path, registry, storcli_args, controller_indexes):
+    """Create physical drive metrics from a streamed drive information command.
+
+    storcli lists the basic information of a drive under 'Drive /cN/eE/sS',
+    immediately followed by its detailed information.
+    """
+    pending = collections.OrderedDict()
+    for key, value in stream_storcli_json(storcli_path, storcli_args):
+        m = drive_key_re.match(key)
+        if m is None or int(m.group(1)) not in controller_indexes:
+            continue
+        controller_index = int(m.group(1))
+
+        if not key.endswith(DETAILED_INFORMATION_SUFFIX):
+            pending[key] = value
+            continue
 
+        basic_info = pending.pop(key[:-len(DETAILED_INFORMATION_SUFFIX)], None)
+        if basic_info:
+            create_metrcis_of_physical_drive(registry, basic_info[0], {key: value},
+                                             controller_index)
 
-def get_basic_controller_info(response):
+    # Drives without detailed information
+    for key, basic_info in pending.items():
+        if basic_info:
+            create_metrcis_of_physical_drive(registry, basic_info[0], {},
+                                             int(drive_key_re.match(key).group(1)))
+
+
+def get_basic_controller_info(registry, response):
     controller_index = response['Basics']['Controller']
-    baselabel = 'controller="{0}"'.format(controller_index)
+    baselabel = (('controller', controller_index), )
 
-    controller_info_label = baselabel + ',model="{0}",serial="{1}",fwversion="{2}"'.format(
-        str(response['Basics']['Model']).strip(),
-        str(response['Basics']['Serial Number']).strip(),
-        str(response['Version']['Firmware Version']).strip(),
+    controller_info_label = baselabel + (
+        ('model', str(response['Basics']['Model']).strip()),
+        ('serial', str(response['Basics']['Serial Number']).strip()),
+        ('fwversion', str(response['Version']['Firmware Version']).strip()),
     )
-    add_metric('controller_info', controller_info_label, 1)
+    registry.add('controller_info', controller_info_label, 1)
 
     return (controller_index, baselabel)
 
 
-def create_metrcis_of_physical_drive(physical_drive, detailed_info_array, controller_index):
+def create_metrcis_of_physical_drive(registry, physical_drive, detailed_info_array,
+                                     controller_index):
     enclosure = physical_drive.get('EID:Slt').split(':')[0]
     slot = physical_drive.get('EID:Slt').split(':')[1]
 
-    pd_baselabel = 'controller="{0}",enclosure="{1}",slot="{2}"'.format(controller_index, enclosure,
-                                                                     slot)
-    pd_info_label = pd_baselabel + \
-        ',disk_id="{0}",interface="{1}",media="{2}",model="{3}",DG="{4}",state="{5}"'.format(
-            str(physical_drive.get('DID')).strip(),
-            str(physical_drive.get('Intf')).strip(),
-            str(physical_drive.get('Med')).strip(),
-            str(physical_drive.get('Model')).strip(),
-            str(physical_drive.get('DG')).strip(),
-            str(physical_drive.get('State')).strip())
+    pd_baselabel = (('controller', controller_index), ('enclosure', enclosure), ('slot', slot))
+    pd_info_label = pd_baselabel + (
+        ('disk_id', str(physical_drive.get('DID')).strip()),
+        ('interface', str(physical_drive.get('Intf')).strip()),
+        ('media', str(physical_drive.get('Med')).strip()),
+        ('model', str(physical_drive.get('Model')).strip()),
+        ('DG', str(physical_drive.get('DG')).strip()),
+        ('state', str(physical_drive.get('State')).strip()),
+    )
 
     drive_identifier = 'Drive /c' + str(controller_index) + '/e' + str(enclosure) + '/s' + str(
         slot)
@@ -174,66 +394,253 @@ def create_metrcis_of_physical_drive(physical_drive, detailed_info_array, contro
         attributes = info[drive_identifier + ' Device attributes']
         settings = info[drive_identifier + ' Policies/Settings']
 
-        add_metric('pd_shield_counter', pd_baselabel, state['Shield Counter'])
-        add_metric('pd_media_errors', pd_baselabel, state['Media Error Count'])
-        add_metric('pd_other_errors', pd_baselabel, state['Other Error Count'])
-        add_metric('pd_predictive_errors', pd_baselabel, state['Predictive Failure Count'])
-        add_metric('pd_smart_alerted', pd_baselabel,
-                   int(state['S.M.A.R.T alert flagged by drive'] == 'Yes'))
-        add_metric('pd_link_speed_gbps', pd_baselabel, attributes['Link Speed'].split('.')[0])
-        add_metric('pd_device_speed_gbps', pd_baselabel, attributes['Device Speed'].split('.')[0])
-        add_metric('pd_commissioned_spare', pd_baselabel,
-                   int(settings['Commissioned Spare'] == 'Yes'))
-        add_metric('pd_emergency_spare', pd_baselabel, int(settings['Emergency Spare'] == 'Yes'))
-        pd_info_label += ',firmware="{0}"'.format(attributes['Firmware Revision'].strip())
+        registry.add('pd_shield_counter', pd_baselabel, state['Shield Counter'])
+        registry.add('pd_media_errors', pd_baselabel, state['Media Error Count'])
+        registry.add('pd_other_errors', pd_baselabel, state['Other Error Count'])
+        registry.add('pd_predictive_errors', pd_baselabel, state['Predictive Failure Count'])
+        registry.add('pd_smart_alerted', pd_baselabel,
+                     int(state['S.M.A.R.T alert flagged by drive'] == 'Yes'))
+        registry.add('pd_link_speed_gbps', pd_baselabel, attributes['Link Speed'].split('.')[0])
+        registry.add('pd_device_speed_gbps', pd_baselabel,
+                     attributes['Device Speed'].split('.')[0])
+        registry.add('pd_commissioned_spare', pd_baselabel,
+                     int(settings['Commissioned Spare'] == 'Yes'))
+        registry.add('pd_emergency_spare', pd_baselabel, int(settings['Emergency Spare'] == 'Yes'))
+        pd_info_label += (('firmware', attributes['Firmware Revision'].strip()), )
     except KeyError:
         pass
-    add_metric('pd_info', pd_info_label, 1)
-
-
-def add_metric(name, labels, value):
-    global metric_list
+    registry.add('pd_info', pd_info_label, 1)
+
+
+class MetricRegistry(object):
+    """Samples of MegaRAID metrics, written in the Prometheus text format.
+
+    Every distinct label set is rendered and escaped once, and shared by all
+    samples using it.  Samples are kept per metric name, in the order the
+    names were first added, mapping the rendered label set to a float value.
+    Adding a sample twice keeps the last value, as a duplicate series would
+    make the whole output invalid.
+    """
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self._metrics = collections.OrderedDict()
+        self._label_sets = {}
+
+    def add(self, name, labels, value):
+        """Add a sample, ignoring values that are not numeric.
+
+        Args:
+            name: metric name without prefix.
+            labels: tuple of (name, value) label pairs.
+            value: sample value, converted with float().
+        """
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+
+        rendered = self._label_sets.get(labels)
+        if rendered is None:
+            rendered = self._label_sets.setdefault(
+                labels, ','.join('{0}="{1}"'.format(k, exposition.escape_label_value(v))
+                                 for k, v in labels))
+
+        samples = self._metrics.get(name)
+        if samples is None:
+            samples = self._metrics.setdefault(name, {})
+        samples[rendered] = value
+
+    def merge(self, other):
+        """Add all samples of another registry."""
+        for name, samples in other._metrics.items():
+            self._metrics.setdefault(name, {}).update(samples)
+
+    def dump(self):
+        """Get all samples as a JSON serializable {name: {labels: value}} dict."""
+        return self._metrics
+
+    @classmethod
+    def load(cls, prefix, metrics):
+        """Create a registry from the result of dump()."""
+        registry = cls(prefix)
+        for name, samples in metrics.items():
+            registry._metrics[name] = {labels: float(value) for labels, value in samples.items()}
+        return registry
+
+    def exposition(self):
+        """Get all metrics as exposition.Exposition."""
+        metrics = exposition.Exposition()
+        for name, samples in self._metrics.items():
+            metric = self.prefix + name
+            metrics.family(metric, 'MegaRAID {0}'.format(name.replace('_', ' ')))
+            for labels, value in samples.items():
+                metrics.add(metric, value, '{' + labels + '}')
+        return metrics
+
+
+def start_storcli(storcli_path, storcli_args, stderr):
+    """Start storcli, exiting if it is not installed or not executable."""
+    storcli_cmd = shlex.split(storcli_path + ' ' + storcli_args)
     try:
-        metric_list[name].append({
-            'labels': labels,
-            'value': float(value),
-        })
-    except ValueError:
-        pass
-
-
-def print_all_metrics(metrics):
-    for metric, measurements in metrics.items():
-        print('# HELP {0}{1} MegaRAID {2}'.format(metric_prefix, metric, metric.replace('_', ' ')))
-        print('# TYPE {0}{1} gauge'.format(metric_prefix, metric))
-        for measurement in measurements:
-            if measurement['value'] != 'Unknown':
-                print('{0}{1}{2} {3}'.format(metric_prefix, metric, '{' + measurement['labels'] + '}',
-                                         measurement['value']))
+        return subprocess.Popen(storcli_cmd, shell=False, stdout=subprocess.PIPE, stderr=stderr)
+    except OSError as e:
+        sys.exit('storcli: unable to run {0}: {1}'.format(storcli_path, e.strerror))
 
 
-def get_storcli_json(storcli_args):
-    """Get storcli output in JSON format."""
-    # Check if storcli is installed and executable
-    if not (os.path.isfile(storcli_path) and os.access(storcli_path, os.X_OK)):
-        SystemExit(1)
-    storcli_cmd = shlex.split(storcli_path + ' ' + storcli_args)
-    proc = subprocess.Popen(
-        storcli_cmd, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output_json = proc.communicate()[0]
+def get_storcli_json(storcli_path, storcli_args):
+    """Get storcli output in JSON format, exiting if the command failed."""
+    with instrumentation.command():
+        proc = start_storcli(storcli_path, storcli_args, subprocess.PIPE)
+        output_json = proc.communicate()[0]
+    instrumentation.parsed(len(output_json))
     data = json.loads(output_json.decode("utf-8"))
 
-    if data["Controllers"][0]["Command Status"]["Status"] != "Success":
-        SystemExit(1)
+    status = data["Controllers"][0]["Command Status"]
+    if status["Status"] != "Success":
+        sys.exit('storcli: {0} failed: {1}'.format(storcli_args,
+                                                   status.get("Description", status["Status"])))
     return data
 
 
+class JSONStream(object):
+    """Incremental reader of a JSON document from a binary file object.
+
+    The document is walked with object_keys() and array_items(), which require
+    the caller to consume each member or item, either with value() or by
+    walking into it.  Only the unconsumed part of the input is buffered.
+    """
+
+    def __init__(self, stream, chunk_size=65536):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+        instrumentation.parsed(len(chunk))
+        self._buf = self._buf[self._pos:] + self._utf8.decode(chunk, final=self._eof)
+        self._pos = 0
+        return not self._eof
+
+    def _peek(self):
+        """Skip whitespace and return the next character, '' at the end."""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill() and self._pos >= len(self._buf):
+                return ''
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError('expected {0!r} in JSON stream'.format(char))
+        self._pos += 1
+
+    def value(self):
+        """Decode the next complete value."""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # A number cut off by the end of the buffer continues in the next
+                # chunk, and may even have stopped early at e.g. '.' or 'e'.
+                if self._eof or (end < len(self._buf) and self._buf[end] not in '0123456789.eE+-'):
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def _items(self, start, end):
+        self._expect(start)
+        if self._peek() == end:
+            self._pos += 1
+            return
+        while True:
+            yield
+            char = self._peek()
+            self._pos += 1
+            if char == end:
+                return
+            if char != ',':
+                raise ValueError('expected {0!r} or {1!r} in JSON stream'.format(',', end))
+
+    def object_keys(self):
+        """Iterate over the keys of the object at the current position."""
+        for _ in self._items('{', '}'):
+            key = self.value()
+            self._expect(':')
+            yield key
+
+    def array_items(self):
+        """Iterate over the items of the array at the current position."""
+        return self._items('[', ']')
+
+
+def stream_storcli_json(storcli_path, storcli_args):
+    """Get storcli output in JSON format, one Response Data member at a time.
+
+    Yields:
+        (key, value) of the members of the Response Data of every controller.
+    """
+    with instrumentation.command():
+        proc = start_storcli(storcli_path, storcli_args, subprocess.DEVNULL)
+        try:
+            stream = JSONStream(proc.stdout)
+            for key in stream.object_keys():
+                if key != 'Controllers':
+                    stream.value()
+                    continue
+                for _ in stream.array_items():
+                    for controller_key in stream.object_keys():
+                        if controller_key != 'Response Data':
+                            stream.value()
+                            continue
+                        for response_key in stream.object_keys():
+                            yield response_key, stream.value()
+        finally:
+            proc.stdout.close()
+            proc.wait()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=DESCRIPTION,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--storcli_path',
+                        default='/opt/MegaRAID/storcli/storcli64',
+                        help='path to StorCLi binary')
+    parser.add_argument(
+        '--parallel',
+        action='store_true',
+        help='query the physical drives of each controller separately and in parallel')
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='process the physical drive information while it is read, to bound memory usage')
+    parser.add_argument(
+        '--cache_file',
+        help='cache the physical drive metrics in this file and only query the drives again '
+        'once the controller state changes')
+    parser.add_argument(
+        '--max_age',
+        type=float,
+        default=3600,
+        help='seconds after which cached physical drive metrics are refreshed anyway')
+    parser.add_argument('--version', action='version', version='%(prog)s {0}'.format(VERSION))
+    instrumentation.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
-    PARSER = argparse.ArgumentParser(
-        description=DESCRIPTION, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    PARSER.add_argument(
-        '--storcli_path', default='/opt/MegaRAID/storcli/storcli64', help='path to StorCLi binary')
-    PARSER.add_argument('--version', action='version', version='%(prog)s {0}'.format(VERSION))
-    ARGS = PARSER.parse_args()
-
-    main(ARGS)
+    main(parse_args())
@@ -0,0 +1,28 @@
+import os
+import struct
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import btrfs_stats  # noqa: E402
+
+FSID = bytes.fromhex('0c1d2e3f4a5b4c6d8e7f0123456789ab')
+
+
+def fs_info_ioctl(fd, request, buf, mutate):
+    struct.pack_into('=QQ16s', buf, 0, 3, 2, FSID)
+    return 0
+
+
+class FsInfoTest(unittest.TestCase):
+
+    def test_fsid_as_hex(self):
+        with mock.patch.object(btrfs_stats.fcntl, 'ioctl', fs_info_ioctl):
+            self.assertEqual(btrfs_stats.get_btrfs_fs_info(0),
+                             (3, '0c1d2e3f4a5b4c6d8e7f0123456789ab'))
+
+
+if __name__ == '__main__':
+    unittest.main()
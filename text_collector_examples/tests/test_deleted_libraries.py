@@ -0,0 +1,104 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import deleted_libraries  # noqa: E402
+
+LIBRARY = '/usr/lib/x86_64-linux-gnu/libssl.so.3'
+
+
+def write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def stat_line(pid, starttime, vsize):
+    return ('{0} (app) S 1 {0} {0} 0 -1 4194560 100 0 0 0 1 1 0 0 20 0 1 0 '
+            '{1} {2} 300 18446744073709551615\n'.format(pid, starttime, vsize))
+
+
+def status_lines(vmlib):
+    return 'Name:\tapp\nVmExe:\t      16 kB\nVmLib:\t{0:8d} kB\n'.format(vmlib)
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = os.path.join(directory.name, 'proc')
+        self.rootfs = os.path.join(directory.name, 'rootfs')
+        self.cache_file = os.path.join(directory.name, 'cache.json')
+        os.makedirs(os.path.dirname(self.rootfs + LIBRARY))
+        write(self.rootfs + LIBRARY, '')
+        self.pid_dir = os.path.join(self.root, '1')
+        os.makedirs(self.pid_dir)
+        os.symlink(self.rootfs, os.path.join(self.pid_dir, 'root'))
+        write(os.path.join(self.pid_dir, 'stat'), stat_line(1, 1000, 4096))
+        write(os.path.join(self.pid_dir, 'status'), status_lines(4))
+        write(os.path.join(self.pid_dir, 'maps'),
+              '7f0000000000-7f0000001000 r-xp 00000000 fd:01 12         {0}\n'.format(LIBRARY))
+
+    def collect(self, *argv):
+        args = deleted_libraries.parse_args(
+            ['--proc-root', self.root, '--cache-file', self.cache_file] + list(argv))
+        return deleted_libraries.collect(args).render()
+
+    def test_cache_format(self):
+        self.collect()
+        with open(self.cache_file) as f:
+            cache = json.load(f)
+        self.assertEqual(cache['all_files'], False)
+        self.assertEqual(list(cache['processes']), ['1'])
+        self.assertEqual(cache['processes']['1']['identity'], [1000, 4])
+        self.assertEqual(deleted_libraries.load_cache(self.cache_file), cache['processes'])
+        self.assertEqual(deleted_libraries.load_cache(self.cache_file, all_files=True), {})
+
+    def test_process_with_same_identity_is_revalidated(self):
+        self.collect()
+        # A larger heap, the scan of the first run is kept and its library
+        # found deleted without reading the maps again
+        write(os.path.join(self.pid_dir, 'stat'), stat_line(1, 1000, 1 << 20))
+        os.unlink(self.rootfs + LIBRARY)
+        with mock.patch.object(deleted_libraries, 'scan_maps') as scan_maps:
+            output = self.collect()
+        scan_maps.assert_not_called()
+        self.assertIn('library_name="libssl.so.3"} 1\n', output)
+
+    def test_process_unmapping_library_is_scanned(self):
+        self.collect()
+        write(os.path.join(self.pid_dir, 'status'), status_lines(0))
+        write(os.path.join(self.pid_dir, 'maps'), '')
+        os.unlink(self.rootfs + LIBRARY)
+        output = self.collect()
+        self.assertNotIn('libssl', output)
+
+    def test_old_scan_is_redone(self):
+        self.collect()
+        write(os.path.join(self.pid_dir, 'maps'), '')
+        os.unlink(self.rootfs + LIBRARY)
+        output = self.collect('--cache-max-age', '0')
+        self.assertNotIn('libssl', output)
+
+    def test_process_with_other_start_time_is_scanned(self):
+        self.collect()
+        write(os.path.join(self.pid_dir, 'stat'), stat_line(1, 2000, 4096))
+        write(os.path.join(self.pid_dir, 'maps'), '')
+        os.unlink(self.rootfs + LIBRARY)
+        output = self.collect()
+        self.assertNotIn('libssl', output)
+
+    def test_previous_format_is_ignored(self):
+        write(self.cache_file, json.dumps({'all_files': False, '1': {
+            'identity': [1000, 4096], 'deleted': {'/lib/libgone.so': 1}, 'mapped': {}}}))
+        self.assertEqual(deleted_libraries.load_cache(self.cache_file), {})
+        self.assertNotIn('libgone', self.collect())
+
+
+if __name__ == '__main__':
+    unittest.main()
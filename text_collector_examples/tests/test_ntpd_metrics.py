@@ -0,0 +1,261 @@
+import math
+import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ntpd_metrics  # noqa: E402
+
+
+class FakeResponder(object):
+    """A UDP server answering requests on a thread.
+
+    respond(request) returns the packets to answer a request with.
+    """
+
+    def __init__(self, respond, family=socket.AF_INET, address=('127.0.0.1', 0)):
+        self.respond = respond
+        self.requests = []
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.bind(address)
+        self.sock.settimeout(0.05)
+        if family == socket.AF_INET:
+            self.port = self.sock.getsockname()[1]
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while not self.stopped.is_set():
+            try:
+                request, address = self.sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            self.requests.append(request)
+            for packet in self.respond(request):
+                self.sock.sendto(packet, address)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.sock.close()
+
+
+def control_packet(request, data, offset=0, more=False, status=0, error=False):
+    _, opcode, sequence, _, association, _, _ = ntpd_metrics.control_header.unpack_from(request)
+    flags = ntpd_metrics.control_response | opcode
+    if more:
+        flags |= ntpd_metrics.control_more
+    if error:
+        flags |= ntpd_metrics.control_error
+    packet = ntpd_metrics.control_header.pack(
+        2 << 3 | 6, flags, sequence, status, association, offset, len(data)) + data
+    return packet + b'\0' * (-len(packet) % 4)
+
+
+# Association ID to peer status word and variables. The peer selection is in
+# bits 8-10 of the status word: 6 is the system peer, 4 a candidate and 1 a
+# falseticker.
+PEERS = {
+    101: (0x961a, b'srcadr=192.0.2.1, refid=203.0.113.5, stratum=2, hmode=3, '
+                  b'delay=1.250, offset=-0.125, jitter=0.050'),
+    102: (0x941a, b'srcadr=192.0.2.2, refid=GPS, stratum=1, hmode=3, '
+                  b'delay=10.500, offset=2.000, jitter=0.400'),
+    103: (0x911a, b'srcadr=192.0.2.3, refid=LOCL, stratum=10, hmode=3, '
+                  b'delay=0.000, offset=0.000, jitter=0.000'),
+    104: (0x9114, b'srcadr=192.0.2.4, refid=198.51.100.7, stratum=3, hmode=3, '
+                  b'delay=30.000, offset=45.000, jitter=9.000'),
+}
+SYSTEM = b'offset=-0.104, sys_jitter=0.061, rootdisp=10.512, rootdelay=2.345'
+
+
+def ntpd(request, system=SYSTEM):
+    _, opcode, _, _, association, _, _ = ntpd_metrics.control_header.unpack_from(request)
+    if opcode == ntpd_metrics.control_op_readstat:
+        data = b''.join(struct.pack('!HH', a, PEERS[a][0]) for a in sorted(PEERS))
+        return [control_packet(request, data)]
+    if association == 0:
+        return [control_packet(request, system)]
+    # Peer variables in three fragments, the last one first
+    data = PEERS[association][1]
+    cuts = [0, 20, 40, len(data)]
+    fragments = [control_packet(request, data[start:end], start, end != len(data))
+                 for start, end in zip(cuts, cuts[1:])]
+    return fragments[::-1]
+
+
+class ControlClientTest(unittest.TestCase):
+
+    def serve(self, respond):
+        responder = FakeResponder(respond)
+        self.addCleanup(responder.close)
+        return responder
+
+    def test_fragmented_replies_and_select_bits(self):
+        responder = self.serve(ntpd)
+        peers, system = ntpd_metrics.collect_control('127.0.0.1', responder.port, 1.0)
+        self.assertEqual(peers, [
+            ntpd_metrics.Peer('192.0.2.1', '203.0.113.5', '2', 'u', 6, 1.25, -0.125, 0.05),
+            ntpd_metrics.Peer('192.0.2.2', '.GPS.', '1', 'u', 4, 10.5, 2.0, 0.4),
+            ntpd_metrics.Peer('192.0.2.4', '198.51.100.7', '3', 'u', 1, 30.0, 45.0, 9.0),
+        ])
+        self.assertEqual(system, [
+            ('offset', -0.104), ('sys_jitter', 0.061), ('rootdisp', 10.512),
+            ('rootdelay', 2.345)])
+
+    def test_reassembles_fragments_of_a_single_query(self):
+        data = b'x' * 10 + b'y' * 10
+
+        def respond(request):
+            return [control_packet(request, data[10:], 10),
+                    control_packet(request, data[:10], 0, more=True)]
+
+        responder = self.serve(respond)
+        client = ntpd_metrics.ControlClient('127.0.0.1', responder.port, 1.0)
+        self.addCleanup(client.close)
+        self.assertEqual(client.query([(ntpd_metrics.control_op_readvar, 0, b'')]), [data])
+
+    def test_error_response(self):
+        responder = self.serve(
+            lambda request: [control_packet(request, b'', status=5 << 8, error=True)])
+        client = ntpd_metrics.ControlClient('127.0.0.1', responder.port, 1.0)
+        self.addCleanup(client.close)
+        with self.assertRaises(ntpd_metrics.ControlError):
+            client.query([(ntpd_metrics.control_op_readvar, 0, b'')])
+
+    def test_parse_error_falls_back(self):
+        responder = self.serve(lambda request: ntpd(request, b'offset=garbage'))
+        args = ntpd_metrics.parse_args([
+            '--backend', 'control', '--host', '127.0.0.1', '--port', str(responder.port)])
+        with self.assertRaisesRegex(RuntimeError, 'Failed to query the NTP daemon'):
+            ntpd_metrics.collect(args)
+
+
+def chrony_float(value):
+    """Encode a float like chronyd, with a 7 bit exponent and 25 bit coefficient."""
+    if value == 0:
+        return struct.pack('!I', 0)
+    mantissa, exp = math.frexp(value)
+    coef = round(mantissa * (1 << 24))
+    exp += 1
+    if abs(coef) == 1 << 24:
+        coef //= 2
+        exp += 1
+    return struct.pack('!I', (exp & 0x7f) << 25 | coef & 0x1ffffff)
+
+
+def chrony_address(family, address):
+    if family == ntpd_metrics.chrony_family_inet4:
+        address = socket.inet_aton(address)
+    return struct.pack('!16sHH', address, family, 0)
+
+
+def chrony_data(length, fields):
+    """Build reply data of length, with the fields at their offsets."""
+    data = bytearray(length)
+    for offset, value in fields:
+        data[offset:offset + len(value)] = value
+    return bytes(data)
+
+
+# Source index to IPAddr, stratum, state, mode, orig_latest_meas, latest_meas
+# and the standard deviation of its sourcestats.
+CHRONY_SOURCES = [
+    (chrony_address(1, '192.0.2.1'), 2, 0, 0, 0.0015, 0.00125, 0.0004),
+    (chrony_address(3, b'GPS'), 0, 4, 2, -0.002, -0.0025, 0.00002),
+]
+
+
+def chronyd(request):
+    _, _, _, _, command, _, sequence, _, _ = ntpd_metrics.chrony_request_header.unpack_from(
+        request)
+    data = request[ntpd_metrics.chrony_request_header.size:]
+    status = ntpd_metrics.chrony_status_success
+    if command == 14:
+        reply = struct.pack('!I', len(CHRONY_SOURCES))
+    elif command == 33:
+        reply = chrony_data(76, [
+            (44, chrony_float(-0.000104)), (48, chrony_float(0.000061)),
+            (64, chrony_float(0.002345)), (68, chrony_float(0.010512))])
+    elif command in (15, 34):
+        address, stratum, state, mode, orig, latest, sd = CHRONY_SOURCES[
+            struct.unpack_from('!i', data)[0]]
+        if command == 15:
+            reply = chrony_data(48, [
+                (0, address), (20, struct.pack('!hHHH', 6, stratum, state, mode)),
+                (36, chrony_float(orig)), (40, chrony_float(latest))])
+        else:
+            reply = chrony_data(56, [(4, address), (36, chrony_float(sd))])
+    elif command == 57 and data[:20] == CHRONY_SOURCES[0][0]:
+        reply = chrony_data(124, [
+            (0, data[:20]), (45, bytes([2])), (56, socket.inet_aton('203.0.113.5')),
+            (76, chrony_float(0.0105))])
+    else:
+        status, reply = 2, b''
+    return [ntpd_metrics.chrony_reply_header.pack(
+        ntpd_metrics.chrony_version, ntpd_metrics.chrony_pkt_type_reply, 0, 0, command, 0,
+        status, 0, 0, 0, sequence, 0, 0) + reply]
+
+
+class ChronyClientTest(unittest.TestCase):
+
+    def assertPeer(self, peer, expected):
+        self.assertEqual(peer[:5], expected[:5])
+        for actual, value in zip(peer[5:], expected[5:]):
+            if value is None:
+                self.assertIsNone(actual)
+            else:
+                self.assertAlmostEqual(actual, value, places=5)
+
+    def assertSystem(self, system):
+        expected = [('offset', -0.104), ('sys_jitter', 0.061), ('rootdisp', 10.512),
+                    ('rootdelay', 2.345)]
+        self.assertEqual([name for name, _ in system], [name for name, _ in expected])
+        for (_, actual), (_, value) in zip(system, expected):
+            self.assertAlmostEqual(actual, value, places=5)
+
+    def test_float_decoding(self):
+        for value in (0.0, 1.0, -1.0, 0.5, 3 * 2.0 ** -13, -0.00125, 123456.0, 1e-9):
+            decoded = ntpd_metrics.chrony_float(chrony_float(value), 0)
+            self.assertAlmostEqual(decoded, value, delta=abs(value) * 2.0 ** -23)
+        self.assertEqual(ntpd_metrics.chrony_float(struct.pack('!I', 2 << 25 | 1 << 23), 0), 1.0)
+        self.assertEqual(
+            ntpd_metrics.chrony_float(struct.pack('!I', 2 << 25 | (1 << 25) - (1 << 23)), 0),
+            -1.0)
+        self.assertEqual(
+            ntpd_metrics.chrony_float(struct.pack('!I', (-10 & 0x7f) << 25 | 3 << 22), 0),
+            3 * 2.0 ** -13)
+
+    def test_udp(self):
+        responder = FakeResponder(chronyd)
+        self.addCleanup(responder.close)
+        peers, system = ntpd_metrics.collect_chrony(None, '127.0.0.1', responder.port, 1.0)
+        commands = sorted({struct.unpack_from('!H', r, 4)[0] for r in responder.requests})
+        self.assertEqual(commands, [14, 15, 33, 34])
+        self.assertEqual(len(peers), 2)
+        self.assertPeer(peers[0], ('192.0.2.1', '', '2', 'u', 6, None, 1.25, 0.4))
+        self.assertPeer(peers[1], ('GPS', '.GPS.', '0', 'l', 4, None, -2.5, 0.02))
+        self.assertSystem(system)
+
+    def test_unix_socket_ntp_data(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'chronyd.sock')
+        responder = FakeResponder(chronyd, socket.AF_UNIX, path)
+        self.addCleanup(responder.close)
+        peers, system = ntpd_metrics.collect_chrony(path, None, None, 1.0)
+        commands = [struct.unpack_from('!H', r, 4)[0] for r in responder.requests]
+        self.assertEqual(commands.count(57), 1)
+        self.assertPeer(peers[0], ('192.0.2.1', '203.0.113.5', '2', 'u', 6, 10.5, 1.25, 0.4))
+        self.assertPeer(peers[1], ('GPS', '.GPS.', '0', 'l', 4, None, -2.5, 0.02))
+        self.assertSystem(system)
+        self.assertEqual(os.listdir(directory.name), ['chronyd.sock'])
+
+
+if __name__ == '__main__':
+    unittest.main()
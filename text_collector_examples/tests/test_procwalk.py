@@ -0,0 +1,74 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import deleted_libraries  # noqa: E402
+import procwalk  # noqa: E402
+
+DELETED_MAPS = ('7f0000000000-7f0000001000 r-xp 00000000 fd:01 12         '
+                '/usr/lib/x86_64-linux-gnu/libssl.so.3 (deleted)\n')
+
+
+def create_process(root, pid, maps=DELETED_MAPS):
+    pid_dir = os.path.join(root, str(pid))
+    os.makedirs(os.path.join(pid_dir, 'fd'))
+    with open(os.path.join(pid_dir, 'maps'), 'w') as f:
+        f.write(maps)
+    with open(os.path.join(pid_dir, 'cmdline'), 'w') as f:
+        f.write('/usr/bin/app\0')
+    with open(os.path.join(pid_dir, 'cgroup'), 'w') as f:
+        f.write('0::/system.slice/app.service\n')
+
+
+def extract_cmdline(pid_fd, pid, results):
+    return procwalk.read_bytes('cmdline', pid_fd)
+
+
+def extract_denied(pid_fd, pid, results):
+    if pid == '2':
+        raise PermissionError(13, 'Permission denied', 'maps')
+    return pid
+
+
+class WalkTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        create_process(self.root, 1)
+        create_process(self.root, 2)
+
+    def test_permission_error_is_no_data(self):
+        processes = procwalk.walk(
+            [('denied', extract_denied), ('cmdline', extract_cmdline)], self.root)
+        self.assertEqual(processes, {
+            '1': {'denied': '1', 'cmdline': b'/usr/bin/app\0'},
+            '2': {'denied': None, 'cmdline': b'/usr/bin/app\0'},
+        })
+
+    def test_deleted_libraries_unreadable_maps(self):
+        scan_maps = deleted_libraries.scan_maps
+        calls = []
+
+        def denied_once(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                raise PermissionError(13, 'Permission denied', 'maps')
+            return scan_maps(*args, **kwargs)
+
+        args = deleted_libraries.parse_args(['--proc-root', self.root, '--by-cgroup'])
+        with mock.patch.object(deleted_libraries, 'scan_maps', denied_once):
+            output = procwalk.collect_plugins(
+                [deleted_libraries.DeletedLibrariesPlugin(args)], self.root).render()
+        self.assertEqual(len(calls), 2)
+        self.assertIn('node_cgroup_processes_linking_deleted_files{cgroup="/system.slice/app.service"} 1\n',
+                      output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'bench'))
+
+import replay  # noqa: E402
+
+
+def fixtures():
+    return sorted(name for name in os.listdir(replay.FIXTURES)
+                  if os.path.isfile(os.path.join(replay.FIXTURES, name, 'collector.json')))
+
+
+class FixtureTest(unittest.TestCase):
+
+    def test_fixtures(self):
+        for name in fixtures():
+            fixture = os.path.join(replay.FIXTURES, name)
+            with open(os.path.join(fixture, 'collector.json')) as f:
+                snapshots = json.load(f)['snapshots']
+            with self.subTest(fixture=name):
+                # The uid of a process is the owner of its directory, which is
+                # the user who checked out the snapshot
+                if '--proc-root' in snapshots and os.getuid() != 0:
+                    self.skipTest('proc snapshots expect processes of root')
+                self.assertEqual(replay.check(fixture), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,314 @@
+import os
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import exposition  # noqa: E402
+import smartmon  # noqa: E402
+
+ATTRIBUTES = '''smartctl 7.3 2022-02-28 r5338 [x86_64-linux-6.1.0] (local build)
+
+=== START OF READ SMART DATA SECTION ===
+SMART Attributes Data Structure revision number: 1
+Vendor Specific SMART Attributes with Thresholds:
+ID# ATTRIBUTE_NAME          FLAG     VALUE WORST THRESH TYPE      UPDATED  WHEN_FAILED RAW_VALUE
+  5 Reallocated_Sector_Ct   0x0033   100   100   010    Pre-fail  Always       -       0
+170 Unknown_Attribute       0x0032   100   100   ---    Old_age   Always       -       7
+171 Unknown_Attribute       0x0032   100   100   ---    Old_age   Always       -       9
+194 Temperature_Celsius     0x0022   064   052   000    Old_age   Always       -       36 (Min/Max 24/48)
+'''
+
+NVME_INFO = '''smartctl 7.3 2022-02-28 r5338 [x86_64-linux-6.1.0] (local build)
+Copyright (C) 2002-22, Bruce Allen, Christian Franke, www.smartmontools.org
+
+=== START OF INFORMATION SECTION ===
+Model Number:                       Samsung SSD 970 EVO Plus 1TB
+Serial Number:                      S4EWNX0R123456A
+Firmware Version:                   2B2QEXM7
+PCI Vendor/Subsystem ID:            0x144d
+IEEE OUI Identifier:                0x002538
+Total NVM Capacity:                 1,000,204,886,016 [1.00 TB]
+Unallocated NVM Capacity:           0
+Controller ID:                      4
+NVMe Version:                       1.3
+Number of Namespaces:               1
+Namespace 1 Size/Capacity:          1,000,204,886,016 [1.00 TB]
+Namespace 1 Utilization:            120,031,457,280 [120 GB]
+Namespace 1 Formatted LBA Size:     512
+Namespace 1 IEEE EUI-64:            002538 5391b12345
+Local Time is:                      Mon Jul 15 10:00:00 2019 UTC
+'''
+
+NVME_HEALTH = '''smartctl 7.3 2022-02-28 r5338 [x86_64-linux-6.1.0] (local build)
+
+=== START OF SMART DATA SECTION ===
+SMART/Health Information (NVMe Log 0x02)
+Critical Warning:                   0x04
+Temperature:                        36 Celsius
+Available Spare:                    98%
+Available Spare Threshold:          10%
+Percentage Used:                    2%
+Data Units Read:                    1,234,567 [632 GB]
+Controller Busy Time:               20
+Power On Hours:                     8,760
+Warning  Comp. Temperature Time:    3
+Temperature Sensor 1:               36 Celsius
+'''
+
+SCSI_COUNTERS = '''smartctl 7.3 2022-02-28 r5338 [x86_64-linux-6.1.0] (local build)
+
+=== START OF READ SMART DATA SECTION ===
+Current Drive Temperature:     30 C
+Drive Trip Temperature:        60 C
+
+Elements in grown defect list: 4
+
+Error counter log:
+           Errors Corrected by           Total   Correction     Gigabytes    Total
+               ECC          rereads/    errors   algorithm      processed    uncorrected
+           fast | delayed   rewrites  corrected  invocations   [10^9 bytes]  errors
+read:          0        7         0         7          7       1024.500           1
+write:         0        0         0         0          0        512.250           0
+
+Non-medium error count:        0
+'''
+
+ALL_ATTRIBUTES = smartmon.AttributeSelection(None, True)
+
+
+def device():
+    return smartmon.Device('/dev/sda', types.SimpleNamespace(type='sat'))
+
+
+def render(device_metrics):
+    metrics = exposition.Exposition()
+    for m in sorted(device_metrics, key=lambda m: m.name):
+        smartmon.metric_add(metrics, m, 'smartmon_')
+    return metrics.render()
+
+
+def series(output):
+    return [line.rsplit(' ', 1)[0] for line in output.splitlines()
+            if not line.startswith('#')]
+
+
+class AttributeMetricsTest(unittest.TestCase):
+
+    def test_all_attributes_text_unique_series(self):
+        with mock.patch.object(smartmon, 'smart_ctl', return_value=ATTRIBUTES):
+            output = render(smartmon.collect_ata_metrics(device(), ALL_ATTRIBUTES))
+        names = series(output)
+        self.assertEqual(len(names), len(set(names)))
+        self.assertIn(
+            'smartmon_attr_raw_value{name="unknown_attribute",id="170",disk="/dev/sda"} 7',
+            output)
+        self.assertIn(
+            'smartmon_attr_raw_value{name="unknown_attribute",id="171",disk="/dev/sda"} 9',
+            output)
+        self.assertIn(
+            'smartmon_attr_raw_value{name="temperature_celsius",id="194",disk="/dev/sda"} 36',
+            output)
+
+    def test_whitelisted_attributes_without_id(self):
+        with mock.patch.object(smartmon, 'smart_ctl', return_value=ATTRIBUTES):
+            output = render(smartmon.collect_ata_metrics(device()))
+        self.assertIn(
+            'smartmon_attr_value{name="temperature_celsius",disk="/dev/sda"} 64', output)
+        self.assertNotIn('id=', output)
+
+    def test_all_attributes_json_unique_series(self):
+        data = {'ata_smart_attributes': {'table': [
+            {'id': 170, 'name': 'Unknown_SSD_Attribute', 'value': 100,
+             'worst': 100, 'thresh': 0, 'raw': {'value': 1, 'string': '1'}},
+            {'id': 173, 'name': 'Unknown_SSD_Attribute', 'value': 99,
+             'worst': 99, 'thresh': 0, 'raw': {'value': 2, 'string': '2'}},
+        ]}}
+        output = render(smartmon.collect_ata_metrics_json(device(), data, ALL_ATTRIBUTES))
+        names = series(output)
+        self.assertEqual(len(names), 8)
+        self.assertEqual(len(names), len(set(names)))
+
+
+def device_metrics(power_on_hours, temperature):
+    labels = device().base_labels
+    return [
+        smartmon.Metric('device_info', {**labels, 'serial_number': 'S1'}, True),
+        smartmon.Metric('attr_value', {'name': 'power_on_hours', 'id': 9, **labels},
+                        power_on_hours),
+        smartmon.Metric('attr_value', {'name': 'temperature_celsius', 'id': 194, **labels},
+                        temperature),
+    ]
+
+
+def unknown_attributes(first, second):
+    labels = device().base_labels
+    return [
+        smartmon.Metric('device_info', {**labels, 'serial_number': 'S1'}, True),
+        smartmon.Metric('attr_value', {'name': 'unknown_attribute', 'id': 170, **labels},
+                        first),
+        smartmon.Metric('attr_value', {'name': 'unknown_attribute', 'id': 171, **labels},
+                        second),
+    ]
+
+
+def attribute_values(metrics):
+    return {m.labels['name']: m.value for m in metrics if m.name == 'attr_value'}
+
+
+class ResultStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'state.json')
+        self.now = 1000.0
+        patcher = mock.patch.object(smartmon.time, 'time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def collect(self, store, power_on_hours, temperature):
+        refresh = store.is_due(device())
+        metrics = device_metrics(power_on_hours, temperature)
+        return refresh, attribute_values(store.update(device(), metrics, refresh))
+
+    def test_attribute_interval_longer_than_refresh_interval(self):
+        store = smartmon.ResultStore(self.path, 0, {'power_on_hours': 3600})
+        self.assertEqual(self.collect(store, 10, 30),
+                         (True, {'power_on_hours': 10, 'temperature_celsius': 30}))
+        store.save()
+
+        self.now += 60
+        store = smartmon.ResultStore(self.path, 0, {'power_on_hours': 3600})
+        self.assertEqual(self.collect(store, 11, 31),
+                         (True, {'power_on_hours': 10, 'temperature_celsius': 31}))
+
+        self.now += 3540
+        self.assertEqual(self.collect(store, 12, 32),
+                         (True, {'power_on_hours': 12, 'temperature_celsius': 32}))
+
+    def test_attribute_interval_shorter_than_refresh_interval(self):
+        store = smartmon.ResultStore(self.path, 3600, {'temperature_celsius': 300})
+        self.collect(store, 10, 30)
+
+        self.now += 299
+        self.assertFalse(store.is_due(device()))
+        self.now += 1
+        self.assertEqual(self.collect(store, 11, 31),
+                         (True, {'power_on_hours': 11, 'temperature_celsius': 31}))
+
+        self.now += 300
+        self.assertTrue(store.is_due(device()))
+
+    def test_refresh_interval(self):
+        store = smartmon.ResultStore(self.path, 3600)
+        self.collect(store, 10, 30)
+        self.now += 3599
+        self.assertFalse(store.is_due(device()))
+        self.now += 1
+        self.assertTrue(store.is_due(device()))
+
+    def test_attributes_sharing_a_name(self):
+        store = smartmon.ResultStore(self.path, 0, {'unknown_attribute': 3600})
+        store.update(device(), unknown_attributes(1, 2), True)
+        self.now += 60
+        metrics = store.update(device(), unknown_attributes(3, 4), True)
+        self.assertEqual(
+            sorted((m.labels['id'], m.value) for m in metrics if m.name == 'attr_value'),
+            [(170, 1), (171, 2)])
+
+    def test_stored_attributes_without_id(self):
+        store = smartmon.ResultStore(self.path, 0, {'unknown_attribute': 3600})
+        metrics = unknown_attributes(1, 2)
+        for m in metrics:
+            m.labels.pop('id', None)
+        store.update(device(), metrics[:2], True)
+        self.now += 60
+        # Switched to --all-attributes, the series without ID are not held
+        metrics = store.update(device(), unknown_attributes(3, 4), True)
+        self.assertEqual(
+            sorted((m.labels.get('id'), m.value) for m in metrics if m.name == 'attr_value'),
+            [(170, 3), (171, 4)])
+
+
+class TextCountersTest(unittest.TestCase):
+
+    def test_parse_nvme_health(self):
+        self.assertEqual(smartmon.parse_nvme_health(NVME_HEALTH), {
+            'nvme_smart_health_information_log': {
+                'critical_warning': 4,
+                'temperature': 36,
+                'available_spare': 98,
+                'available_spare_threshold': 10,
+                'percentage_used': 2,
+                'data_units_read': 1234567,
+                'controller_busy_time': 20,
+                'power_on_hours': 8760,
+                'warning_temp_time': 3,
+            }})
+
+    def test_parse_scsi_counters(self):
+        data = smartmon.parse_scsi_counters(SCSI_COUNTERS)
+        self.assertEqual(data['scsi_grown_defect_list'], 4)
+        self.assertEqual(data['temperature'], {'current': 30, 'drive_trip': 60})
+        self.assertEqual(sorted(data['scsi_error_counter_log']), ['read', 'write'])
+        self.assertEqual(data['scsi_error_counter_log']['read'], {
+            'errors_corrected_by_eccfast': 0,
+            'errors_corrected_by_eccdelayed': 7,
+            'errors_corrected_by_rereads_rewrites': 0,
+            'total_errors_corrected': 7,
+            'correction_algorithm_invocations': 7,
+            'gigabytes_processed': '1024.500',
+            'total_uncorrected_errors': 1,
+        })
+
+    def test_nvme_text_metrics(self):
+        nvme = smartmon.Device('/dev/nvme0', types.SimpleNamespace(type='nvme'))
+        with mock.patch.object(smartmon, 'smart_ctl', return_value=NVME_HEALTH):
+            output = render(smartmon.collect_nvme_metrics(nvme))
+        self.assertIn('smartmon_nvme_available_spare_ratio{disk="/dev/nvme0"} 0.98', output)
+        self.assertIn(
+            'smartmon_nvme_controller_busy_time_seconds_total{disk="/dev/nvme0"} 1200', output)
+        self.assertIn(
+            '# TYPE smartmon_nvme_controller_busy_time_seconds_total counter', output)
+        self.assertIn('# TYPE smartmon_nvme_power_on_hours_total counter', output)
+        self.assertIn('smartmon_nvme_power_on_hours_total{disk="/dev/nvme0"} 8760', output)
+        self.assertIn('# TYPE smartmon_nvme_temperature_celsius gauge', output)
+
+    def test_nvme_smart_support(self):
+        # smartctl --info prints no "SMART support is:" line for NVMe devices
+        def smart_ctl(*args):
+            return NVME_INFO if '--info' in args else NVME_HEALTH
+
+        nvme = smartmon.Device('/dev/nvme0', types.SimpleNamespace(type='nvme'))
+        with mock.patch.object(smartmon, 'smart_ctl', side_effect=smart_ctl), \
+                mock.patch.object(smartmon, 'smart_ctl_process',
+                                  return_value=types.SimpleNamespace(returncode=0)):
+            output = render(smartmon.collect_device_metrics_text(nvme))
+        self.assertIn('smartmon_device_smart_available{disk="/dev/nvme0"} 1', output)
+        self.assertIn('smartmon_device_smart_enabled{disk="/dev/nvme0"} 1', output)
+        self.assertIn(
+            'smartmon_device_info{disk="/dev/nvme0",device_model="Samsung SSD 970 EVO Plus 1TB",'
+            'serial_number="S4EWNX0R123456A",firmware_version="2B2QEXM7"} 1', output)
+        self.assertIn('smartmon_nvme_available_spare_ratio{disk="/dev/nvme0"} 0.98', output)
+
+    def test_scsi_text_metrics(self):
+        scsi = smartmon.Device('/dev/sdb', types.SimpleNamespace(type='scsi'))
+        with mock.patch.object(smartmon, 'smart_ctl', return_value=SCSI_COUNTERS):
+            output = render(smartmon.collect_scsi_metrics(scsi))
+        self.assertIn('# TYPE smartmon_scsi_processed_bytes_total counter', output)
+        self.assertIn(
+            'smartmon_scsi_processed_bytes_total{operation="read",disk="/dev/sdb"} '
+            '1024500000000', output)
+        self.assertIn(
+            'smartmon_scsi_errors_uncorrected_total{operation="read",disk="/dev/sdb"} 1',
+            output)
+        self.assertIn('smartmon_scsi_grown_defects{disk="/dev/sdb"} 4', output)
+        self.assertIn('smartmon_scsi_temperature_trip_celsius{disk="/dev/sdb"} 60', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
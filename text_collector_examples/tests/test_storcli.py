@@ -0,0 +1,51 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storcli  # noqa: E402
+
+
+def fake_storcli(directory, output):
+    """Write a storcli printing output."""
+    path = os.path.join(directory, 'storcli64')
+    with open(os.path.join(directory, 'output.json'), 'w') as f:
+        json.dump(output, f)
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\ncat {0}\n'.format(os.path.join(directory, 'output.json')))
+    os.chmod(path, 0o755)
+    return path
+
+
+class StorcliJSONTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_missing_binary_exits(self):
+        with self.assertRaises(SystemExit) as cm:
+            storcli.get_storcli_json(os.path.join(self.directory, 'storcli64'),
+                                     '/cALL show all J')
+        self.assertIn('unable to run', str(cm.exception.code))
+
+    def test_failed_command_exits(self):
+        path = fake_storcli(self.directory, {'Controllers': [{'Command Status': {
+            'Status': 'Failure', 'Description': 'Controller 0 not found'}}]})
+        with self.assertRaises(SystemExit) as cm:
+            storcli.get_storcli_json(path, '/c0 show all J')
+        self.assertIn('Controller 0 not found', str(cm.exception.code))
+
+    def test_success(self):
+        output = {'Controllers': [{'Command Status': {'Status': 'Success'},
+                                   'Response Data': {}}]}
+        path = fake_storcli(self.directory, output)
+        self.assertEqual(storcli.get_storcli_json(path, '/cALL show all J'), output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import textfile_writer  # noqa: E402
+
+OUTPUT = '''# HELP btrfs_errors_total number of btrfs errors
+# TYPE btrfs_errors_total counter
+btrfs_errors_total{{fs="f",type="write"}} 0
+# HELP textfile_collector_phase_duration_seconds Duration of a phase of the text collector run.
+# TYPE textfile_collector_phase_duration_seconds gauge
+textfile_collector_phase_duration_seconds{{collector="btrfs_stats",phase="errors"}} {0}
+# HELP textfile_collector_subprocess_duration_seconds Total duration of the subprocesses of the text collector run.
+# TYPE textfile_collector_subprocess_duration_seconds gauge
+textfile_collector_subprocess_duration_seconds{{collector="btrfs_stats"}} {0}
+'''
+
+
+class WriteTextfileTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'btrfs_stats.prom')
+
+    def write(self, content):
+        return textfile_writer.write_textfile(self.path, 'btrfs_stats', content, 0.1)
+
+    def test_timings_do_not_cause_a_write(self):
+        self.assertTrue(self.write(OUTPUT.format(0.001)))
+        self.assertFalse(self.write(OUTPUT.format(0.002)))
+        with open(self.path) as f:
+            self.assertIn('phase="errors"} 0.001\n', f.read())
+
+    def test_changed_sample_is_written(self):
+        self.assertTrue(self.write(OUTPUT.format(0.001)))
+        self.assertTrue(self.write(OUTPUT.format(0.001).replace('} 0\n', '} 1\n')))
+
+    def test_smartctl_run_is_not_hashed(self):
+        self.assertEqual(
+            textfile_writer.content_hash('smartmon_smartctl_run{disk="/dev/sda"} 1\n'),
+            textfile_writer.content_hash('smartmon_smartctl_run{disk="/dev/sda"} 2\n'))
+
+
+
+class WriteAtomicTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_replaces_file(self):
+        path = os.path.join(self.directory, 'cache.json')
+        textfile_writer.write_atomic(path, 'old')
+        textfile_writer.write_atomic(path, 'new')
+        with open(path) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertEqual(os.listdir(self.directory), ['cache.json'])
+
+    def test_failed_write_leaves_no_temporary_file(self):
+        # The rename fails, as the destination is a directory
+        path = os.path.join(self.directory, 'cache.json')
+        os.mkdir(path)
+        with self.assertRaises(OSError):
+            textfile_writer.write_atomic(path, 'new')
+        self.assertEqual(os.listdir(self.directory), ['cache.json'])
+
+    def test_failed_encoding_leaves_no_temporary_file(self):
+        with self.assertRaises(TypeError):
+            textfile_writer.write_atomic(os.path.join(self.directory, 'cache.json'), None)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Run the Python text collectors on schedules and write their metrics into the
+textfile collector directory.
+
+The collectors are imported once, so a run does not pay the interpreter
+startup and import cost. Every run is forked from the agent, so that a run
+exceeding its timeout is killed together with the subprocesses it started
+(smartctl, storcli, ...), and the agent keeps no state of the collectors
+between runs.
+
+The collectors are configured in a JSON file, by module name:
+
+    {
+        "smartmon": {"interval": 300, "timeout": 120,
+                     "args": ["--workers", "4"]},
+        "storcli": {"args": ["--cache_file", "/var/cache/storcli.json"]},
+        "ntpd_metrics": {"interval": 60}
+    }
+
+interval and timeout are seconds, timeout defaults to the interval. Runs are
+spread by a random jitter around the interval. Collectors querying disks
+(smartmon, storcli, btrfs_stats) are not run more than --disk-concurrency at
+a time. Each collector writes NAME.prom in the directory, see
+textfile_writer.py.
+
+Usage: ./textfile_agent.py [--disk-concurrency N] [--jitter FRACTION]
+                           [--fsync] CONFIG DIRECTORY
+
+Requires Python 3.7 or later.
+"""
+
+import argparse
+import asyncio
+import collections
+import importlib
+import json
+import os
+import random
+import signal
+import sys
+import time
+import traceback
+
+import textfile_writer
+
+# Collectors by module name, with their default interval in seconds and
+# whether they query disks.
+COLLECTORS = {
+    'smartmon': (300, True),
+    'storcli': (300, True),
+    'btrfs_stats': (60, True),
+    'ntpd_metrics': (60, False),
+    'deleted_libraries': (300, False),
+    # deleted_libraries and inotify-instances in a single walk of /proc
+    'procwalk': (300, False),
+}
+
+Collector = collections.namedtuple(
+    'Collector', ['name', 'module', 'args', 'interval', 'timeout', 'disk'])
+
+
+def load_collectors(path):
+    """Import and configure the collectors of a configuration file.
+
+    The arguments of the collectors are parsed here, so that invalid ones
+    stop the agent at startup.
+
+    Returns:
+        list of Collector.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError('expected an object of collectors')
+
+    collectors = []
+    for name, options in sorted(config.items()):
+        if name not in COLLECTORS:
+            raise ValueError('unknown collector {0}'.format(name))
+        interval, disk = COLLECTORS[name]
+        interval = float(options.get('interval', interval))
+        if interval <= 0:
+            raise ValueError('interval of {0} must be positive'.format(name))
+        module = importlib.import_module(name)
+        argv = [str(arg) for arg in options.get('args', [])]
+        collectors.append(Collector(
+            name=name,
+            module=module,
+            args=module.parse_args(argv),
+            interval=interval,
+            timeout=float(options.get('timeout', interval)),
+            disk=bool(options.get('disk', disk))))
+    return collectors
+
+
+def collect_in_child(collector, write_fd):
+    """Run a collector in a forked process and write its output to write_fd.
+
+    Never returns.
+    """
+    status = 0
+    try:
+        # Signals are handled by the event loop of the agent otherwise
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        metrics = collector.module.collect(collector.args)
+        output = metrics.render().encode('utf-8')
+        with os.fdopen(write_fd, 'wb') as f:
+            f.write(output)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            status = 1
+            if not isinstance(e.code, int):
+                print('{0}: {1}'.format(collector.name, e.code),
+                      file=sys.stderr)
+    except BaseException:
+        status = 1
+        print('{0}: {1}'.format(collector.name, traceback.format_exc()),
+              file=sys.stderr, end='')
+    finally:
+        sys.stderr.flush()
+        os._exit(status)
+
+
+async def wait_process(pid):
+    """Wait for a child process without blocking the event loop.
+
+    Returns:
+        (int) exit status, negative for the signal which killed the process.
+    """
+    while True:
+        wpid, status = os.waitpid(pid, os.WNOHANG)
+        if wpid:
+            if os.WIFSIGNALED(status):
+                return -os.WTERMSIG(status)
+            return os.WEXITSTATUS(status)
+        await asyncio.sleep(0.01)
+
+
+async def run_forked(collector):
+    """Run a collector in a forked process, within its timeout.
+
+    Returns:
+        (output, success) tuple.
+    """
+    loop = asyncio.get_running_loop()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        # A process group of its own, to kill the subprocesses on timeout
+        os.setpgid(0, 0)
+        collect_in_child(collector, write_fd)
+    os.close(write_fd)
+    try:
+        os.setpgid(pid, pid)
+    except OSError:
+        # The child has set it already, or exited
+        pass
+
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader),
+        os.fdopen(read_fd, 'rb', 0))
+
+    async def communicate():
+        output = await reader.read()
+        status = await wait_process(pid)
+        return output, status
+
+    try:
+        output, status = await asyncio.wait_for(
+            communicate(), collector.timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        os.waitpid(pid, 0)
+        if isinstance(e, asyncio.CancelledError):
+            raise
+        print('{0}: killed after {1}s timeout'.format(
+            collector.name, collector.timeout), file=sys.stderr)
+        return '', False
+    finally:
+        transport.close()
+    return output.decode('utf-8'), status == 0
+
+
+async def schedule(collector, directory, disk_semaphore, jitter, fsync):
+    """Run a collector forever, every interval with jitter."""
+    loop = asyncio.get_running_loop()
+    path = os.path.join(directory, collector.name + '.prom')
+    # Do not start all collectors at the same moment either
+    next_run = loop.time() + random.uniform(0, collector.interval * jitter)
+    while True:
+        await asyncio.sleep(max(0, next_run - loop.time()))
+        if collector.disk:
+            async with disk_semaphore:
+                start = time.monotonic()
+                output, success = await run_forked(collector)
+        else:
+            start = time.monotonic()
+            output, success = await run_forked(collector)
+        duration = time.monotonic() - start
+        try:
+            textfile_writer.write_textfile(
+                path, collector.name, output, duration, success, fsync)
+        except OSError as e:
+            print('{0}: failed to write {1}: {2}'.format(
+                collector.name, path, e), file=sys.stderr)
+
+        next_run += collector.interval * random.uniform(1 - jitter, 1 + jitter)
+        # Skip the runs missed by a run taking longer than the interval
+        if next_run < loop.time():
+            next_run = loop.time()
+
+
+async def run_agent(collectors, directory, disk_concurrency, jitter, fsync):
+    loop = asyncio.get_running_loop()
+    disk_semaphore = asyncio.Semaphore(disk_concurrency)
+    tasks = [
+        asyncio.ensure_future(
+            schedule(collector, directory, disk_semaphore, jitter, fsync))
+        for collector in collectors]
+    stopped = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopped.set)
+
+    done = asyncio.ensure_future(
+        asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION))
+    await asyncio.wait([done, asyncio.ensure_future(stopped.wait())],
+                       return_when=asyncio.FIRST_COMPLETED)
+    # Cancelling kills the running collectors
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for task in tasks:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--disk-concurrency', type=int, default=1,
+                        help='number of collectors querying disks run at the '
+                        'same time')
+    parser.add_argument('--jitter', type=float, default=0.1,
+                        help='fraction of the interval by which runs are '
+                        'spread randomly')
+    parser.add_argument('--fsync', action='store_true',
+                        help='sync the written files to disk')
+    parser.add_argument('config', help='JSON file configuring the collectors')
+    parser.add_argument('directory', help='textfile collector directory')
+    args = parser.parse_args()
+
+    if args.disk_concurrency < 1:
+        parser.error('--disk-concurrency must be at least 1')
+    if not 0 <= args.jitter < 1:
+        parser.error('--jitter must be at least 0 and less than 1')
+    try:
+        collectors = load_collectors(args.config)
+    except (OSError, ValueError) as e:
+        sys.exit('Failed to load {0}: {1}'.format(args.config, e))
+    if not collectors:
+        sys.exit('No collectors configured in {0}'.format(args.config))
+
+    asyncio.run(run_agent(
+        collectors, args.directory, args.disk_concurrency, args.jitter,
+        args.fsync))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Run a text collector and write its output into the textfile collector
+directory.
+
+The file is replaced atomically, with a temporary file in the same directory
+which is renamed over it. The rewrite is skipped if the collector output is
+unchanged since the last run, so the textfile collector does not need to parse
+it again and node_textfile_mtime_seconds shows when the metrics last changed.
+Samples differing on every run, like the durations of instrumentation.py, are
+left out of that comparison.
+
+The duration of the collector run and whether it succeeded are added to the
+file as textfile_collector_duration_seconds and textfile_collector_success.
+
+Usage: ./textfile_writer.py [--fsync] [--name NAME] OUTPUT COLLECTOR [ARGS...]
+
+Python collectors are run in the same interpreter, other collectors as
+subprocess.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import re
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+
+import instrumentation
+
+# The first line of a written file holds the hash of the collector output.
+HASH_PREFIX = '# textfile_writer sha256='
+
+# Samples left out of the hash, as they change with every run: the durations
+# of instrumentation.py and the time of the smartctl runs of smartmon.py.
+UNHASHED_METRICS = instrumentation.TIMING_METRICS + ('smartmon_smartctl_run',)
+
+_unhashed_samples = re.compile(r'^(?:{0})[{{ ].*\n'.format(
+    '|'.join(map(re.escape, UNHASHED_METRICS))), re.M)
+
+
+def content_hash(content):
+    """Hash collector output, without the samples of UNHASHED_METRICS."""
+    hashed = _unhashed_samples.sub('', content)
+    return hashlib.sha256(hashed.encode('utf-8')).hexdigest()
+
+
+def read_hash(path):
+    """Read the hash of the collector output of a written file.
+
+    Returns:
+        (str) hex digest, None if the file does not exist or has no hash.
+    """
+    try:
+        with open(path) as f:
+            line = f.readline()
+    except (OSError, UnicodeDecodeError):
+        return None
+    if line.startswith(HASH_PREFIX):
+        return line[len(HASH_PREFIX):].strip()
+    return None
+
+
+def write_atomic(path, content, fsync=False):
+    """Atomically replace a file.
+
+    Args:
+        path: (str) file to replace.
+        content: (str) new content.
+        fsync: (bool) sync the file and the directory to disk.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            # mkstemp creates the file only readable by the owner
+            os.fchmod(f.fileno(), 0o644)
+            if fsync:
+                os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    if fsync:
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def status_metrics(collector, duration, success):
+    collector = collector.replace('\\', '\\\\').replace('\n', '\\n')
+    collector = collector.replace('"', '\\"')
+    return (
+        '# HELP textfile_collector_duration_seconds '
+        'Duration of the text collector run.\n'
+        '# TYPE textfile_collector_duration_seconds gauge\n'
+        'textfile_collector_duration_seconds{{collector="{0}"}} {1:.6f}\n'
+        '# HELP textfile_collector_success '
+        'Whether the text collector run succeeded.\n'
+        '# TYPE textfile_collector_success gauge\n'
+        'textfile_collector_success{{collector="{0}"}} {2:d}\n'
+    ).format(collector, duration, success)
+
+
+def write_textfile(path, collector, content, duration, success=True,
+                   fsync=False):
+    """Write the output of a collector run into a textfile.
+
+    The file is left alone if the run succeeded and its output did not change
+    since the last written run, apart from the samples of UNHASHED_METRICS.
+    These and the duration of the previous run are kept then.
+
+    Args:
+        path: (str) file in the textfile collector directory.
+        collector: (str) name of the collector, for the status metrics.
+        content: (str) collector output, in the text exposition format. Only
+            the status metrics are written if the run failed.
+        duration: (float) seconds the collector ran.
+        success: (bool) whether the collector run succeeded.
+        fsync: (bool) sync the file to disk.
+
+    Returns:
+        (bool) whether the file was written.
+    """
+    if not success:
+        # No hash either, so that the next successful run is written
+        write_atomic(path, status_metrics(collector, duration, success), fsync)
+        return True
+
+    if content and not content.endswith('\n'):
+        content += '\n'
+    digest = content_hash(content)
+    if read_hash(path) == digest:
+        return False
+    status = status_metrics(collector, duration, success)
+    write_atomic(path, HASH_PREFIX + digest + '\n' + content + status, fsync)
+    return True
+
+
+def run(collect):
+    """Run a collector function and capture what it prints.
+
+    Args:
+        collect: function printing metrics to stdout.
+
+    Returns:
+        (output, duration, success) tuple. A collector fails if it raises an
+        exception or exits with a non-zero status.
+    """
+    output = io.StringIO()
+    start = time.monotonic()
+    success = True
+    try:
+        with contextlib.redirect_stdout(output):
+            collect()
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            success = False
+            if not isinstance(e.code, int):
+                print(e.code, file=sys.stderr)
+    except Exception as e:
+        success = False
+        print('{0}: {1}'.format(type(e).__name__, e), file=sys.stderr)
+    return output.getvalue(), time.monotonic() - start, success
+
+
+def is_python_script(path):
+    if path.endswith('.py'):
+        return True
+    try:
+        with open(path, 'rb') as f:
+            return b'python' in f.readline()
+    except OSError:
+        return False
+
+
+def script_collector(path, args):
+    """Get a function running a collector script.
+
+    Python scripts are run in this interpreter as __main__, with sys.argv set
+    to the arguments.
+    """
+    if is_python_script(path):
+        def collect():
+            argv = sys.argv
+            sys.argv = [path] + list(args)
+            try:
+                runpy.run_path(path, run_name='__main__')
+            finally:
+                sys.argv = argv
+    else:
+        def collect():
+            sys.stdout.write(
+                subprocess.run([path] + list(args), stdout=subprocess.PIPE,
+                               check=True, universal_newlines=True).stdout)
+    return collect
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--fsync', action='store_true',
+                        help='sync the written file to disk')
+    parser.add_argument('--name',
+                        help='collector label of the status metrics, by '
+                        'default the collector file name without extension')
+    parser.add_argument('output',
+                        help='file in the textfile collector directory')
+    parser.add_argument('collector', help='collector script')
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='collector arguments')
+    args = parser.parse_args()
+
+    name = args.name or os.path.splitext(os.path.basename(args.collector))[0]
+    content, duration, success = run(
+        script_collector(args.collector, args.args))
+    write_textfile(args.output, name, content, duration, success, args.fsync)
+    if not success:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()